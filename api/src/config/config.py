@@ -1,3 +1,6 @@
+import os
+import tempfile
+
 
 PAPERS_DATA_DIR_PATH = "/data/"
 PAPERS_DATA_FILE = "papers-with-abstracts.json.gz" # https://paperswithcode.com/media/about/papers-with-abstracts.json.gz
@@ -8,11 +11,97 @@ MODEL_SERVING_SERVICE_CONFIG = {
     'min_port': 5001, # min port in range
     'max_port': 5999, # max port in range
     'max_concurrent_models': 5, # max number of running models
-    'max_retries': 6 # max number of retries on model prediction (using exponential algo.)
+    'max_memory': 1024 * 4, # max memory (MB) used by the model pool workers
+    'ready_timeout': 60*10, # max time (seconds) to wait for a model to be ready; includes worker boot and model load
+    'ready_poll_interval': 0.5, # interval (seconds) between worker health checks
+    'micro_batching': True, # coalesce concurrent prediction requests of a model into a single invocation
+    'batch_max_rows': 100, # max number of rows of a coalesced invocation
+    'batch_max_latency': 0.005, # latency budget (seconds): max time a request waits for its batch to be sent
+    'registry_path': os.path.join(tempfile.gettempdir(), 'shipped-brain', 'model-serving-registry.json') # live models registry shared by the server processes of the host
+}
+
+PREDICTION_SERVICE_CONFIG = {
+    'max_batch_size': 10, # max number of rows per prediction request
+    'max_payload_size': 10, # max size (MB) of a streamed prediction request body
+    'stream_chunk_size': 64 * 1024, # size (bytes) of the chunks of streamed prediction payloads
+    # accepted streamed prediction payloads; Arrow IPC requires pyarrow in the model's conda environment
+    'content_types': ['application/json', 'application/vnd.apache.arrow.stream', 'application/x-npy']
+}
+
+# Cache directory shared by the servers of the host; e.g. a docker volume
+CACHE_DIR = os.environ.get('CACHE_DIR', os.path.join(tempfile.gettempdir(), 'shipped-brain'))
+
+CONDA_ENV_SERVICE_CONFIG = {
+    'cache_path': os.path.join(CACHE_DIR, 'conda-envs.json'), # (model, version) to resolved conda env. cache
+    'env_files_dir': os.path.join(CACHE_DIR, 'conda-envs') # copies of the models' conda.yaml files
+}
+
+ARTIFACT_CACHE_CONFIG = {
+    'cache_dir': os.path.join(CACHE_DIR, 'artifacts'), # run artifacts cache; e.g. shipped-brain.yaml, MLmodel
+    'max_disk_size': 1024, # max size (MB) of the cached artifacts on disk
+    'max_memory_size': 64 # max size (MB) of the cached artifacts in memory, per process
+}
+
+PREDICTION_CACHE_CONFIG = {
+    'path': os.path.join(CACHE_DIR, 'predictions.db'), # per-row predictions of models that opted in to caching
+    'max_disk_size': 1024, # max size (MB) of the cached predictions on disk
+    'max_memory_size': 64, # max size (MB) of the cached predictions in memory, per process
+    'settings_ttl': 60 # lifetime (seconds) of a model's cached caching setting
+}
+
+METERING_CONFIG = {
+    'spool_dir': os.path.join(CACHE_DIR, 'metering'), # local spool of api call events not yet written to the database
+    'flush_interval': 5, # max time (seconds) between writes of api call events
+    'flush_size': 1000, # number of pending api call events that triggers a write
+    'max_attempts': 5, # failed writes after which a batch of api call events is moved to '<spool_dir>/dead'
+    'minute_rollup_retention': 7, # retention (days) of per minute usage rollups; older usage is kept per hour
+    'hour_rollup_retention': 90, # retention (days) of per hour usage rollups; older usage is kept per day
+    'batch_retention': 7, # retention (days) of the ids of written api call event batches
+    'retention_interval': 3600 # interval (seconds) between deletions of expired usage rollups
+}
+
+BATCH_JOB_SERVICE_CONFIG = {
+    'jobs_dir': os.path.join(CACHE_DIR, 'jobs'), # input and output files of batch scoring jobs
+    'max_input_size': 1024, # max size (MB) of a batch scoring input file
+    'chunk_size': 1000, # number of rows scored per model invocation
+    'chunk_concurrency': 4, # max number of chunks of a job scored concurrently
+    'max_concurrent_jobs': 2, # max number of jobs run concurrently by each prediction server process
+    'poll_interval': 2, # interval (seconds) between checks for queued jobs
+    'heartbeat_interval': 10, # interval (seconds) between heartbeats of the jobs run by a prediction server process
+    'stale_timeout': 60, # time (seconds) without heartbeats after which a running job is recovered
+    'max_attempts': 3 # max number of runs of a job; e.g. jobs whose prediction server process stopped are run again
+}
+
+IMAGE_CONFIG = {
+    'thumbnails_dir': os.path.abspath(os.path.join('files', 'thumbnails')), # resized user photos and model covers
+    'static_url': os.environ.get('STATIC_URL', '/api/v0/static'), # URL of the thumbnails directory
+    'photo_size': 128, # max width and height (px) of user photo thumbnails
+    'cover_size': 640, # max width and height (px) of model cover thumbnails
+    'max_age': 60*60*24 # lifetime (seconds) of thumbnails in clients' caches; a new upload changes the URL
+}
+
+AUTH_CONFIG = {
+    'principal_ttl': 30, # lifetime (seconds) of a cached authenticated user; bounds staleness of other processes' updates
+    'max_principals': 10000 # max number of cached authenticated users, per process
 }
 
 MODEL_UPLOAD_SERVICE_CONFIG = {
-    'max_model_size': 1024, # max zip file size
-    'max_concurrent_uploads_all': 1, #max number of concurrent model uplaods on the platform
-    'max_concurrent_uploads_user': 1 #max number of concurrent model uplaods per user on the platform
+    'uploads_dir': os.path.join(CACHE_DIR, 'uploads'), # uploaded zip files waiting to be registered
+    'max_model_size': 1024, # max zip file size (MB); enforced while the upload is streamed
+    'max_uncompressed_size': 4096, # max total size (MB) of the zip file's contents
+    'max_files': 10000, # max number of files in the zip file
+    'dedupe_uploads': True, # identical uploads of a user resolve to the version already registered
+    'dedupe_artifacts': True, # artifact files already stored are copied server side instead of uploaded
+    'dedupe_min_size': 64 * 1024, # min size (bytes) of deduplicated artifact files
+    'workers': int(os.environ.get('UPLOAD_WORKERS', 2)), # number of upload worker processes; i.e. max number of concurrent model uploads on the platform
+    'max_concurrent_uploads_user': 1, # max number of concurrent model uploads per user on the platform
+    'max_queued_uploads': 100, # max number of queued and running model uploads on the platform
+    'max_queued_uploads_user': 3, # max number of queued and running model uploads per user
+    'poll_interval': 2, # interval (seconds) between checks for queued uploads of an idle worker
+    'heartbeat_interval': 10, # interval (seconds) between heartbeats of a worker running an upload
+    'stale_timeout': 60, # time (seconds) without heartbeats after which a running upload is recovered
+    'max_attempts': 3, # max number of runs of an upload; e.g. uploads whose worker crashed are run again
+    'progress_poll_interval': 1, # interval (seconds) between checks of an upload's progress stream
+    'progress_keep_alive': 15, # max time (seconds) between events of an upload's progress stream
+    'progress_timeout': 3600 # max duration (seconds) of an upload's progress stream
 }
\ No newline at end of file
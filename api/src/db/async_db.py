@@ -0,0 +1,62 @@
+'''
+Async database access for the hot read paths of async routers; e.g. auth lookup and model listings.
+
+Queries are SQLAlchemy core statements built from the ORM tables and run with asyncpg, thus they never block the
+event loop. Blocking calls that remain, e.g. ORM services or mlflow's client, run in a bounded thread pool with
+run_blocking; the pool is also the event loop's default executor, used by sync routes.
+'''
+import asyncio
+import contextvars
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Mapping, Optional, Type
+
+import databases
+from db.db_config import db_url, pool_settings
+
+# asyncpg driver; e.g. postgresql+psycopg2://... -> postgresql://...
+async_db_url = os.getenv('ASYNC_DB_URL', db_url.replace('+psycopg2', '') if db_url else db_url)
+
+database = databases.Database(async_db_url,
+                              min_size=int(os.getenv('ASYNC_DB_MIN_POOL_SIZE', 1)),
+                              max_size=int(os.getenv('ASYNC_DB_MAX_POOL_SIZE', pool_settings['pool_size'])))
+
+# Bounded by the number of connections blocking calls may hold
+blocking_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv('DB_BLOCKING_POOL_SIZE', pool_settings['pool_size'] + pool_settings['max_overflow'])),
+    thread_name_prefix='blocking')
+
+
+async def connect() -> None:
+    ''' Connect the async database and bound the event loop's default executor; run on app startup
+    '''
+    asyncio.get_event_loop().set_default_executor(blocking_executor)
+    await database.connect()
+
+
+async def disconnect() -> None:
+    await database.disconnect()
+
+
+async def run_blocking(func: Callable[..., Any], *args, **kwargs) -> Any:
+    ''' Run a blocking function in the bounded thread pool. The context is copied, thus the function uses the
+    database session of the current request
+
+    :param func: the blocking function
+
+    :return: the function's return value
+    '''
+    context = contextvars.copy_context()
+    call = functools.partial(context.run, func, *args, **kwargs)
+
+    return await asyncio.get_event_loop().run_in_executor(blocking_executor, call)
+
+
+def to_model(model_class: Type, record: Optional[Mapping]):
+    ''' Build a transient ORM object from a record of its table; None if record is None
+    '''
+    if record is None:
+        return None
+
+    return model_class(**{column.name: record[column.name] for column in model_class.__table__.columns})
@@ -1,7 +1,11 @@
 from dotenv import load_dotenv
 from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import sessionmaker, scoped_session
 from sqlalchemy.ext.declarative import declarative_base
+from contextvars import ContextVar
+from typing import Optional
+import threading
+import uuid
 import os
 
 # Load env variables
@@ -9,12 +13,55 @@ load_dotenv()
 
 # Engine setup
 db_url = os.getenv('DB_URL')
+db_read_url = os.getenv('DB_READ_URL') # optional read replica
+
+# Pool size is per process; e.g. gunicorn workers * (pool_size + max_overflow) must fit the server's max connections
+pool_settings = {
+    'pool_size': int(os.getenv('DB_POOL_SIZE', 5)),
+    'max_overflow': int(os.getenv('DB_MAX_OVERFLOW', 10)),
+    'pool_timeout': int(os.getenv('DB_POOL_TIMEOUT', 30)),
+    'pool_recycle': int(os.getenv('DB_POOL_RECYCLE', 1800)),
+    'pool_pre_ping': True
+}
 
 print(f'[DEBUG] Using DB URL {db_url}')
 print('[INFO] Creating database engine')
-engine = create_engine(db_url)
+engine = create_engine(db_url, **pool_settings)
+read_engine = create_engine(db_read_url, **pool_settings) if db_read_url else engine
+
+# Session scope: a request, set by DBSessionMiddleware, or a background task; defaults to the current thread
+session_scope: ContextVar[Optional[str]] = ContextVar('session_scope', default=None)
+
+
+def get_session_scope():
+    scope = session_scope.get()
+
+    return scope if scope is not None else threading.get_ident()
+
+
+def begin_session_scope():
+    ''' Start a new session scope in the current context; e.g. in a background task
+
+    :return: token to pass to end_session_scope
+    '''
+    return session_scope.set(uuid.uuid4().hex)
+
+
+def end_session_scope(token) -> None:
+    ''' Close the sessions of the current scope and restore the previous scope
+    '''
+    try:
+        session.remove()
+        if read_session is not session:
+            read_session.remove()
+    finally:
+        session_scope.reset(token)
+
 
 Session = sessionmaker(bind = engine)
-session = Session()
+session = scoped_session(Session, scopefunc=get_session_scope)
+
+# Read-only queries that tolerate replication lag; same as session if there is no read replica
+read_session = scoped_session(sessionmaker(bind = read_engine), scopefunc=get_session_scope) if db_read_url else session
 
-Base = declarative_base()
\ No newline at end of file
+Base = declarative_base()
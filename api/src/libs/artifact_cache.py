@@ -0,0 +1,175 @@
+'''
+Read-through cache of run artifacts, e.g. shipped-brain.yaml and MLmodel files.
+
+Run artifacts are immutable once logged, thus entries never need invalidating. Artifacts are stored on disk
+content-addressed by their sha256 - refs map (run_id, artifact path) to a blob - and the most recently used
+ones are kept in memory. Both levels are size bounded and evict least recently used entries first.
+'''
+import hashlib
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Callable, Optional
+
+
+class ArtifactCache:
+
+    def __init__(self, cache_dir: str, max_disk_size: int, max_memory_size: int):
+        ''' Artifact cache
+
+        :param cache_dir: directory of the disk cache; may be shared by several processes
+        :param max_disk_size: max size (bytes) of the blobs on disk
+        :param max_memory_size: max size (bytes) of the blobs in memory
+        '''
+        self.blobs_dir = os.path.join(cache_dir, 'blobs')
+        self.refs_dir = os.path.join(cache_dir, 'refs')
+        self.max_disk_size = max_disk_size
+        self.max_memory_size = max_memory_size
+        self.memory: OrderedDict = OrderedDict()  # (run_id, path): bytes
+        self.memory_size = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(self.blobs_dir, exist_ok=True)
+        os.makedirs(self.refs_dir, exist_ok=True)
+
+    def __ref_path(self, run_id: str, path: str) -> str:
+        return os.path.join(self.refs_dir, hashlib.sha256(f'{run_id}/{path}'.encode('utf-8')).hexdigest())
+
+    def __blob_path(self, digest: str) -> str:
+        return os.path.join(self.blobs_dir, digest[:2], digest)
+
+    @staticmethod
+    def __write_atomic(path: str, content: bytes) -> None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(content)
+            os.replace(tmp_path, path)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+
+    def __get_blob_path(self, run_id: str, path: str) -> Optional[str]:
+        ''' Get the blob of an artifact on disk; None if it is not cached
+        '''
+        try:
+            with open(self.__ref_path(run_id, path), 'r') as f:
+                blob_path = self.__blob_path(f.read().strip())
+            # access time for LRU eviction; atime is often disabled on mounts
+            os.utime(blob_path)
+            return blob_path
+        except FileNotFoundError:
+            return None
+
+    def __put_memory(self, key: tuple, content: bytes) -> None:
+        if len(content) > self.max_memory_size:
+            return
+
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                return
+
+            self.memory[key] = content
+            self.memory_size += len(content)
+            while self.memory_size > self.max_memory_size:
+                _, evicted = self.memory.popitem(last=False)
+                self.memory_size -= len(evicted)
+
+    def __evict_disk(self, keep: str) -> None:
+        ''' Remove least recently used blobs until the disk cache fits max_disk_size.
+        Refs of removed blobs are left dangling and read as misses
+
+        :param keep: path of a blob that must not be removed; e.g. the blob just written
+        '''
+        blobs = []
+        for root, _, files in os.walk(self.blobs_dir):
+            for file in files:
+                if file.endswith('.tmp'):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(root, file))
+                    blobs.append((stat.st_mtime, stat.st_size, os.path.join(root, file)))
+                except FileNotFoundError:
+                    pass
+
+        disk_size = sum(b[1] for b in blobs)
+        for _, size, blob_path in sorted(blobs):
+            if disk_size <= self.max_disk_size:
+                break
+            if blob_path == keep:
+                continue
+            try:
+                os.remove(blob_path)
+            except FileNotFoundError:
+                pass
+            disk_size -= size
+
+    def get_path(self, run_id: str, path: str, download: Callable[[str, str], str]) -> str:
+        ''' Get local path of a run artifact; downloads it on cache miss
+
+        :param run_id: run id of the artifact
+        :param path: artifact path relative to the run's artifact root
+        :param download: function (run_id, path) -> local path; e.g. MlflowClient.download_artifacts
+
+        :return: path of the cached artifact
+        '''
+        blob_path = self.__get_blob_path(run_id, path)
+        if blob_path is not None:
+            self.hits += 1
+            return blob_path
+
+        self.misses += 1
+        with open(download(run_id, path), 'rb') as f:
+            content = f.read()
+
+        digest = hashlib.sha256(content).hexdigest()
+        blob_path = self.__blob_path(digest)
+        if not os.path.exists(blob_path):
+            ArtifactCache.__write_atomic(blob_path, content)
+        ArtifactCache.__write_atomic(self.__ref_path(run_id, path), digest.encode('utf-8'))
+
+        self.__put_memory((run_id, path), content)
+        self.__evict_disk(keep=blob_path)
+
+        return blob_path
+
+    def get(self, run_id: str, path: str, download: Callable[[str, str], str]) -> bytes:
+        ''' Get content of a run artifact; downloads it on cache miss
+
+        :param run_id: run id of the artifact
+        :param path: artifact path relative to the run's artifact root
+        :param download: function (run_id, path) -> local path; e.g. MlflowClient.download_artifacts
+
+        :return: artifact content
+        '''
+        key = (run_id, path)
+        with self.lock:
+            content = self.memory.get(key)
+            if content is not None:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                return content
+
+        try:
+            with open(self.get_path(run_id, path, download), 'rb') as f:
+                content = f.read()
+        except FileNotFoundError:
+            # blob evicted by another process in between; read through
+            os.remove(self.__ref_path(run_id, path))
+            with open(self.get_path(run_id, path, download), 'rb') as f:
+                content = f.read()
+
+        self.__put_memory(key, content)
+
+        return content
+
+    def stats(self) -> dict:
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'memory_entries': len(self.memory),
+                'memory_size': self.memory_size}
@@ -0,0 +1,201 @@
+'''
+Usage metering queue with a crash-safe local spool.
+
+Events are appended as JSON lines to a spool file owned by the process, thus the request path never waits on the
+database. A background thread moves the spool aside and hands the events to a writer (e.g. a bulk insert) every
+flush_interval seconds or once flush_size events are pending; a batch file is only removed after it was written.
+Batches keep their id when their spool is taken over, thus writers can skip batches already written, e.g. by a
+process that crashed before removing the batch file. Batches that keep failing while other batches are written,
+e.g. events of a deleted user, are moved to the 'dead' directory after max_attempts failures.
+
+Each process holds an exclusive file lock on its '<owner>.owner' file while it lives. Flushers take over the
+spools of owners whose lock is free, i.e. of processes that crashed or were restarted.
+'''
+import atexit
+import fcntl
+import glob
+import json
+import os
+import socket
+import threading
+import time
+from typing import Callable, List
+
+
+class MeteringQueue:
+
+    def __init__(self, spool_dir: str, writer: Callable[[List[dict], str], None], flush_interval: float = 5,
+                 flush_size: int = 1000, max_attempts: int = 5):
+        ''' Metering queue
+
+        :param spool_dir: directory of the spool files; may be shared by several processes
+        :param writer: function (events, batch id) that durably writes a list of events, at most once per batch id;
+                       must raise on failure
+        :param flush_interval: max time (seconds) between flushes
+        :param flush_size: number of pending events that triggers a flush
+        :param max_attempts: number of failed writes after which a batch is moved to the dead letter directory
+        '''
+        self.spool_dir = spool_dir
+        self.dead_letter_dir = os.path.join(spool_dir, 'dead')
+        self.writer = writer
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.max_attempts = max_attempts
+        self.attempts = {}  # batch id: failed writes
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.wake_up = threading.Event()
+        self.pid = None
+        self.owner = None
+        self.owner_file = None
+        self.spool_file = None
+        self.pending = 0
+        self.batch_number = 0
+
+    def __spool_path(self, owner: str) -> str:
+        return os.path.join(self.spool_dir, f'{owner}.spool')
+
+    def __batch_path(self, batch_id: str) -> str:
+        ''' Path of a batch of this process; batch ids are unique, e.g. '<owner>-<time ns>-<n>'
+        '''
+        return os.path.join(self.spool_dir, f'{self.owner}.{batch_id}.batch')
+
+    @staticmethod
+    def get_batch_id(path: str) -> str:
+        return os.path.basename(path)[:-len('.batch')].split('.', 1)[1]
+
+    def __start(self) -> None:
+        ''' Open the process' spool and start the flusher thread. Runs on first use in each (forked) process
+        '''
+        os.makedirs(self.spool_dir, exist_ok=True)
+
+        self.pid = os.getpid()
+        # '.' separates the owner from the batch id in file names
+        self.owner = f"{socket.gethostname().replace('.', '_')}-{self.pid}"
+        self.owner_file = open(os.path.join(self.spool_dir, f'{self.owner}.owner'), 'a')
+        fcntl.flock(self.owner_file, fcntl.LOCK_EX)
+        self.spool_file = open(self.__spool_path(self.owner), 'a')
+        self.pending = 0
+
+        threading.Thread(target=self.__run, name='metering-flusher', daemon=True).start()
+        atexit.register(self.flush)
+
+    def enqueue(self, event: dict) -> None:
+        ''' Append a JSON serializable event to the spool
+
+        :param event: the event; e.g. {'user_id': 1, 'model_name': 'model', 'calls': 10, 'call_time': <iso format>}
+        '''
+        with self.lock:
+            if self.pid != os.getpid():
+                self.__start()
+
+            self.spool_file.write(json.dumps(event) + '\n')
+            self.spool_file.flush()
+            self.pending += 1
+
+            if self.pending >= self.flush_size:
+                self.wake_up.set()
+
+    def __rotate(self) -> None:
+        ''' Move the current spool aside as a batch file and start a new spool
+        '''
+        with self.lock:
+            if self.pending == 0:
+                return
+
+            self.spool_file.close()
+            self.batch_number += 1
+            os.replace(self.__spool_path(self.owner),
+                       self.__batch_path(f'{self.owner}-{time.time_ns()}-{self.batch_number}'))
+            self.spool_file = open(self.__spool_path(self.owner), 'a')
+            self.pending = 0
+
+    def __write_batch(self, path: str) -> None:
+        events = []
+        with open(path, 'r') as f:
+            for line in f:
+                try:
+                    events.append(json.loads(line))
+                except ValueError:
+                    # torn write of a crashed process
+                    print(f'[WARN] Metering - skipping malformed event in {path}')
+
+        if len(events) > 0:
+            self.writer(events, MeteringQueue.get_batch_id(path))
+        os.remove(path)
+
+    def __dead_letter(self, path: str) -> None:
+        ''' Move a batch that cannot be written aside; its events are kept for inspection
+        '''
+        os.makedirs(self.dead_letter_dir, exist_ok=True)
+        os.replace(path, os.path.join(self.dead_letter_dir, os.path.basename(path)))
+        print(f'[WARN] Metering - moved {path} to {self.dead_letter_dir} after {self.max_attempts} failed writes')
+
+    def __recover(self) -> None:
+        ''' Take over the spools of dead owners; their events are written with this process' batches
+        '''
+        for owner_path in glob.glob(os.path.join(self.spool_dir, '*.owner')):
+            owner = os.path.basename(owner_path)[:-len('.owner')]
+            if owner == self.owner:
+                continue
+
+            with open(owner_path, 'a') as owner_file:
+                try:
+                    fcntl.flock(owner_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    # owner is alive
+                    continue
+
+                spool_path = self.__spool_path(owner)
+                if os.path.exists(spool_path):
+                    os.replace(spool_path, self.__batch_path(f'{owner}-{time.time_ns()}-0'))
+
+                for batch_path in glob.glob(os.path.join(self.spool_dir, f'{owner}.*.batch')):
+                    os.replace(batch_path, self.__batch_path(MeteringQueue.get_batch_id(batch_path)))
+
+                os.remove(owner_path)
+                print(f'[INFO] Metering - recovered spool of {owner}')
+
+    def flush(self) -> None:
+        ''' Write pending events; failed batches are kept on disk and retried on the next flush. A failure only
+        counts as an attempt if another batch was written by the same flush; i.e. not while the database is down
+        '''
+        if self.pid != os.getpid():
+            return
+
+        with self.flush_lock:
+            try:
+                self.__rotate()
+                self.__recover()
+            except Exception as e:
+                print(f'[EXCEPTION] Metering - failed to rotate spool. Exception: {e}')
+
+            written = 0
+            failed = []
+            for batch_path in sorted(glob.glob(os.path.join(self.spool_dir, f'{self.owner}.*.batch'))):
+                try:
+                    self.__write_batch(batch_path)
+                    self.attempts.pop(MeteringQueue.get_batch_id(batch_path), None)
+                    written += 1
+                except Exception as e:
+                    print(f'[EXCEPTION] Metering - failed to write {batch_path}; retrying on next flush. Exception: {e}')
+                    failed.append(batch_path)
+
+            if written == 0:
+                return
+
+            for batch_path in failed:
+                batch_id = MeteringQueue.get_batch_id(batch_path)
+                self.attempts[batch_id] = self.attempts.get(batch_id, 0) + 1
+                if self.attempts[batch_id] >= self.max_attempts:
+                    try:
+                        self.__dead_letter(batch_path)
+                        self.attempts.pop(batch_id)
+                    except Exception as e:
+                        print(f'[EXCEPTION] Metering - failed to move {batch_path} to dead letters. Exception: {e}')
+
+    def __run(self) -> None:
+        while True:
+            self.wake_up.wait(self.flush_interval)
+            self.wake_up.clear()
+            self.flush()
@@ -0,0 +1,90 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Tuple
+
+
+class MicroBatcher:
+    ''' Coalesce concurrent calls sharing the same key into batches.
+
+    A batch is sent as soon as the key has no batch in flight, thus a lone caller does not wait. Calls that arrive
+    while a batch is in flight are queued and sent together when the batch completes, after max_latency seconds or
+    once max_size items are queued, whichever comes first
+    '''
+
+    def __init__(self,
+                 send: Callable[[Hashable, List[Any]], Awaitable[List[Any]]],
+                 max_size: int,
+                 max_latency: float):
+        ''' Micro batcher
+
+        :param send: async function (key, items) -> results; must return one result per item, in order
+        :param max_size: max size of a batch; e.g. number of rows
+        :param max_latency: max time (seconds) a call is queued before its batch is sent
+        '''
+        self.send = send
+        self.max_size = max_size
+        self.max_latency = max_latency
+        self.queues: Dict[Hashable, List[Tuple[Any, asyncio.Future]]] = {}
+        self.sizes: Dict[Hashable, int] = {}
+        self.timers: Dict[Hashable, asyncio.Handle] = {}
+        self.in_flight: Dict[Hashable, int] = {}
+
+    async def submit(self, key: Hashable, item: Any, size: int = 1) -> Any:
+        ''' Queue an item and wait for its result
+
+        :param key: the batch key; e.g. model and version
+        :param item: the item to send
+        :param size: size of the item; e.g. number of rows
+
+        :return: the result of the item
+        '''
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+
+        self.queues.setdefault(key, []).append((item, future))
+        self.sizes[key] = self.sizes.get(key, 0) + size
+
+        if self.sizes[key] >= self.max_size:
+            self.__flush(key)
+        elif key not in self.timers:
+            # idle key: send on next iteration to coalesce calls of the same tick; otherwise wait for the batch
+            # in flight to complete, at most max_latency
+            delay = 0 if self.in_flight.get(key, 0) == 0 else self.max_latency
+            self.timers[key] = loop.call_later(delay, self.__flush, key)
+
+        # a cancelled caller must not cancel the batch other callers are awaiting
+        return await asyncio.shield(future)
+
+    def __flush(self, key: Hashable) -> None:
+        timer = self.timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+
+        batch = self.queues.pop(key, [])
+        self.sizes.pop(key, None)
+        if len(batch) == 0:
+            return
+
+        self.in_flight[key] = self.in_flight.get(key, 0) + 1
+        asyncio.ensure_future(self.__run(key, batch))
+
+    async def __run(self, key: Hashable, batch: List[Tuple[Any, asyncio.Future]]) -> None:
+        try:
+            results = await self.send(key, [item for item, _ in batch])
+            if len(results) != len(batch):
+                raise ValueError(f'Batch of {len(batch)} items returned {len(results)} results')
+
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+        finally:
+            self.in_flight[key] -= 1
+            if self.in_flight[key] == 0:
+                self.in_flight.pop(key)
+
+            # calls queued while the batch was in flight
+            if key in self.queues:
+                self.__flush(key)
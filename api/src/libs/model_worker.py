@@ -0,0 +1,355 @@
+'''
+Model pool worker
+
+Long-lived process that keeps loaded mlflow.pyfunc models in memory and serves them over HTTP.
+It runs with the python interpreter of a model's conda environment, thus it must only depend on the
+standard library and on the packages every model environment has (mlflow, pandas).
+
+Usage:
+    <conda_env>/bin/python model_worker.py --port <port>
+
+Endpoints:
+    GET  /ping                            - liveness
+    GET  /stats                           - worker RSS and loaded models
+    POST /load/<name>/<version>           - load model version into memory
+    POST /unload/<name>/<version>         - drop model version from memory
+    POST /invocations/<name>/<version>    - predict; body format given by the Content-Type header:
+                                              application/json                    - pandas 'split' orient json
+                                              application/vnd.apache.arrow.stream - Arrow IPC stream; requires
+                                                                                    pyarrow in the model environment
+                                              application/x-npy                   - NumPy .npy array
+                                            optional 'X-Max-Batch-Size' request header; the number of
+                                            input rows is returned in the 'X-Prediction-Rows' header
+'''
+import argparse
+import gc
+import json
+import os
+import socketserver
+import threading
+import traceback
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+MODELS = {}  # '<name>/<version>': (pyfunc model, rss delta in bytes)
+LOCKS = {}  # '<name>/<version>': threading.Lock
+LOCKS_LOCK = threading.Lock()
+
+
+def get_rss() -> int:
+    ''' Get resident set size of the current process in bytes
+    '''
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except Exception:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def get_lock(key: str) -> threading.Lock:
+    with LOCKS_LOCK:
+        if key not in LOCKS:
+            LOCKS[key] = threading.Lock()
+        return LOCKS[key]
+
+
+def load_model(name: str, version: str, base_uri: str = 'models'):
+    ''' Load model version if it is not loaded yet
+
+    :return: (pyfunc model, rss delta in bytes)
+    '''
+    import mlflow.pyfunc
+
+    key = f'{name}/{version}'
+    with get_lock(key):
+        if key not in MODELS:
+            print(f'[INFO] Model worker - loading {key}', flush=True)
+            rss_before = get_rss()
+            model = mlflow.pyfunc.load_model(f'{base_uri}:/{name}/{version}')
+            MODELS[key] = (model, max(get_rss() - rss_before, 0))
+            print(f'[INFO] Model worker - loaded {key}; rss delta: {MODELS[key][1]}', flush=True)
+
+    return MODELS[key]
+
+
+def unload_model(name: str, version: str) -> bool:
+    key = f'{name}/{version}'
+    with get_lock(key):
+        removed = MODELS.pop(key, None) is not None
+    gc.collect()
+
+    return removed
+
+
+CONTENT_TYPE_JSON = 'application/json'
+CONTENT_TYPE_ARROW = 'application/vnd.apache.arrow.stream'
+CONTENT_TYPE_NPY = 'application/x-npy'
+
+
+class BatchTooLarge(Exception):
+    pass
+
+
+class UnsupportedContentType(Exception):
+    pass
+
+
+def parse_arrow(body: bytes):
+    ''' Read an Arrow IPC stream into a DataFrame. Numeric columns without nulls are converted without copies
+    '''
+    try:
+        import pyarrow
+    except ImportError:
+        raise UnsupportedContentType(f"'{CONTENT_TYPE_ARROW}' requires pyarrow in the model's conda environment")
+
+    # pyarrow < 0.12
+    if not hasattr(pyarrow, 'ipc') or not hasattr(pyarrow.ipc, 'open_stream'):
+        raise UnsupportedContentType(f"'{CONTENT_TYPE_ARROW}' requires pyarrow >= 0.12 in the model's conda environment; "
+                                     f"found {pyarrow.__version__}")
+
+    table = pyarrow.ipc.open_stream(pyarrow.py_buffer(body)).read_all()
+
+    try:
+        return table.to_pandas(split_blocks=True, self_destruct=True)
+    except TypeError:
+        # pyarrow < 2.0: no split_blocks/self_destruct; the columns are copied
+        return table.to_pandas()
+
+
+def parse_npy(body: bytes):
+    ''' Read a .npy payload into an ndarray backed by the request body, i.e. without copying the data
+    '''
+    import io
+    import numpy
+    from numpy.lib import format as npy_format
+
+    f = io.BytesIO(body)
+    version = npy_format.read_magic(f)
+    if version == (1, 0):
+        shape, fortran_order, dtype = npy_format.read_array_header_1_0(f)
+    elif version == (2, 0):
+        shape, fortran_order, dtype = npy_format.read_array_header_2_0(f)
+    else:
+        raise ValueError(f'Unsupported .npy format version {version}')
+
+    # object arrays are pickled; never unpickle request bodies
+    if dtype.hasobject:
+        raise ValueError('.npy arrays of objects are not supported')
+
+    count = 1
+    for dim in shape:
+        count *= dim
+    data = numpy.frombuffer(body, dtype=dtype, count=count, offset=f.tell())
+
+    return data.reshape(shape, order='F' if fortran_order else 'C')
+
+
+def conform_to_signature(model, data):
+    ''' Conform binary input to the model's input signature: ndarrays of column-based models are wrapped in a
+    DataFrame named after the signature's columns and DataFrames' columns are put in signature order.
+    Types are enforced by pyfunc's predict
+
+    :param model: pyfunc model
+    :param data: DataFrame or ndarray
+
+    :return: DataFrame or ndarray
+    '''
+    import numpy
+    import pandas
+
+    # mlflow < 1.9 has no signatures; mlflow < 1.14 has no tensor-based signatures
+    get_input_schema = getattr(model.metadata, 'get_input_schema', None)
+    schema = get_input_schema() if get_input_schema is not None else None
+    is_tensor_spec = getattr(schema, 'is_tensor_spec', None)
+    if is_tensor_spec is not None and is_tensor_spec():
+        return data
+
+    columns = schema.column_names() if schema is not None and schema.has_column_names() else None
+
+    if isinstance(data, numpy.ndarray):
+        if data.dtype.names is not None:
+            data = pandas.DataFrame(data)
+        else:
+            if data.ndim == 1:
+                data = data.reshape(-1, 1)
+            if data.ndim != 2:
+                raise ValueError(f'Expected a 2D array for a column-based signature; got {data.ndim} dimensions')
+            if schema is not None and data.shape[1] != len(schema.inputs):
+                raise ValueError(f'Model signature declares {len(schema.inputs)} inputs; got {data.shape[1]} columns')
+            # a homogeneous 2D array is wrapped as a single block, without copying
+            return pandas.DataFrame(data, columns=columns, copy=False)
+
+    if columns is not None:
+        missing = [c for c in columns if c not in data.columns]
+        if len(missing) > 0:
+            raise ValueError(f'Model is missing inputs {missing}')
+        if list(data.columns) != columns:
+            data = data[columns]
+
+    return data
+
+
+def parse_input(model, body: bytes, content_type: str):
+    ''' Parse a request body according to its content type
+
+    :return: DataFrame or ndarray
+    '''
+    content_type = (content_type or CONTENT_TYPE_JSON).split(';')[0].strip().lower()
+
+    if content_type == CONTENT_TYPE_JSON:
+        from mlflow.pyfunc import scoring_server
+        return scoring_server.parse_json_input(body.decode('utf-8'), orient='split')
+    if content_type == CONTENT_TYPE_ARROW:
+        return conform_to_signature(model, parse_arrow(body))
+    if content_type == CONTENT_TYPE_NPY:
+        return conform_to_signature(model, parse_npy(body))
+
+    raise UnsupportedContentType(f"Unsupported content type '{content_type}'")
+
+
+def predict(model, body: bytes, max_batch_size: int = None, content_type: str = CONTENT_TYPE_JSON) -> tuple:
+    ''' Run prediction using mlflow's scoring server output format
+
+    :return: (predictions json, number of input rows)
+    '''
+    from mlflow.pyfunc import scoring_server
+
+    data = parse_input(model, body, content_type)
+    if max_batch_size is not None and len(data) > max_batch_size:
+        raise BatchTooLarge(f'Batch size {len(data)} exceeds max. batch size {max_batch_size}')
+
+    raw_predictions = model.predict(data)
+
+    out = _StringWriter()
+    scoring_server.predictions_to_json(raw_predictions, out)
+
+    return out.getvalue().encode('utf-8'), len(data)
+
+
+class _StringWriter:
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, s: str):
+        self.chunks.append(s)
+
+    def getvalue(self) -> str:
+        return ''.join(self.chunks)
+
+
+class ModelWorkerHandler(BaseHTTPRequestHandler):
+
+    def _send(self, status: int, body, content_type: str = 'application/json', headers: dict = None):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_error(self, status: int, error_code: str, e: Exception):
+        self._send(status, {'error_code': error_code,
+                            'message': str(e),
+                            'stack_trace': traceback.format_exc()})
+
+    def _read_body(self) -> bytes:
+        # streamed requests without Content-Length
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(b';')[0].strip(), 16)
+                if size == 0:
+                    # skip trailers
+                    while self.rfile.readline() not in (b'\r\n', b'\n', b''):
+                        pass
+                    break
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+            return b''.join(chunks)
+
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length > 0 else b''
+
+    def _route(self):
+        parts = [p for p in self.path.split('?')[0].split('/') if p != '']
+        if len(parts) == 3:
+            return parts[0], parts[1], parts[2]
+        return (parts[0] if parts else ''), None, None
+
+    def do_GET(self):
+        action, _, _ = self._route()
+        if action == 'ping':
+            self._send(200, b'\n', 'text/plain')
+        elif action == 'stats':
+            self._send(200, {'rss': get_rss(),
+                             'models': {k: {'rss': v[1]} for k, v in list(MODELS.items())}})
+        else:
+            self._send(404, {'error_code': 'NOT_FOUND', 'message': self.path})
+
+    def do_POST(self):
+        action, name, version = self._route()
+        body = self._read_body()
+
+        if name is None:
+            self._send(404, {'error_code': 'NOT_FOUND', 'message': self.path})
+            return
+
+        if action == 'load':
+            try:
+                _, rss = load_model(name, version)
+                self._send(200, {'key': f'{name}/{version}', 'rss': rss})
+            except Exception as e:
+                self._send_error(500, 'RESOURCE_DOES_NOT_EXIST', e)
+
+        elif action == 'unload':
+            self._send(200, {'key': f'{name}/{version}', 'unloaded': unload_model(name, version)})
+
+        elif action == 'invocations':
+            try:
+                model, _ = load_model(name, version)
+            except Exception as e:
+                self._send_error(500, 'RESOURCE_DOES_NOT_EXIST', e)
+                return
+
+            try:
+                max_batch_size = self.headers.get('X-Max-Batch-Size')
+                predictions, rows = predict(model, body, int(max_batch_size) if max_batch_size else None,
+                                            self.headers.get('Content-Type'))
+                self._send(200, predictions, headers={'X-Prediction-Rows': str(rows)})
+            except BatchTooLarge as e:
+                self._send_error(413, 'BATCH_TOO_LARGE', e)
+            except UnsupportedContentType as e:
+                self._send_error(415, 'UNSUPPORTED_MEDIA_TYPE', e)
+            except Exception as e:
+                self._send_error(400, 'BAD_REQUEST', e)
+
+        else:
+            self._send(404, {'error_code': 'NOT_FOUND', 'message': self.path})
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    ''' One thread per request. http.server.ThreadingHTTPServer requires python 3.7; model environments may pin
+    older versions
+    '''
+    daemon_threads = True
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Shipped Brain model pool worker')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, required=True)
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer((args.host, args.port), ModelWorkerHandler)
+    print(f'[INFO] Model worker - listening on {args.host}:{args.port} (pid {os.getpid()})', flush=True)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,166 @@
+'''
+Cache of per-row predictions of model versions.
+
+Model versions are immutable, thus the prediction of a deterministic model for an input row never changes and
+entries never need invalidating. Rows are keyed by the sha256 of (model, version, columns, row); the most recently
+used predictions are kept in memory, and on disk in a sqlite database shared by the processes of the host. Both
+levels are size bounded and evict least recently used entries first.
+'''
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Tuple
+
+
+class PredictionCache:
+    EVICTION_RATIO: float = 0.9 # disk eviction frees space down to this fraction of max_disk_size
+    EVICTION_INTERVAL: int = 100 # number of writes between disk size checks
+
+    def __init__(self, path: str, max_disk_size: int, max_memory_size: int):
+        ''' Prediction cache
+
+        :param path: path of the sqlite database
+        :param max_disk_size: max size (bytes) of the predictions on disk
+        :param max_memory_size: max size (bytes) of the predictions in memory, per process
+        '''
+        self.path = path
+        self.max_disk_size = max_disk_size
+        self.max_memory_size = max_memory_size
+        self.memory: OrderedDict = OrderedDict()  # key: prediction json
+        self.memory_size = 0
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+
+    @staticmethod
+    def get_key(name: str, version: int, columns: List[str], row: List[Any]) -> str:
+        ''' Key of an input row; rows are canonicalized as compact json of (model, version, columns, row)
+        '''
+        canonical = json.dumps([name, int(version), columns, row], separators=(',', ':'), default=str)
+
+        return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+    def __connect(self) -> sqlite3.Connection:
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=5)
+            connection.execute('pragma journal_mode=wal')
+            connection.execute('create table if not exists predictions('
+                               'key text primary key, value blob not null, size integer not null, last_used real not null)')
+            connection.execute('create index if not exists predictions_last_used_idx on predictions(last_used)')
+            connection.commit()
+            self.local.connection = connection
+
+        return connection
+
+    def __put_memory(self, key: str, value: bytes) -> None:
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            return
+
+        self.memory[key] = value
+        self.memory_size += len(value)
+        while self.memory_size > self.max_memory_size:
+            _, evicted = self.memory.popitem(last=False)
+            self.memory_size -= len(evicted)
+
+    def get_many(self, keys: List[str]) -> Dict[str, bytes]:
+        ''' Get the cached predictions of keys
+
+        :param keys: row keys; see get_key
+
+        :return: dict of key: prediction json, for cached keys only
+        '''
+        found = {}
+        with self.lock:
+            for key in keys:
+                value = self.memory.get(key)
+                if value is not None:
+                    self.memory.move_to_end(key)
+                    found[key] = value
+
+        missing = list({key for key in keys if key not in found})
+        if len(missing) > 0:
+            try:
+                connection = self.__connect()
+                for i in range(0, len(missing), 500):
+                    batch = missing[i:i + 500]
+                    rows = connection.execute(f"select key, value from predictions where key in ({','.join('?' * len(batch))})",
+                                              batch).fetchall()
+                    for key, value in rows:
+                        found[key] = bytes(value)
+                    if len(rows) > 0:
+                        connection.executemany('update predictions set last_used = ? where key = ?',
+                                               [(time.time(), key) for key, _ in rows])
+                connection.commit()
+            except sqlite3.Error as e:
+                print(f'[WARN] PredictionCache - disk lookup failed: {e}')
+
+            with self.lock:
+                for key in missing:
+                    if key in found:
+                        self.__put_memory(key, found[key])
+
+        hits = sum(1 for key in keys if key in found)
+        self.hits += hits
+        self.misses += len(keys) - hits
+
+        return found
+
+    def put_many(self, items: List[Tuple[str, bytes]]) -> None:
+        ''' Cache predictions
+
+        :param items: list of (key, prediction json)
+        '''
+        with self.lock:
+            for key, value in items:
+                self.__put_memory(key, value)
+
+        try:
+            connection = self.__connect()
+            now = time.time()
+            connection.executemany('insert or replace into predictions(key, value, size, last_used) values (?, ?, ?, ?)',
+                                   [(key, value, len(key) + len(value), now) for key, value in items])
+            connection.commit()
+
+            self.writes += 1
+            if self.writes % PredictionCache.EVICTION_INTERVAL == 0:
+                self.__evict_disk(connection)
+        except sqlite3.Error as e:
+            print(f'[WARN] PredictionCache - disk write failed: {e}')
+
+    def __evict_disk(self, connection: sqlite3.Connection) -> None:
+        ''' Remove least recently used predictions until the disk cache fits max_disk_size
+        '''
+        disk_size = connection.execute('select coalesce(sum(size), 0) from predictions').fetchone()[0]
+        if disk_size <= self.max_disk_size:
+            return
+
+        excess = disk_size - int(self.max_disk_size * PredictionCache.EVICTION_RATIO)
+        while excess > 0:
+            rows = connection.execute('select key, size from predictions order by last_used limit 1000').fetchall()
+            if len(rows) == 0:
+                break
+            evicted = []
+            for key, size in rows:
+                if excess <= 0:
+                    break
+                evicted.append((key,))
+                excess -= size
+            connection.executemany('delete from predictions where key = ?', evicted)
+            connection.commit()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups > 0 else 0.0,
+                'memory_entries': len(self.memory),
+                'memory_size': self.memory_size}
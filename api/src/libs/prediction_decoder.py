@@ -0,0 +1,130 @@
+'''
+Decoder of mlflow scoring server responses.
+
+Formats (https://www.mlflow.org/docs/latest/models.html#deploy-mlflow-models):
+    - JSON array of predictions: [0.1, 0.2] or [[0.1, 0.9], [0.8, 0.2]]
+    - pandas 'records' orient DataFrame: [{"a": 1, "b": 2}, ...]
+    - pandas 'split' orient DataFrame: {"columns": [...], "index": [...], "data": [[...], ...]}
+    - error envelope: {"error_code": "BAD_REQUEST", "message": "...", "stack_trace": "..."}
+
+orjson is used when installed; it is several times faster than the standard json module on large outputs.
+'''
+import json
+from typing import Any, List, Optional, Union
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def loads(body: Union[bytes, str]) -> Any:
+    ''' Parse JSON with the fastest available backend
+    '''
+    if orjson is not None:
+        return orjson.loads(body)
+
+    return json.loads(body)
+
+
+class DecodedPredictions:
+    ARRAY: str = 'array'
+    RECORDS: str = 'records'
+    SPLIT: str = 'split'
+    ERROR: str = 'error'
+
+    def __init__(self,
+                 kind: str,
+                 predictions: Any = None,
+                 error_code: Optional[str] = None,
+                 message: Optional[str] = None):
+        self.kind = kind
+        self.predictions = predictions
+        self.error_code = error_code # mlflow error code; e.g. BAD_REQUEST
+        self.message = message
+
+    def is_error(self) -> bool:
+        return self.kind == DecodedPredictions.ERROR
+
+    def __len__(self) -> int:
+        if self.kind == DecodedPredictions.SPLIT:
+            return len(self.predictions['data'])
+        if self.is_error():
+            return 0
+
+        return len(self.predictions)
+
+
+def decode(body: Union[bytes, str]) -> DecodedPredictions:
+    ''' Decode a scoring server response
+
+    :param body: the response body
+
+    :return: DecodedPredictions; raises ValueError if body is not a scoring server response
+    '''
+    try:
+        value = loads(body)
+    except Exception as e:
+        raise ValueError(f'Prediction response is not valid JSON: {e}')
+
+    if isinstance(value, dict):
+        if 'error_code' in value or 'error_message' in value:
+            return DecodedPredictions(DecodedPredictions.ERROR,
+                                      error_code=value.get('error_code'),
+                                      message=value.get('message', value.get('error_message')))
+        if 'data' in value:
+            return DecodedPredictions(DecodedPredictions.SPLIT, predictions=value)
+
+        raise ValueError(f'Unknown prediction response object with keys {list(value.keys())}')
+
+    if isinstance(value, list):
+        if len(value) > 0 and isinstance(value[0], dict):
+            return DecodedPredictions(DecodedPredictions.RECORDS, predictions=value)
+
+        return DecodedPredictions(DecodedPredictions.ARRAY, predictions=value)
+
+    raise ValueError(f'Unknown prediction response of type {type(value).__name__}')
+
+
+def get_error(body: Union[bytes, str]) -> Optional[DecodedPredictions]:
+    ''' Check if a scoring server response is an error without decoding successful predictions.
+    Only JSON objects are parsed: predictions arrays, usually the largest responses, are never errors
+
+    :param body: the response body
+
+    :return: the decoded error; None if body is not an error
+    '''
+    start = body[:64].lstrip()[:1]
+    if start not in (b'{', '{'):
+        return None
+
+    decoded = decode(body)
+
+    return decoded if decoded.is_error() else None
+
+
+def split(decoded: DecodedPredictions, sizes: List[int]) -> List[bytes]:
+    ''' Split the predictions of a batch back into the responses of the requests it was made of.
+    Responses are serialized like the scoring server does, thus they match unbatched responses
+
+    :param decoded: decoded predictions of the batch
+    :param sizes: number of input rows of each request, in batch order
+
+    :return: list of response bodies; raises ValueError if the number of predictions does not match
+    '''
+    if decoded.is_error() or len(decoded) != sum(sizes):
+        raise ValueError(f'Expected {sum(sizes)} predictions; got {len(decoded)}')
+
+    responses = []
+    start = 0
+    for size in sizes:
+        if decoded.kind == DecodedPredictions.SPLIT:
+            value = {'columns': decoded.predictions['columns'],
+                     'index': list(range(size)),
+                     'data': decoded.predictions['data'][start:start + size]}
+        else:
+            value = decoded.predictions[start:start + size]
+        responses.append(json.dumps(value).encode('utf-8'))
+        start += size
+
+    return responses
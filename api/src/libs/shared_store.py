@@ -0,0 +1,81 @@
+'''
+JSON document shared by all processes of a host, e.g. gunicorn workers.
+
+Reads take a shared file lock; read-modify-write transactions take an exclusive file lock, so claims made
+inside a transaction are atomic across processes. No external service is required.
+'''
+import copy
+import fcntl
+import json
+import os
+import tempfile
+from contextlib import contextmanager
+
+
+class SharedStore:
+
+    def __init__(self, path: str, default: dict):
+        ''' Shared store backed by a JSON file
+
+        :param path: path of the JSON file; a '<path>.lock' file is created next to it
+        :param default: document used when the file does not exist or is corrupted
+        '''
+        self.path = path
+        self.lock_path = f'{path}.lock'
+        self.default = default
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    @contextmanager
+    def __lock(self, operation: int):
+        with open(self.lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, operation)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def __load(self) -> dict:
+        try:
+            with open(self.path, 'r') as f:
+                state = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return copy.deepcopy(self.default)
+
+        # add keys introduced after the file was created
+        for k in self.default:
+            if k not in state:
+                state[k] = copy.deepcopy(self.default[k])
+
+        return state
+
+    def __dump(self, state: dict) -> None:
+        # write to a temp. file and rename: readers never see a partial document
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(state, f)
+            os.replace(tmp_path, self.path)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+
+    def read(self) -> dict:
+        ''' Read a snapshot of the document
+        '''
+        with self.__lock(fcntl.LOCK_SH):
+            return self.__load()
+
+    @contextmanager
+    def transaction(self):
+        ''' Read-modify-write the document under an exclusive lock.
+        Changes made to the yielded dict are persisted unless an exception is raised
+
+        Example:
+            with store.transaction() as state:
+                state['counter'] += 1
+        '''
+        with self.__lock(fcntl.LOCK_EX):
+            state = self.__load()
+            yield state
+            self.__dump(state)
@@ -0,0 +1,43 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable
+
+
+class SingleFlight:
+    ''' Coalesce concurrent calls sharing the same key into a single execution.
+    The first caller runs the coroutine; every other caller awaits its result
+    '''
+
+    def __init__(self):
+        self.calls: Dict[Hashable, asyncio.Future] = {}
+
+    def in_flight(self, key: Hashable) -> bool:
+        ''' Check if a call with key is running
+
+        :param key: the call key
+
+        :return: True if running; False otherwise
+        '''
+        return key in self.calls
+
+    async def do(self, key: Hashable, coroutine_function: Callable[..., Awaitable[Any]], *args, **kwargs) -> Any:
+        ''' Run coroutine_function(*args, **kwargs) unless a call with the same key is running
+
+        :param key: the call key
+        :param coroutine_function: async function to run
+
+        :return: the result of the single execution
+        '''
+        task = self.calls.get(key)
+
+        if task is None:
+            task = asyncio.ensure_future(coroutine_function(*args, **kwargs))
+            self.calls[key] = task
+
+            def forget(done_task):
+                if self.calls.get(key) is done_task:
+                    self.calls.pop(key)
+
+            task.add_done_callback(forget)
+
+        # a cancelled caller must not cancel the call other callers are awaiting
+        return await asyncio.shield(task)
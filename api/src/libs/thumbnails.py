@@ -0,0 +1,138 @@
+'''
+Thumbnails of uploaded images, served as static files.
+
+Thumbnails are resized once, on upload, and stored as <dir>/<quoted key>.<jpg|png>. Their URLs carry the thumbnail's
+modification time, thus clients and proxies may cache them for long periods and a new upload changes the URL.
+Each process keeps an index of key: URL; the index is rebuilt when the directory changes, i.e. a single stat per
+lookup, so uploads handled by other processes are seen at once.
+'''
+import os
+import threading
+import uuid
+from typing import Dict, List, Optional
+from urllib.parse import quote, unquote
+
+from PIL import Image, ImageOps
+from starlette.staticfiles import StaticFiles
+
+THUMBNAIL_EXTENSIONS = ('.jpg', '.png')
+
+
+class ThumbnailStore:
+
+    def __init__(self, directory: str, url_path: str, size: int):
+        ''' Thumbnail store
+
+        :param directory: directory of the thumbnails
+        :param url_path: URL of the directory
+        :param size: max width and height (px) of the thumbnails
+        '''
+        self.directory = directory
+        self.url_path = url_path.rstrip('/')
+        self.size = size
+        self.index: Dict[str, str] = {}
+        self.index_mtime: Optional[int] = None
+        self.lock = threading.Lock()
+
+    def __get_path(self, key: str, extension: str) -> str:
+        return os.path.join(self.directory, quote(key, safe='') + extension)
+
+    def create(self, source_path: str, key: str) -> str:
+        ''' Resize an image into the thumbnail of key; replaces the previous thumbnail
+
+        :param source_path: path of the original image
+        :param key: thumbnail key; e.g. username
+
+        :return: the thumbnail's URL
+        '''
+        os.makedirs(self.directory, exist_ok=True)
+
+        with Image.open(source_path) as image:
+            # First frame of animated images; orientation from EXIF
+            image.seek(0)
+            thumbnail = ImageOps.exif_transpose(image)
+            thumbnail.thumbnail((self.size, self.size), Image.LANCZOS)
+
+            has_alpha = thumbnail.mode in ('RGBA', 'LA') or (thumbnail.mode == 'P' and 'transparency' in thumbnail.info)
+            if has_alpha:
+                extension, image_format, options = '.png', 'PNG', {'optimize': True}
+                thumbnail = thumbnail.convert('RGBA')
+            else:
+                extension, image_format, options = '.jpg', 'JPEG', {'quality': 85, 'optimize': True, 'progressive': True}
+                thumbnail = thumbnail.convert('RGB')
+
+            path = self.__get_path(key, extension)
+            temp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+            thumbnail.save(temp_path, image_format, **options)
+
+        os.replace(temp_path, path)
+        for other_extension in THUMBNAIL_EXTENSIONS:
+            if other_extension != extension and os.path.exists(self.__get_path(key, other_extension)):
+                os.remove(self.__get_path(key, other_extension))
+
+        return self.get_url(key)
+
+    def has(self, key: str) -> bool:
+        return any(os.path.exists(self.__get_path(key, extension)) for extension in THUMBNAIL_EXTENSIONS)
+
+    def __refresh_index(self) -> None:
+        try:
+            mtime = os.stat(self.directory).st_mtime_ns
+        except FileNotFoundError:
+            self.index, self.index_mtime = {}, None
+            return
+
+        if mtime == self.index_mtime:
+            return
+
+        index = {}
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                name, extension = os.path.splitext(entry.name)
+                if extension not in THUMBNAIL_EXTENSIONS:
+                    continue
+                index[unquote(name)] = f'{self.url_path}/{quote(entry.name)}?v={entry.stat().st_mtime_ns // 1000000}'
+
+        self.index, self.index_mtime = index, mtime
+
+    def get_url(self, key: str) -> Optional[str]:
+        ''' Get the URL of the thumbnail of key
+
+        :param key: thumbnail key
+
+        :return: the URL; None if key has no thumbnail
+        '''
+        return self.get_urls([key]).get(key)
+
+    def get_urls(self, keys: List[str]) -> Dict[str, str]:
+        ''' Get the URLs of the thumbnails of keys
+
+        :param keys: thumbnail keys
+
+        :return: dict of key: URL, for keys with thumbnails only
+        '''
+        with self.lock:
+            self.__refresh_index()
+            index = self.index
+
+        return {key: index[key] for key in keys if key in index}
+
+    def delete(self, key: str) -> None:
+        for extension in THUMBNAIL_EXTENSIONS:
+            if os.path.exists(self.__get_path(key, extension)):
+                os.remove(self.__get_path(key, extension))
+
+
+class CachedStaticFiles(StaticFiles):
+    ''' Static files with a Cache-Control header; ETag and Last-Modified validation is done by StaticFiles
+    '''
+
+    def __init__(self, *args, max_age: int = 3600, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.max_age = max_age
+
+    def file_response(self, *args, **kwargs):
+        response = super().file_response(*args, **kwargs)
+        response.headers['Cache-Control'] = f'public, max-age={self.max_age}'
+
+        return response
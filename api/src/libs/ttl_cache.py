@@ -0,0 +1,51 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+
+class TTLCache:
+    ''' In-memory cache whose entries expire ttl seconds after being set; size bounded, evicts least recently set
+    entries first. Entries are per process, thus writes in other processes are only seen after expiry
+    '''
+
+    def __init__(self, ttl: float, max_size: int):
+        ''' TTL cache
+
+        :param ttl: lifetime (seconds) of an entry
+        :param max_size: max number of entries
+        '''
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries: OrderedDict = OrderedDict()  # key: (value, expires_at)
+        self.lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        ''' Get the value of key
+
+        :param key: the entry key
+
+        :return: the value; None if key is not cached or expired
+        '''
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+
+            value, expires_at = entry
+            if time.monotonic() >= expires_at:
+                self.entries.pop(key)
+                return None
+
+            return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (value, time.monotonic() + self.ttl)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, key: Hashable) -> None:
+        with self.lock:
+            self.entries.pop(key, None)
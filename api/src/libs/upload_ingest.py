@@ -0,0 +1,194 @@
+'''
+Streaming ingest of uploaded files.
+
+The multipart request body is parsed as it arrives, rather than spooled whole by the framework: the file part is
+written to disk chunk by chunk, hashed and size capped on the fly, thus oversized uploads are rejected after
+reading at most max_size bytes. Zip files are then validated from their central directory, without extracting.
+'''
+import asyncio
+import hashlib
+import os
+import posixpath
+import zipfile
+from typing import BinaryIO, List, Optional
+
+from multipart.multipart import MultipartParser, parse_options_header
+from starlette.requests import Request
+
+from models.result import Result
+
+# Slack for the multipart envelope and form fields when checking Content-Length
+MULTIPART_OVERHEAD: int = 64 * 1024
+
+
+class IngestError(Exception):
+    ''' Upload rejected; reason is a Result error, e.g. Result.NOT_ACCEPTABLE
+    '''
+
+    def __init__(self, message: str, reason: str = Result.BAD_REQUEST):
+        super().__init__(message)
+        self.message = message
+        self.reason = reason
+
+
+class IngestedFile:
+
+    def __init__(self, path: str, filename: str, content_type: str, size: int, sha256: str):
+        self.path = path
+        self.filename = filename
+        self.content_type = content_type
+        self.size = size
+        self.sha256 = sha256
+
+
+class _FilePartWriter:
+    ''' multipart.MultipartParser callbacks; buffers the data of the file part for the next write
+    '''
+
+    def __init__(self, field_name: str, content_types: Optional[List[str]], max_size: int):
+        self.field_name = field_name
+        self.content_types = content_types
+        self.max_size = max_size
+        self.header_field = b''
+        self.header_value = b''
+        self.headers = {}
+        self.in_file_part = False
+        self.found = False
+        self.filename = None
+        self.content_type = None
+        self.pending = bytearray()
+        self.size = 0
+        self.hash = hashlib.sha256()
+
+    def on_part_begin(self) -> None:
+        self.headers = {}
+
+    def on_header_field(self, data: bytes, start: int, end: int) -> None:
+        self.header_field += data[start:end]
+
+    def on_header_value(self, data: bytes, start: int, end: int) -> None:
+        self.header_value += data[start:end]
+
+    def on_header_end(self) -> None:
+        self.headers[self.header_field.lower()] = self.header_value
+        self.header_field = b''
+        self.header_value = b''
+
+    def on_headers_finished(self) -> None:
+        _, options = parse_options_header(self.headers.get(b'content-disposition', b''))
+        self.in_file_part = options.get(b'name', b'').decode('latin-1') == self.field_name and not self.found
+        if not self.in_file_part:
+            return
+
+        self.found = True
+        self.filename = os.path.basename(options.get(b'filename', b'').decode('utf-8', 'replace')) or 'upload.zip'
+        self.content_type = self.headers.get(b'content-type', b'application/octet-stream').decode('latin-1')
+        if self.content_types is not None and self.content_type not in self.content_types:
+            raise IngestError('Invalid extension for file upload', Result.NOT_ACCEPTABLE)
+
+    def on_part_data(self, data: bytes, start: int, end: int) -> None:
+        if not self.in_file_part:
+            return
+
+        chunk = data[start:end]
+        self.size += len(chunk)
+        if self.size > self.max_size:
+            raise IngestError(f'File is too big! Max. size is {self.max_size // (1024 * 1024)} MB', Result.NOT_ACCEPTABLE)
+
+        self.hash.update(chunk)
+        self.pending += chunk
+
+    def on_part_end(self) -> None:
+        self.in_file_part = False
+
+    def callbacks(self) -> dict:
+        return {name: getattr(self, name) for name in ('on_part_begin', 'on_header_field', 'on_header_value',
+                                                       'on_header_end', 'on_headers_finished', 'on_part_data',
+                                                       'on_part_end')}
+
+
+async def ingest_multipart_file(request: Request,
+                                field_name: str,
+                                target_dir: str,
+                                max_size: int,
+                                content_types: Optional[List[str]] = None) -> IngestedFile:
+    ''' Stream the file of a multipart/form-data request to disk, computing its sha256 and enforcing max_size while
+    reading. Other form fields are ignored
+
+    :param request: the request
+    :param field_name: name of the file's form field
+    :param target_dir: directory to write the file to
+    :param max_size: max size (bytes) of the file
+    :param content_types: (optional) accepted content types of the file
+
+    :return: the ingested file
+
+    :raises IngestError: if the file is missing, too big or of a bad content type
+    '''
+    content_type, params = parse_options_header(request.headers.get('Content-Type', ''))
+    if content_type != b'multipart/form-data' or b'boundary' not in params:
+        raise IngestError('Expected a multipart/form-data request', Result.NOT_ACCEPTABLE)
+
+    if int(request.headers.get('Content-Length') or 0) > max_size + MULTIPART_OVERHEAD:
+        raise IngestError(f'File is too big! Max. size is {max_size // (1024 * 1024)} MB', Result.NOT_ACCEPTABLE)
+
+    writer = _FilePartWriter(field_name, content_types, max_size)
+    parser = MultipartParser(params[b'boundary'], writer.callbacks())
+    loop = asyncio.get_event_loop()
+
+    path = None
+    target: Optional[BinaryIO] = None
+    try:
+        async for chunk in request.stream():
+            parser.write(chunk)
+
+            if len(writer.pending) > 0:
+                if target is None:
+                    path = os.path.join(target_dir, writer.filename)
+                    target = open(path, 'wb')
+                data, writer.pending = bytes(writer.pending), bytearray()
+                await loop.run_in_executor(None, target.write, data)
+
+        parser.finalize()
+    finally:
+        if target is not None:
+            target.close()
+
+    if not writer.found or path is None:
+        raise IngestError(f"Missing file field '{field_name}'")
+
+    return IngestedFile(path, writer.filename, writer.content_type, writer.size, writer.hash.hexdigest())
+
+
+def validate_zip(path: str, max_files: int, max_uncompressed_size: int, required_files: List[str]) -> None:
+    ''' Validate a zip file from its central directory; nothing is extracted
+
+    :param path: path of the zip file
+    :param max_files: max number of entries
+    :param max_uncompressed_size: max total uncompressed size (bytes) of the entries
+    :param required_files: files that must exist, at the root of the zip or of its single top level directory
+
+    :raises IngestError: if the zip file is invalid
+    '''
+    try:
+        with zipfile.ZipFile(path) as zip_file:
+            infos = zip_file.infolist()
+    except (zipfile.BadZipFile, zipfile.LargeZipFile, OSError) as e:
+        raise IngestError(f'Invalid zip file: {e}')
+
+    if len(infos) > max_files:
+        raise IngestError(f'Zip file has too many files! Max. number of files is {max_files}')
+
+    if sum(info.file_size for info in infos) > max_uncompressed_size:
+        raise IngestError(f'Zip file is too big uncompressed! Max. size is {max_uncompressed_size // (1024 * 1024)} MB')
+
+    names = set()
+    for info in infos:
+        name = info.filename.replace('\\', '/')
+        if name.startswith('/') or '..' in name.split('/') or ':' in name.split('/')[0]:
+            raise IngestError(f"Invalid path in zip file: '{info.filename}'")
+        names.add(posixpath.normpath(name))
+
+    for required_file in required_files:
+        if not any(name == required_file or name.split('/')[1:] == [required_file] for name in names):
+            raise IngestError(f"Zip file does not contain '{required_file}'")
@@ -63,4 +63,21 @@ def get_mime_type(file_extension: str) -> str:
     if file_extension == 'png': return f'image/png'
     if file_extension == 'gif': return f'image/gif'
 
-    return 'text/html'
\ No newline at end of file
+    return 'text/html'
+
+
+def get_dir_size(dir: str) -> int:
+    '''Returns the total size of the files in directory, recursively
+
+    :param dir: directory to search files in
+
+    :return: Size in bytes
+    '''
+    size = 0
+    for root, _, files in os.walk(dir):
+        for file in files:
+            path = os.path.join(root, file)
+            if not os.path.islink(path):
+                size += os.path.getsize(path)
+
+    return size
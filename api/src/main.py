@@ -1,12 +1,40 @@
+import os
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from routers import users, ml_models, auth, hashtags, model_requests, model_uploads, model_likes, papers_with_code, model_comments, health_checks
+from middleware.db_session import DBSessionMiddleware
+import db.async_db as async_db
+from config.config import IMAGE_CONFIG, METERING_CONFIG
+from fastapi_utils.tasks import repeat_every
+from libs.thumbnails import CachedStaticFiles
+from services.user_photo_service import UserPhotoService
+from services.model_cover_upload_service import ModelCoverUploadService
+from services.api_call_service import ApiCallService
+from routers import users, ml_models, auth, hashtags, model_requests, model_uploads, model_likes, papers_with_code, model_comments, health_checks, batch_jobs
 
 app = FastAPI(
     title='Shipped Brain API',
     version='0.1'
 )
 
+app.add_middleware(DBSessionMiddleware)
+
+# Async database pool
+app.add_event_handler('startup', async_db.connect)
+app.add_event_handler('shutdown', async_db.disconnect)
+
+
+@app.on_event('startup')
+async def create_missing_thumbnails():
+    await async_db.run_blocking(UserPhotoService.create_missing_thumbnails)
+    await async_db.run_blocking(ModelCoverUploadService.create_missing_thumbnails)
+
+
+@app.on_event('startup')
+@repeat_every(seconds=METERING_CONFIG['retention_interval'])
+async def delete_expired_usage() -> None:
+    await async_db.run_blocking(ApiCallService.delete_expired_usage)
+
+
 # CORS setup
 origins = [
     'http://localhost:4200',
@@ -18,7 +46,8 @@ app.add_middleware(
     allow_origins=origins,
     allow_credentials=True,
     allow_methods=['GET', 'POST', 'PUT', 'DELETE'],
-    allow_headers=['*']
+    allow_headers=['*'],
+    expose_headers=['X-Next-Cursor']
 )
 
 # Included routers
@@ -30,5 +59,11 @@ app.include_router(model_requests.router, tags=['model-requests'], prefix='/api/
 app.include_router(model_uploads.router, tags=['model-uploads'], prefix='/api/v0')
 app.include_router(model_likes.router, tags=['model-likes'], prefix='/api/v0')
 app.include_router(model_comments.router, tags=['model-comments'], prefix='/api/v0')
+app.include_router(batch_jobs.router, tags=['batch-jobs'], prefix='/api/v0')
 #app.include_router(papers_with_code.router, tags=['papers-with-code'], prefix='/api/v0')
 app.include_router(health_checks.router, tags=['health-checks'], prefix='/api/v0/health')
+
+# User photo and model cover thumbnails
+os.makedirs(IMAGE_CONFIG['thumbnails_dir'], exist_ok=True)
+app.mount('/api/v0/static', CachedStaticFiles(directory=IMAGE_CONFIG['thumbnails_dir'], max_age=IMAGE_CONFIG['max_age']),
+          name='static')
@@ -1,4 +1,4 @@
-from services.api_call_service import ApiCallService
+import asyncio
 from models.result import Result
 from fastapi import status, Depends, HTTPException
 from fastapi.security import OAuth2PasswordBearer
@@ -8,6 +8,7 @@ from datetime import datetime, timedelta
 from dotenv import load_dotenv
 import schemas.token as TokenSchema
 from services.user_service import UserService
+from db.async_db import run_blocking
 import os
 
 load_dotenv()
@@ -50,21 +51,25 @@ async def get_current_user(token: str = Depends(oauth2_scheme)) -> Result:
     except JWTError:
         raise credentials_exception
 
-    user = UserService.get_user_by_username(username=token_data.username)
+    # Counters are not loaded; see get_user_counters
+    user = await UserService.get_principal_async(username=token_data.username)
 
-    if user.data is None:
+    if user.is_fail() or user.data is None:
         raise credentials_exception
 
-    # Get nr of user's models
-    models_count = UserService.count_user_models(username=user.data.username)
-    user.data.models_count = None if models_count.is_fail() else models_count.data
-
-    # Get nr of user's model versions
-    model_versions_count = UserService.count_user_model_versions(username=user.data.username)
-    user.data.model_versions_count = None if model_versions_count.is_fail() else model_versions_count.data
+    return user
 
-    # Get nr of used api calls
-    api_calls_count = ApiCallService.get_user_calls_count(user_id=user.data.id)
-    user.data.api_calls_count = None if api_calls_count.is_fail() else api_calls_count.data
 
-    return user
+async def get_user_counters(user) -> dict:
+    '''
+        Gets nr of user's models and model versions; loaded only by endpoints that return them since counting
+        models lists all of the user's registered models in mlflow
+    '''
+    models_count, model_versions_count = await asyncio.gather(
+        run_blocking(UserService.count_user_models, username=user.username),
+        UserService.count_user_model_versions_async(username=user.username))
+
+    return {
+        'models_count': None if models_count.is_fail() else models_count.data,
+        'model_versions_count': None if model_versions_count.is_fail() else model_versions_count.data
+    }
@@ -0,0 +1,22 @@
+from starlette.types import ASGIApp, Receive, Scope, Send
+from db.db_config import begin_session_scope, end_session_scope
+
+
+class DBSessionMiddleware:
+    ''' Give each request its own database session scope; sessions are closed, and their connections returned to the
+    pool, once the response is sent
+    '''
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        token = begin_session_scope()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            end_session_scope(token)
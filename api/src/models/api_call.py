@@ -14,10 +14,12 @@ class ApiCall(Base):
     user_id = Column(Integer, ForeignKey(User.id), nullable=False)
     model_name = Column(String(256), ForeignKey(RegisteredModel.name), nullable=False)
     call_time = Column(DateTime(), default=datetime.now())
+    calls = Column(Integer, nullable=False, default=1) # number of predictions; a batch prediction is metered as one row
 
     def to_dict(self):
         
         return {'id': self.id,
                 'user_id': self.user_id,
                 'model_name': self.model_name,
-                'call_time': self.call_time}
\ No newline at end of file
+                'call_time': self.call_time,
+                'calls': self.calls}
\ No newline at end of file
@@ -0,0 +1,11 @@
+'''
+Metering batch written to api_calls; makes the writes of the metering flusher idempotent
+'''
+from sqlalchemy import Column, String, DateTime
+from db.db_config import Base
+
+class ApiCallBatch(Base):
+    __tablename__ = 'api_call_batches'
+
+    id = Column(String(256), primary_key=True)
+    written_at = Column(DateTime(), nullable=False)
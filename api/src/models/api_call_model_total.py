@@ -0,0 +1,18 @@
+'''
+Total api calls of a model; used to rank models by popularity
+'''
+from sqlalchemy import Column, String, ForeignKey, DateTime, BIGINT
+from db.db_config import Base
+from models.registered_model import RegisteredModel
+
+class ApiCallModelTotal(Base):
+    __tablename__ = 'api_call_model_totals'
+
+    model_name = Column(String(256), ForeignKey(RegisteredModel.name), primary_key=True)
+    calls = Column(BIGINT, nullable=False, default=0)
+    last_call_time = Column(DateTime())
+
+    def to_dict(self):
+        return {'model_name': self.model_name,
+                'calls': self.calls,
+                'last_call_time': self.last_call_time}
@@ -0,0 +1,38 @@
+'''
+Pre-aggregated api calls of a user to a model in a time bucket
+'''
+from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, BIGINT
+from db.db_config import Base
+from models.user import User
+from models.registered_model import RegisteredModel
+
+class ApiCallRollup(Base):
+    __tablename__ = 'api_call_rollups'
+
+    MINUTE: str = 'minute'
+    HOUR: str = 'hour'
+    DAY: str = 'day'
+    _all_granularities = [MINUTE, HOUR, DAY]
+
+    granularity = Column(String(8), primary_key=True)
+    bucket = Column(DateTime(), primary_key=True) # start of the bucket
+    model_name = Column(String(256), ForeignKey(RegisteredModel.name), primary_key=True)
+    user_id = Column(Integer, ForeignKey(User.id), primary_key=True)
+    calls = Column(BIGINT, nullable=False, default=0)
+
+    @staticmethod
+    def truncate(call_time, granularity: str):
+        '''Get the start of the bucket of call_time'''
+        if granularity == ApiCallRollup.MINUTE:
+            return call_time.replace(second=0, microsecond=0)
+        if granularity == ApiCallRollup.HOUR:
+            return call_time.replace(minute=0, second=0, microsecond=0)
+
+        return call_time.replace(hour=0, minute=0, second=0, microsecond=0)
+
+    def to_dict(self):
+        return {'granularity': self.granularity,
+                'bucket': self.bucket,
+                'model_name': self.model_name,
+                'user_id': self.user_id,
+                'calls': self.calls}
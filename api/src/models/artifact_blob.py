@@ -0,0 +1,14 @@
+'''
+Content-addressed artifact: the first stored copy of an artifact file, by sha256
+'''
+from sqlalchemy import Column, String, DateTime, Text, BIGINT
+from db.db_config import Base
+from datetime import datetime
+
+class ArtifactBlob(Base):
+    __tablename__ = 'artifact_blobs'
+
+    sha256 = Column(String(64), primary_key=True)
+    size = Column(BIGINT, nullable=False)
+    uri = Column(Text, nullable=False) # e.g. s3://<bucket>/<run artifacts path>/<file>
+    created_at = Column(DateTime, default=datetime.now, nullable=False)
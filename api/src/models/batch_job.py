@@ -0,0 +1,71 @@
+'''
+Batch scoring job: a CSV or Parquet file scored in chunks by the prediction server
+'''
+from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, Text, BIGINT
+from db.db_config import Base
+from datetime import datetime
+from models.user import User
+
+class BatchJob(Base):
+    __tablename__ = 'batch_jobs'
+
+    QUEUED: str = 'queued'
+    RUNNING: str = 'running'
+    FINISHED: str = 'finished'
+    FAILED: str = 'failed'
+    _all_status = [QUEUED, RUNNING, FINISHED, FAILED]
+
+    CSV: str = 'csv'
+    PARQUET: str = 'parquet'
+    _all_formats = [CSV, PARQUET]
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey(User.id, ondelete='CASCADE'), nullable=False)
+    model_name = Column(String(256), nullable=False)
+    model_version = Column(Integer, nullable=False)
+    status = Column(String(12), default=QUEUED, nullable=False)
+    input_format = Column(String(12), nullable=False)
+    input_path = Column(Text, nullable=False)
+    output_path = Column(Text, nullable=True)
+    total_rows = Column(BIGINT, nullable=True) # known once the job starts
+    processed_rows = Column(BIGINT, default=0, nullable=False)
+    error = Column(Text, nullable=True)
+    created_at = Column(DateTime, default=datetime.now, nullable=False)
+    started_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
+    attempts = Column(Integer, default=0, nullable=False)
+    heartbeat_at = Column(DateTime, nullable=True) # last sign of life of the process running the job
+
+    @staticmethod
+    def is_valid_status(status: str) -> bool:
+        '''Validate status'''
+
+        return status in BatchJob._all_status
+
+    def get_progress(self) -> float:
+        ''' Fraction of the rows scored; 0 if the number of rows is not known yet
+        '''
+        if self.status == BatchJob.FINISHED:
+            return 1.0
+        if not self.total_rows:
+            return 0.0
+
+        return min(self.processed_rows / self.total_rows, 1.0)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'user_id': self.user_id,
+            'model_name': self.model_name,
+            'model_version': self.model_version,
+            'status': self.status,
+            'input_format': self.input_format,
+            'total_rows': self.total_rows,
+            'processed_rows': self.processed_rows,
+            'progress': self.get_progress(),
+            'error': self.error,
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+            'attempts': self.attempts
+        }
@@ -0,0 +1,54 @@
+'''
+Model version being served by a model pool worker
+'''
+from datetime import datetime
+from typing import Optional
+
+
+class LiveModel:
+    STARTING: str = 'starting'
+    READY: str = 'ready'
+
+    def __init__(self,
+                 port: Optional[int],
+                 pid: Optional[int],
+                 last_used: datetime,
+                 memory: int = 0,
+                 env: Optional[str] = None,
+                 status: str = STARTING,
+                 owner: Optional[int] = None,
+                 started_at: Optional[datetime] = None):
+        self.port = port # port of the pool worker serving the model
+        self.pid = pid # pool worker process id
+        self.last_used = last_used
+        self.memory = memory # resident memory (bytes) used by the loaded model
+        self.env = env # conda env. of the pool worker
+        self.status = status
+        self.owner = owner # id of the server process starting the model
+        self.started_at = started_at if started_at is not None else last_used
+
+    def is_ready(self) -> bool:
+        return self.status == LiveModel.READY
+
+    def to_dict(self):
+        return {
+            'port': self.port,
+            'pid': self.pid,
+            'last_used': self.last_used.timestamp(),
+            'memory': self.memory,
+            'env': self.env,
+            'status': self.status,
+            'owner': self.owner,
+            'started_at': self.started_at.timestamp()
+        }
+
+    @staticmethod
+    def from_dict(live_model: dict) -> 'LiveModel':
+        return LiveModel(port=live_model['port'],
+                         pid=live_model['pid'],
+                         last_used=datetime.fromtimestamp(live_model['last_used']),
+                         memory=live_model['memory'],
+                         env=live_model['env'],
+                         status=live_model['status'],
+                         owner=live_model['owner'],
+                         started_at=datetime.fromtimestamp(live_model['started_at']))
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, Text, DateTime
+from sqlalchemy import Column, Integer, BigInteger, String, ForeignKey, Text, DateTime
 from db.db_config import Base
 from datetime import datetime
 from models.user import User
@@ -21,6 +21,12 @@ class ModelUpload(Base):
     status = Column(String(12), default=RUNNING, nullable=False)
     started_at = Column(DateTime, default=datetime.now(), nullable=False)
     finished_at = Column(DateTime, nullable=True)
+    file_size = Column(BigInteger, nullable=True)
+    content_hash = Column(String(64), nullable=True)
+    upload_path = Column(Text, nullable=True) # zip file to register; removed once the upload is finished or failed
+    attempts = Column(Integer, default=0, nullable=False)
+    worker_id = Column(String(64), nullable=True) # upload worker running the upload
+    heartbeat_at = Column(DateTime, nullable=True) # last sign of life of the worker running the upload
 
     @staticmethod
     def is_valid_status(status: str) -> bool:
@@ -36,6 +42,9 @@ class ModelUpload(Base):
             'model_version': self.model_version,
             'status': self.status,
             'started_at': self.started_at,
-            'finished_at': self.finished_at
+            'finished_at': self.finished_at,
+            'file_size': self.file_size,
+            'content_hash': self.content_hash,
+            'attempts': self.attempts
         }
 
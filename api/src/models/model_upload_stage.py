@@ -0,0 +1,45 @@
+'''
+Stage of a model upload's registration, with its timing and size
+'''
+from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, Text, BIGINT
+from db.db_config import Base
+from models.model_upload import ModelUpload
+
+class ModelUploadStage(Base):
+    __tablename__ = 'model_upload_stages'
+
+    # Stages, in order
+    QUEUE: str = 'queue' # waiting for an upload worker
+    SAVE: str = 'save' # upload streamed to disk
+    UNZIP: str = 'unzip'
+    YAML_PARSE: str = 'yaml_parse' # shipped-brain.yaml
+    LOG_MODEL: str = 'log_model' # run and artifacts logged to mlflow
+    REGISTER_MODEL: str = 'register_model'
+    TAGS: str = 'tags' # params and metrics
+    CONDA_ENV: str = 'conda_env' # conda env. prepared for serving; runs after the upload is finished
+
+    RUNNING: str = 'running'
+    FINISHED: str = 'finished'
+    FAILED: str = 'failed'
+
+    id = Column(Integer, primary_key=True)
+    model_upload_id = Column(Integer, ForeignKey(ModelUpload.id, ondelete='CASCADE'), nullable=False)
+    stage = Column(String(32), nullable=False)
+    attempt = Column(Integer, default=1, nullable=False)
+    status = Column(String(12), default=RUNNING, nullable=False)
+    started_at = Column(DateTime, nullable=False)
+    finished_at = Column(DateTime, nullable=True)
+    bytes = Column(BIGINT, nullable=True) # e.g. size of the uploaded, unzipped or logged files
+    error = Column(Text, nullable=True)
+
+    def to_dict(self):
+        return {
+            'stage': self.stage,
+            'attempt': self.attempt,
+            'status': self.status,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+            'duration': (self.finished_at - self.started_at).total_seconds() if self.finished_at else None,
+            'bytes': self.bytes,
+            'error': self.error
+        }
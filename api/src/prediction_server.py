@@ -1,9 +1,17 @@
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from middleware.db_session import DBSessionMiddleware
+import db.async_db as async_db
 from routers.prediction_server import prediction
 
 app = FastAPI(title='Shipped Brain - Prediction Server', version='0.1')
 
+app.add_middleware(DBSessionMiddleware)
+
+# Async database pool
+app.add_event_handler('startup', async_db.connect)
+app.add_event_handler('shutdown', async_db.disconnect)
+
 # CORS setup
 origins = [
     'http://localhost:8000',
@@ -48,11 +48,9 @@ def login(response: Response, form_data: UserSchema.Login):
 @router.get('/users/me')
 async def get_user(current_user: UserSchema.UserBase = Depends(AuthMiddleware.get_current_user)):
     user = Format.format_user(current_user.data)
+    user.update(await AuthMiddleware.get_user_counters(current_user.data))
 
-    try:
-        user['photo'] = UserPhotoService.get_user_photo(user['username'])
-    except:
-        user['photo'] = None
+    user['photo'] = UserPhotoService.get_user_photo_url(user['username'])
 
     return Result(
         Result.SUCCESS,
@@ -0,0 +1,128 @@
+'''
+Batch scoring jobs
+
+Input files are scored asynchronously by the prediction server; see BatchJobService.
+'''
+import os
+from typing import Optional
+
+import middleware.auth as AuthMiddleware
+from fastapi import APIRouter, Depends, File, Response, UploadFile
+from fastapi.responses import StreamingResponse
+from models.batch_job import BatchJob
+from models.result import Result
+from services.batch_job_service import BatchJobService
+from services.mlflow_service import MLflowService
+
+router = APIRouter()
+
+
+def get_user_job(job_id: int, user_id: int) -> Result:
+    ''' Get a batch job of a user; jobs of other users are not found
+    '''
+    result = BatchJobService.get_by_id(job_id)
+    if result.is_success() and result.data.user_id != user_id:
+        return Result(Result.FAIL,
+                      f'Batch job with id {job_id} was not found',
+                      Result.NOT_FOUND)
+
+    return result
+
+
+@router.post('/predict/{model_name}/jobs', status_code=200)
+def create_batch_job(model_name: str,
+                     response: Response,
+                     model_version: Optional[int] = None,
+                     file: UploadFile = File(...),
+                     current_user=Depends(AuthMiddleware.get_current_user)):
+    '''Score a CSV or Parquet file asynchronously. Defaults to the model's latest version
+
+    Request example:
+        curl -X POST "http://localhost:8000/api/v0/predict/ElasticNet/jobs" \
+        -H 'Authorization: Bearer <token>' \
+        -F "file=@/path/to/wine.csv"
+    '''
+    input_format = BatchJobService.get_input_format(file.filename)
+    if input_format is None:
+        result = Result(Result.FAIL,
+                        f'Input file must be one of {BatchJob._all_formats}',
+                        Result.NOT_ACCEPTABLE)
+        response.status_code = result.get_status_code()
+        return result.to_dict()
+
+    if model_version is None:
+        registered_model_result = MLflowService.get_model(model_name=model_name)
+        if registered_model_result.is_fail() or len(registered_model_result.data.latest_versions) == 0:
+            result = Result(Result.FAIL,
+                            f"Failed to get model with name '{model_name}'",
+                            Result.NOT_FOUND)
+            response.status_code = result.get_status_code()
+            return result.to_dict()
+        model_version = int(registered_model_result.data.latest_versions[0].version)
+    elif MLflowService.get_model_version(model_name, model_version).is_fail():
+        result = Result(Result.FAIL,
+                        f"Failed to get version {model_version} of model '{model_name}'",
+                        Result.NOT_FOUND)
+        response.status_code = result.get_status_code()
+        return result.to_dict()
+
+    result = BatchJobService.create(current_user.data.id, model_name, model_version, input_format, file.file)
+    if result.is_fail():
+        response.status_code = result.get_status_code()
+        return result.to_dict()
+
+    return Result(Result.SUCCESS, result.message, result.data.to_dict()).to_dict()
+
+
+@router.get('/jobs', status_code=200)
+def get_batch_jobs(response: Response, status: Optional[str] = None, current_user=Depends(AuthMiddleware.get_current_user)):
+    '''List the current user's batch jobs with optional status
+    '''
+    if status and not BatchJob.is_valid_status(status):
+        result = Result(Result.FAIL,
+                        'Status is not valid',
+                        Result.NOT_ACCEPTABLE)
+        response.status_code = result.get_status_code()
+        return result.to_dict()
+
+    result = BatchJobService.list(current_user.data.id, status=status or None)
+    if result.is_fail():
+        response.status_code = result.get_status_code()
+        return result.to_dict()
+
+    return Result(Result.SUCCESS, result.message, [job.to_dict() for job in result.data]).to_dict()
+
+
+@router.get('/jobs/{job_id}', status_code=200)
+def get_batch_job(job_id: int, response: Response, current_user=Depends(AuthMiddleware.get_current_user)):
+    '''Get a batch job's status and progress
+    '''
+    result = get_user_job(job_id, current_user.data.id)
+    if result.is_fail():
+        response.status_code = result.get_status_code()
+        return result.to_dict()
+
+    return Result(Result.SUCCESS, result.message, result.data.to_dict()).to_dict()
+
+
+@router.get('/jobs/{job_id}/predictions', status_code=200)
+def download_batch_job_predictions(job_id: int, response: Response, current_user=Depends(AuthMiddleware.get_current_user)):
+    '''Download a finished batch job's predictions as CSV, one row per input row in input order
+    '''
+    result = get_user_job(job_id, current_user.data.id)
+    if result.is_success() and (result.data.status != BatchJob.FINISHED or not os.path.exists(result.data.output_path)):
+        result = Result(Result.FAIL,
+                        f'Batch job with id {job_id} is {result.data.status}',
+                        Result.NOT_ACCEPTABLE)
+    if result.is_fail():
+        response.status_code = result.get_status_code()
+        return result.to_dict()
+
+    def read_predictions():
+        with open(result.data.output_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(64 * 1024), b''):
+                yield chunk
+
+    return StreamingResponse(read_predictions(),
+                             media_type='text/csv',
+                             headers={'Content-Disposition': f'attachment; filename="predictions-{job_id}.csv"'})
@@ -1,10 +1,11 @@
 import json
+from typing import Optional
 import os
-from services.user_photo_service import UserPhotoService
 import requests
 import aiohttp
 import libs.format as Format
 import libs.utilities as utilities
+import libs.prediction_decoder as PredictionDecoder
 import middleware.auth as AuthMiddleware
 import schemas.api_call as ApiCallSchema
 import schemas.hashtag as HashtagSchema
@@ -12,6 +13,9 @@ import schemas.ml_model as ml_model_schema
 import schemas.user as UserSchema
 from dotenv import load_dotenv
 from fastapi import APIRouter, Depends, Response, Request
+from fastapi.responses import StreamingResponse
+from config.config import PREDICTION_SERVICE_CONFIG
+from db.async_db import run_blocking
 from fastapi.datastructures import UploadFile
 from fastapi.param_functions import File
 from models.prediction_request import PredictionRequest
@@ -22,6 +26,7 @@ from services.image_upload_service import ImageUploadService
 from services.model_cover_upload_service import ModelCoverUploadService
 from services.mlflow_service import MLflowService
 from services.model_like_service import ModelLikeService
+from services.model_listing_service import ModelListingService
 from services.user_service import UserService
 from services.model_comment_service import ModelCommentService
 import util.validation as Validation
@@ -35,13 +40,20 @@ aiohttp_session = aiohttp.ClientSession()
 router = APIRouter()
 
 
+class PayloadTooLarge(Exception):
+    ''' Streamed request body exceeds PREDICTION_SERVICE_CONFIG['max_payload_size']
+    '''
+    pass
+
+
 # Get models
 @router.get('/models', status_code=200)
 async def get_models(request: Request,
                      response: Response,
                      search_query: str = '',
                      order: str = 'recent',
-                     page_number: int = 1, results_per_page: int = 10):
+                     page_number: int = 1, results_per_page: int = 10,
+                     cursor: Optional[str] = None):
     accepted_orders = ['recent', 'popular', 'recently_used']
     results = []
 
@@ -58,36 +70,45 @@ async def get_models(request: Request,
         response.status_code = result.get_status_code()
         return result.to_dict()
 
+    # Get current user once; used by recently used models and likes
+    user_id = None
+    if 'Authorization' in request.headers:
+        current_user = await AuthMiddleware.get_current_user(
+            str(request.headers['Authorization']).replace('Bearer ', ''))
+        user_id = current_user.data.id
+
     # Get models by order param
     if order == 'recent':
         # Get most recent models
-        query_results = MLflowService.search_models(model_name=search_query,
-                                                    page_number=page_number,
-                                                    results_per_page=results_per_page)
-        query_results_data = query_results.data
+        query_results = await run_blocking(MLflowService.search_models,
+                                           model_name=search_query,
+                                           page_number=page_number,
+                                           results_per_page=results_per_page,
+                                           cursor=cursor)
+
+        if query_results.is_success():
+            query_results_data = query_results.data['models']
+
+            # Keyset pagination: clients pass it back as the cursor param to get the next page
+            if query_results.data['next_cursor'] is not None:
+                response.headers['X-Next-Cursor'] = query_results.data['next_cursor']
 
     elif order == 'popular':
         # Get most popular models
-        query_results = ApiCallService.get_most_popular_models(search_query=search_query,
-                                                               page_number=page_number,
-                                                               results_per_page=results_per_page)
+        query_results = await run_blocking(ApiCallService.get_most_popular_models,
+                                           search_query=search_query,
+                                           page_number=page_number,
+                                           results_per_page=results_per_page)
 
         query_results_data = query_results.data['models']
 
     elif order == 'recently_used':
-        user_id = None
-        # Check if authorization header exists
-        if 'Authorization' in request.headers:
-            # Get current user
-            current_user = await AuthMiddleware.get_current_user(
-                str(request.headers['Authorization']).replace('Bearer ', ''))
-            user_id = current_user.data.id
-
         # Get recently used models
-        query_results = ApiCallService.get_recently_used_models(user_id=user_id,
-                                                                search_query=search_query,
-                                                                page_number=page_number,
-                                                                results_per_page=results_per_page)
+        query_results = await run_blocking(ApiCallService.get_recently_used_models,
+                                           user_id=user_id,
+                                           search_query=search_query,
+                                           page_number=page_number,
+                                           results_per_page=results_per_page)
         query_results_data = query_results.data["models"]
 
     else:
@@ -102,90 +123,15 @@ async def get_models(request: Request,
         response.status_code = query_results.get_status_code()
         return query_results.to_dict()
 
-    for registered_model in query_results_data:
-
-        # Validation is necessary because model_version from recently used is already formatted
-        if order != 'recently_used':
-            # Get user
-            user = UserService.get_user_by_username(registered_model.tags['user_id'])
-            if user.is_success():
-                user = ml_model_schema.User(name=user.data.name, username=user.data.username)
-
-                try:
-                    user.photo = UserPhotoService.get_user_photo(user.username)
-                except:
-                    user.photo = None
-
-            # Get hashtags
-            hashtags_result = HashtagService.get_model_hashtags(model_name=registered_model.name)
-            hashtags = hashtags_result.data if hashtags_result.is_success() else []
-            print("[DEBUG] hashtags_result.is_success():", hashtags_result.is_success())
-
-            # Get API calls
-            api_calls_result = ApiCallService.get_model_count(model_name=registered_model.name)
-            api_calls = api_calls_result.data['count'] if api_calls_result.is_success() else 0
-            print("[DEBUG] api_calls_result.is_success():", api_calls_result.is_success())
-
-            # Get likes
-            user_id = None
-
-            # Check if authorization header exists
-            if 'Authorization' in request.headers:
-                # Get current user
-                current_user = await AuthMiddleware.get_current_user(
-                    str(request.headers['Authorization']).replace('Bearer ', ''))
-                user_id = current_user.data.id
-
-            likes_dict = {
-                'count': 0,
-                'has_liked_model': False
-            }
-
-            likes_dict['count'] = ModelLikeService.get_model_likes(model_name=registered_model.name,
-                                                                   count_only=True).data
-            likes_dict['has_liked_model'] = False
-
-            # Check if user liked model
-            if user_id:
-                user_like = ModelLikeService.get_like(model_name=registered_model.name, user_id=user_id)
+    # Validation is necessary because model_version from recently used is already formatted
+    if order != 'recently_used':
+        listing_result = await ModelListingService.list_models_async(query_results_data, user_id=user_id)
 
-                if user_like.is_success() and user_like.data is not None:
-                    likes_dict['has_liked_model'] = True
+        if listing_result.is_fail():
+            response.status_code = listing_result.get_status_code()
+            return listing_result.to_dict()
 
-            likes = ml_model_schema.Likes(**likes_dict)
-
-            # Get comment count
-            comment_count = ModelCommentService.get_model_comments(model_name=registered_model.name, count_only=True)
-            comment_count = comment_count.data if comment_count.is_success() else 0
-
-            # Get latest model version
-            version = 0 if len(registered_model.latest_versions) == 0 else int(registered_model.latest_versions[0].version)
-
-            # Get model's cover photo
-            cover_photo = None
-            try:
-                cover_photo = ModelCoverUploadService.get_model_cover_photo(registered_model.name)
-            except:
-                cover_photo = None
-
-            registered_model_dict = ml_model_schema.MlModelListing(name=registered_model.name,
-                                                                   version=version,
-                                                                   likes=likes,
-                                                                   comment_count=comment_count,
-                                                                   hashtags=hashtags,
-                                                                   tags=registered_model.tags,
-                                                                   api_calls=api_calls,
-                                                                   creation_time=registered_model.creation_timestamp,
-                                                                   last_update_time=registered_model.last_updated_timestamp,
-                                                                   user=user,
-                                                                   description=registered_model.description,
-                                                                   cover_photo=cover_photo).dict()
-            results.append(registered_model_dict)
-
-        # Sorting here is necessary since it won't work when doing it with SQL, because SQL query is guaranteeing
-        # that only the latest version of each model is being returned, by sorting by model name and version
-        if order == 'recent':
-            results = sorted(results, key=lambda x: x['creation_time'], reverse=True)
+        results = listing_result.data
 
     return Result(
         Result.SUCCESS,
@@ -277,11 +223,7 @@ def get_model(model_name: str, response: Response, type: str = 'full'):
                 raw_readme = None
 
         # Get model's cover photo
-        cover_photo = None
-        try:
-            cover_photo = ModelCoverUploadService.get_model_cover_photo(model_name)
-        except:
-            cover_photo = None
+        cover_photo = ModelCoverUploadService.get_model_cover_photo_url(model_name)
 
         # Set Result's data property
         result.data = ml_model_schema.MlModelPage(name=model_name,
@@ -391,6 +333,20 @@ def set_github_repo(model_name: str,
     return result.to_dict()
 
 
+@router.post('/models/prediction-cache/{model_name}', status_code=200)
+def set_prediction_cache(model_name: str,
+                         prediction_cache: ml_model_schema.MlModelPredictionCacheSet,
+                         response: Response,
+                         current_user: UserSchema.UserBase = Depends(AuthMiddleware.get_current_user)):
+    """Enable or disable caching of model predictions; only for deterministic models"""
+    result = MLflowService.set_prediction_cache(current_user.data.username, model_name, enabled=prediction_cache.enabled)
+
+    if result.is_fail():
+        response.status_code = result.get_status_code()
+
+    return result.to_dict()
+
+
 @router.post('/models/parameters/{model_name}', status_code=200)
 def set_model_parameters(model_name: str,
                          parameters: ml_model_schema.MlModelParametersSet,
@@ -549,10 +505,9 @@ async def predict(model_name: str,
         -H 'accept: application/json' \
         -d '{"columns": ["fixed acidity","volatile acidity","citric acid","residual sugar","chlorides","free sulfur dioxide","total sulfur dioxide","density","pH","sulphates","alcohol"], "index": [0, 1], "data": [[7,0.27,0.36,20.7,0.045,45,170,1.001,3,0.45,8.8], [7,0.27,0.36,20.7,0.045,45,170,1.001,3,0.45,8.8]]}'
     '''
-    prediction_json = json.loads(prediction_req.json())
-    batch_size = len(prediction_json['data'])
+    batch_size = len(prediction_req.data)
 
-    if batch_size > 10:
+    if batch_size > PREDICTION_SERVICE_CONFIG['max_batch_size']:
         result = Result(
             Result.FAIL,
             'Failed to perform prediction. Batch size is too big!',
@@ -576,12 +531,12 @@ async def predict(model_name: str,
     try:
         async with aiohttp_session.post(
                 f'http://{PREDICTION_SERVER}:{PREDICTION_SERVER_PORT}/api/v0/serving/predict/{model_name}/{model_version}',
-                headers={'Authorization': f'Bearer {access_token}'},
-                json=prediction_json) as resp:
+                headers={'Authorization': f'Bearer {access_token}', 'Content-Type': 'application/json'},
+                data=prediction_req.json()) as resp:
             predict_result = await resp.text()
             print(f'[DEBUG] predict_result: {predict_result}')
 
-        result = json.loads(predict_result)
+        result = PredictionDecoder.loads(predict_result)
 
         # Log api call
         if result['status'] == Result.SUCCESS:
@@ -613,6 +568,128 @@ async def predict(model_name: str,
         return result_fail.to_dict()
 
 
+@router.post('/predict/{model_name}/stream')
+async def predict_stream(model_name: str,
+                         request: Request,
+                         response: Response,
+                         current_user=Depends(AuthMiddleware.get_current_user)):
+    '''Make prediction using model, in pass-through mode: the request body is streamed to the model server
+    without being parsed and the predictions are streamed back as returned by the model
+
+    Content types:
+        application/json                    - pandas 'split' orient json
+        application/vnd.apache.arrow.stream - Arrow IPC stream; columns are matched to the model's signature
+        application/x-npy                   - NumPy .npy array; columns are in the model's signature order
+
+    Request example:
+        curl -X POST "http://localhost:8000/api/v0/predict/ElasticNet/stream"  \
+        -H 'Authorization: Bearer <token>' \
+        -H 'Content-Type: application/json' \
+        -d '{"columns": ["fixed acidity", ...], "data": [[7,0.27,0.36,20.7,0.045,45,170,1.001,3,0.45,8.8]]}'
+
+        curl -X POST "http://localhost:8000/api/v0/predict/ElasticNet/stream"  \
+        -H 'Authorization: Bearer <token>' \
+        -H 'Content-Type: application/x-npy' \
+        --data-binary @inputs.npy
+
+    Response example:
+        [5.576883967129615]
+    '''
+    max_payload_size = PREDICTION_SERVICE_CONFIG['max_payload_size'] * 1024 * 1024
+
+    # Validate envelope only; rows are validated by the model server
+    content_type = request.headers.get('Content-Type', 'application/json').split(';')[0].strip().lower()
+    if content_type not in PREDICTION_SERVICE_CONFIG['content_types']:
+        result = Result(Result.FAIL,
+                        f"Failed to perform prediction. Content type must be one of {PREDICTION_SERVICE_CONFIG['content_types']}",
+                        Result.NOT_ACCEPTABLE)
+        response.status_code = result.get_status_code()
+        return result.to_dict()
+
+    payload_too_large_result = Result(Result.FAIL,
+                                      'Failed to perform prediction. Payload is too big!',
+                                      Result.NOT_ACCEPTABLE)
+    if int(request.headers.get('Content-Length') or 0) > max_payload_size:
+        response.status_code = payload_too_large_result.get_status_code()
+        return payload_too_large_result.to_dict()
+
+    # Get model
+    registered_model_result = await run_blocking(MLflowService.get_model, model_name=model_name)
+    if registered_model_result.is_fail() or len(registered_model_result.data.latest_versions) == 0:
+        result = Result(Result.FAIL,
+                        f"Failed to get deployment endpoint for model with name '{model_name}'.",
+                        Result.NOT_FOUND)
+        response.status_code = result.get_status_code()
+        return result.to_dict()
+    model_version = registered_model_result.data.latest_versions[0].version
+
+    # The client may send more than its Content-Length, or no Content-Length at all
+    payload = {'too_large': False}
+
+    async def stream_payload():
+        size = 0
+        async for chunk in request.stream():
+            size += len(chunk)
+            if size > max_payload_size:
+                payload['too_large'] = True
+                raise PayloadTooLarge(f'Payload exceeds {max_payload_size} bytes')
+            yield chunk
+
+    access_token, _ = AuthMiddleware.create_access_token(data={'sub': current_user.data.username},
+                                                         expires_delta=int(os.getenv('ACCESS_TOKEN_EXPIRATION')))
+    headers = {'Authorization': f'Bearer {access_token}', 'Content-Type': content_type}
+    if 'Content-Length' in request.headers:
+        headers['Content-Length'] = request.headers['Content-Length']
+
+    try:
+        resp = await aiohttp_session.post(
+            f'http://{PREDICTION_SERVER}:{PREDICTION_SERVER_PORT}/api/v0/serving/stream/{model_name}/{model_version}',
+            headers=headers,
+            data=stream_payload())
+    except Exception as e:
+        # aiohttp may surface the payload error as a connection error
+        if isinstance(e, PayloadTooLarge) or payload['too_large']:
+            print(f'[INFO] Rejected streamed prediction for model ({model_name}, {model_version}). {e}')
+            response.status_code = payload_too_large_result.get_status_code()
+            return payload_too_large_result.to_dict()
+
+        print(f'[EXCEPTION] Could not perform prediction using model ({model_name}, {model_version}). Exception: {e}')
+        result_fail = Result(Result.FAIL,
+                             f'Could not perform prediction using model ({model_name}, {model_version}). An unexpected error occured.',
+                             Result.EXCEPTION)
+        response.status_code = result_fail.get_status_code()
+        return result_fail.to_dict()
+
+    # Prediction server errors are Result dicts; e.g. proxies may answer with other bodies
+    if resp.status != 200:
+        try:
+            result = await resp.json()
+        except Exception as e:
+            print(f'[WARN] Unexpected prediction server response for model ({model_name}, {model_version}). '
+                  f'Status: {resp.status}; error: {e}')
+            result = Result(Result.FAIL,
+                            f'Could not perform prediction using model ({model_name}, {model_version}). An unexpected error occured.',
+                            Result.EXCEPTION).to_dict()
+        finally:
+            resp.release()
+        response.status_code = resp.status
+        return result
+
+    # Log api calls; the number of rows is known from the headers, before the predictions are streamed
+    api_call_create = ApiCallSchema.ApiCallCreate(user_id=current_user.data.id, model_name=model_name,
+                                                  model_version=model_version)
+    _ = await run_blocking(ApiCallService.create_batch, api_call_create, int(resp.headers.get('X-Prediction-Rows', 0)))
+
+    async def stream_predictions():
+        try:
+            async for chunk in resp.content.iter_chunked(PREDICTION_SERVICE_CONFIG['stream_chunk_size']):
+                yield chunk
+        finally:
+            resp.release()
+
+    return StreamingResponse(stream_predictions(), media_type='application/json')
+
+
 # Get model version usage
 @router.get('/models/{model_name}/usage')
 async def get_model_usage(model_name: str, response: Response, sample: str = 'D'):
@@ -694,6 +771,7 @@ def upload_cover_photo(model_name: str, response: Response, cover_photo: UploadF
         utilities.clear_dir(full_cover_photo_path)
         utilities.create_dir(full_cover_photo_path)
         utilities.save_uploaded_file(full_cover_photo_path, cover_photo)
+        ModelCoverUploadService.create_model_cover_photo_thumbnail(model_name)
     except Exception:
         result = Result(
             Result.FAIL,
@@ -84,16 +84,12 @@ def get_model_comments(model_name, response: Response, count_only: bool = False,
         user = UserService.get_user_by_id(model_comment.user_id)
         username: str = ''
         name: str = ''
+        user_photo = None
 
         if user.is_success():
             username = user.data.username
             name = user.data.name
-            user_photo = None
-
-            try:
-                user_photo = UserPhotoService.get_user_photo(username)
-            except:
-                user_photo = None
+            user_photo = UserPhotoService.get_user_photo_url(username)
 
         # Format model comment
         model_comment_dict = ModelCommentSchema.ModelCommentList(
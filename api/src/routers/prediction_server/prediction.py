@@ -4,16 +4,17 @@ File upload server
 This server implements models prediction feature. This prevents the main API from blocking.
 '''
 
-import json
-from time import sleep
-
 import aiohttp
 import middleware.auth as AuthMiddleware
-from fastapi import APIRouter, Depends, Response
+import libs.prediction_decoder as PredictionDecoder
+from fastapi import APIRouter, Depends, Response, Request
+from fastapi.responses import StreamingResponse
+from config.config import PREDICTION_SERVICE_CONFIG, BATCH_JOB_SERVICE_CONFIG
 from fastapi_utils.tasks import repeat_every
 from models.prediction_request import PredictionRequest
 from models.result import Result
 from services.model_serving_service import ModelServingService
+from services.batch_job_service import BatchJobService
 
 aiohttp_session = aiohttp.ClientSession()
 
@@ -29,6 +30,12 @@ async def kill_serving_model() -> None:
     await model_serving.kill()
 
 
+@router.on_event("startup")
+@repeat_every(seconds=BATCH_JOB_SERVICE_CONFIG['poll_interval'])
+async def run_batch_jobs() -> None:
+    await BatchJobService.run_queued(model_serving)
+
+
 @router.post('/serving/predict/{model_name}/{model_version}')
 async def predict(model_name: str,
                   model_version: int,
@@ -37,50 +44,32 @@ async def predict(model_name: str,
                   current_user=Depends(AuthMiddleware.get_current_user)):
     print(f'[INFO] Model Server - Running prediction for ({model_name}, {model_version})')
 
-    serve_result = await model_serving.serve(model_name, int(model_version))
-
-    # Live model
-    if serve_result.is_success():
-        port = serve_result.data['port']
-        print(f'[INFO] Model Server - Serving SUCCESS')
-
-        retries: int = 0
-        while retries < model_serving.MAX_RETRIES:
-            retries += 1
-            try:
-                async with aiohttp_session.post(f'http://127.0.0.1:{port}/invocations',
-                                                headers={'Content-Type': 'application/json'},
-                                                json=json.loads(prediction_req.json())) as resp:
-                    result = await resp.text()
-
-                # Handle error: model crash
-                if result is None:
-                    result = Result(Result.FAIL,
-                                    f'Failed to perform predictions using model ({model_name}, {model_version})',
-                                    Result.NOT_ACCEPTABLE)
-                    response.status_code = result.get_status_code()
-                    return result.to_dict()
-                else:
-                    # Handle error: mlflow exception
-                    # error_code=BAD_REQUEST, error_message=
-                    # remove stack_trace from response
-                    # https://github.com/mlflow/mlflow/blob/9d9d4b1f1f62de82637e24c1eb1daeec405e6c30/mlflow/pyfunc/scoring_server/__init__.py#L261
-                    result_eval = eval(result)
-                    if type(result_eval) is dict and (
-                            result_eval.get('error_code') or result_eval.get('error_message')):
-                        result = Result(Result.FAIL,
-                                        f'Failed to perform predictions using model ({model_name}, {model_version})',
-                                        Result.NOT_ACCEPTABLE)
-                        response.status_code = result.get_status_code()
-                        return result.to_dict()
-                    # SUCCESS
-                    else:
-                        return Result(Result.SUCCESS,
-                                      f'Successfully performed predictions using model ({model_name}, {model_version})',
-                                      result).to_dict()
-            except Exception as e:
-                print(f'[DEBUG] Retrying model prediction: {retries}.')
-                sleep(2 ** retries)
+    predict_result = await model_serving.predict_rows(model_name, int(model_version), prediction_req.columns, prediction_req.data)
+
+    # Model is live
+    if predict_result.is_success():
+        status, result = predict_result.data
+
+        try:
+            # Handle error: mlflow exception
+            # error_code=BAD_REQUEST, error_message=
+            # remove stack_trace from response
+            # https://github.com/mlflow/mlflow/blob/9d9d4b1f1f62de82637e24c1eb1daeec405e6c30/mlflow/pyfunc/scoring_server/__init__.py#L261
+            error = PredictionDecoder.get_error(result)
+            if error is not None or status != 200:
+                print(f'[WARN] Model Server - Prediction failed for model ({model_name}, {model_version}): {error.message if error else status}')
+                result = Result(Result.FAIL,
+                                f'Failed to perform predictions using model ({model_name}, {model_version})',
+                                Result.NOT_ACCEPTABLE)
+                response.status_code = result.get_status_code()
+                return result.to_dict()
+            # SUCCESS
+            else:
+                return Result(Result.SUCCESS,
+                              f'Successfully performed predictions using model ({model_name}, {model_version})',
+                              result.decode('utf-8')).to_dict()
+        except Exception as e:
+            print(f'[EXCEPTION] Model Server - Failed to perform prediction for model ({model_name}, {model_version}). Error: {e}')
 
         # failed to predict
         result_fail = Result(Result.FAIL,
@@ -91,9 +80,72 @@ async def predict(model_name: str,
 
     # failed to serve
     else:
+        response.status_code = predict_result.get_status_code()
+        return predict_result.to_dict()
+
+
+@router.post('/serving/stream/{model_name}/{model_version}')
+async def predict_stream(model_name: str,
+                         model_version: int,
+                         request: Request,
+                         response: Response,
+                         current_user=Depends(AuthMiddleware.get_current_user)):
+    ''' Pass-through prediction: the request body, pandas 'split' orient json, Arrow IPC stream or .npy array, is
+    streamed to the model as is and the model's predictions are streamed back as is. The number of predicted rows is
+    returned in the 'X-Prediction-Rows' header
+    '''
+    print(f'[INFO] Model Server - Running streamed prediction for ({model_name}, {model_version})')
+
+    serve_result = await model_serving.serve(model_name, int(model_version))
+
+    if serve_result.is_fail():
         response.status_code = serve_result.get_status_code()
         return serve_result.to_dict()
 
+    port = serve_result.data['port']
+    path = serve_result.data['path']
+
+    headers = {'Content-Type': request.headers.get('Content-Type', 'application/json'),
+               'X-Max-Batch-Size': str(PREDICTION_SERVICE_CONFIG['max_batch_size'])}
+    if 'Content-Length' in request.headers:
+        headers['Content-Length'] = request.headers['Content-Length']
+
+    try:
+        resp = await aiohttp_session.post(f'http://127.0.0.1:{port}{path}', headers=headers, data=request.stream())
+    except Exception as e:
+        print(f'[EXCEPTION] Model Server - Failed to perform prediction for model ({model_name}, {model_version}). Error: {e}')
+        result_fail = Result(Result.FAIL,
+                             f'Failed to perform prediction for model ({model_name}, {model_version})',
+                             Result.FAIL)
+        response.status_code = result_fail.get_status_code()
+        return result_fail.to_dict()
+
+    # Handle error: mlflow exception; remove stack_trace from response
+    if resp.status != 200:
+        try:
+            error = await resp.json()
+        except Exception as e:
+            error = {'message': f'Unexpected response (status {resp.status}): {e}'}
+        finally:
+            resp.release()
+        print(f"[WARN] Model Server - Prediction failed for model ({model_name}, {model_version}): {error.get('message')}")
+        result_fail = Result(Result.FAIL,
+                             f'Failed to perform predictions using model ({model_name}, {model_version})',
+                             Result.NOT_ACCEPTABLE)
+        response.status_code = result_fail.get_status_code()
+        return result_fail.to_dict()
+
+    async def stream_predictions():
+        try:
+            async for chunk in resp.content.iter_chunked(PREDICTION_SERVICE_CONFIG['stream_chunk_size']):
+                yield chunk
+        finally:
+            resp.release()
+
+    return StreamingResponse(stream_predictions(),
+                             media_type='application/json',
+                             headers={'X-Prediction-Rows': resp.headers.get('X-Prediction-Rows', '0')})
+
 
 @router.post('/serving/serve/{model_name}/{version}', status_code=200)
 async def serve_model(model_name: str, version: int, response: Response,
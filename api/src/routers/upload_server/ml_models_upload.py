@@ -3,156 +3,79 @@ File upload server
 
 This server implements the model deployment and project upload feature. This prevents the main API from blocking.  
 '''
+import asyncio
+import json
 import os
+import shutil
 import tempfile
+import time
 from datetime import datetime
 from typing import Optional, Tuple
 
-import libs.utilities as Utilities
 import middleware.auth as AuthMiddleware
 from config.config import MODEL_UPLOAD_SERVICE_CONFIG
-from fastapi import APIRouter, File, UploadFile, Depends, Response, BackgroundTasks
-from fastapi_utils.tasks import repeat_every
-from libs.email_lib import Email
+from fastapi import APIRouter, Depends, Request, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+from libs.upload_ingest import IngestError, ingest_multipart_file, validate_zip
 from models.model_upload import ModelUpload
+from models.model_upload_stage import ModelUploadStage
 from models.result import Result
 from services.mlflow_service import MLflowService
-from services.model_registry_service import ModelRegistryService
 from services.model_upload_service import ModelUploadService
-from services.user_service import UserService
+from services.model_upload_stage_service import ModelUploadStageService
 
 router = APIRouter()
 
 
-# @router.on_event("startup")
-# @repeat_every(seconds=60)
-# async def update_model_uploads() -> None:
-#     print(f'[INFO] Trigger - Update model upload table')
-#     now = datetime.now()
-#     running_model_uploads_result = ModelUploadService.list(staus="running")
-#     ttl = 60 * 5  # 5 minutes
-#     if running_model_uploads_result.is_success():
-#         running_model_uploads = running_model_uploads_result.data
-#         for rmu in running_model_uploads:
-#             time_delta = now - rmu.started_at
-#             if time_delta.seconds >= ttl:
-#                 ModelUploadService.update(user_id=rmu.id, status="failed")
-#                 user_result = UserService.get_user_by_id(rmu.id)
-#                 if user_result.is_success():
-#                     username = user_result.data.username
-#                     access_token, _ = AuthMiddleware.create_access_token(data={'sub': username},
-#                                                                          expires_delta=int(
-#                                                                              os.getenv('ACCESS_TOKEN_EXPIRATION')))
-#                     send_email(access_token=access_token, success=False, deployment_id=rmu.id)
-
-
-def send_email(access_token: Result,
-               model_name_version: Optional[Tuple[str, int]] = None,
-               success: bool = True,
-               deployment_id: Optional[int] = None,
-               message: Optional[str] = None) -> Result:
-    try:
-        if success:
-            print('[INFO] Sending model deployment SUCCESS e-mail.')
-            Email().send_deployed_model_email(user_name=access_token.data.name,
-                                              user_email=access_token.data.email,
-                                              model_name=model_name_version[0],
-                                              model_version=model_name_version[1])
-        else:
-            print('[INFO] Sending model deployment FAIL e-mail.')
-            Email().send_failed_deployed_model_email(user_name=access_token.data.name,
-                                                     user_email=access_token.data.email,
-                                                     deployment_id=deployment_id)
-    except Exception as e:
-        print(f'[EXCEPTION] An error occurred while sending an email confirming model deployment status. Exception {e}')
-        return Result(
-            Result.FAIL,
-            'An error occurred while sending an email confirming model deployment status',
-            Result.EXCEPTION
-        )
-
-    return Result(Result.SUCCESS,
-                  'Successfully submitted model deployment job.',
-                  Result.SUCCESS)
-
-
-# Background task
-def upload_file_and_register_model(access_token: Result,
-                                   file: UploadFile,
-                                   user_model_upload_result: Result,
-                                   response) -> None:
-    with tempfile.TemporaryDirectory() as tmpdir:
-
-        # Save file
-        try:
-            uploaded_model = Utilities.save_uploaded_file(dir=tmpdir, file=file)
-
-        except Exception as e:
-            print(f'[EXCEPTION] An error occurred while saving file. Exception: {e}')
-            # ModelUpdate - update completion
-            _ = ModelUploadService.update(user_model_upload_result.data.id,
-                                          status=ModelUpload.FAILED,
-                                          finished_at=datetime.now())
-
-            _ = send_email(access_token, success=False, deployment_id=user_model_upload_result.data.id)
-
-        # Register model
-        try:
-            uploaded_model_zip = os.path.join(tmpdir, file.filename)
-
-            print("[INFO] Registrying model...")
-            register_model_result = ModelRegistryService.register_model(uploaded_model_zip, access_token.data.username)
-
-            print(f"[DEBUG] Register model result.is_success(): {register_model_result.is_success()}")
-            print(f"[DEBUG] Register model result: {register_model_result.data}")
+def get_registered_model_version(user_id: int, content_hash: str) -> Optional[Tuple[str, int]]:
+    ''' Get the model version registered from an identical upload of the user, if it still exists
+    '''
+    if not MODEL_UPLOAD_SERVICE_CONFIG['dedupe_uploads']:
+        return None
 
-            if register_model_result.is_success():
-                model_version = register_model_result.data
-                ModelRegistryService.update_model_owner(access_token.data.username, run_id=model_version.run_id)
-                #ModelRegistryService.inherit_model_hashtags(model_version.name, int(model_version.version))
+    model_upload_result = ModelUploadService.get_registered_by_content_hash(user_id, content_hash)
+    if model_upload_result.is_fail():
+        return None
 
-                # Update upload state
-                # ModelUpdate - update completion
-                print(f"[INFO] Model uploaded successfully.")
+    model_upload = model_upload_result.data
+    model_version_result = MLflowService.get_model_version(model_upload.model_name, model_upload.model_version)
+    if model_version_result.is_fail():
+        return None
 
-                _ = ModelUploadService.update(user_model_upload_result.data.id,
-                                              model_name=model_version.name,
-                                              model_version=int(model_version.version),
-                                              status=ModelUpload.FINISHED,
-                                              finished_at=datetime.now())
+    return model_upload.model_name, model_upload.model_version
 
-                _ = send_email(access_token, model_name_version=(model_version.name, int(model_version.version)),
-                               success=True)
 
-            else:
-                print(f"[INFO] Failed to register model! {register_model_result.message}")
-                # Update upload state
-                # ModelUpdate - update completion
-                _ = ModelUploadService.update(user_model_upload_result.data.id,
-                                              status=ModelUpload.FAILED,
-                                              finished_at=datetime.now())
+async def get_user_upload_progress(upload_id: int, user_id: int) -> Result:
+    ''' Get the progress of a model upload of a user; uploads of other users are not found
+    '''
+    result = await ModelUploadStageService.get_progress_async(upload_id)
+    if result.is_success() and result.data['user_id'] != user_id:
+        return Result(Result.FAIL,
+                      f'Model upload with id {upload_id} was not found',
+                      Result.NOT_FOUND)
 
-                _ = send_email(access_token, success=False, deployment_id=user_model_upload_result.data.id)
+    return result
 
-        except Exception as e:
-            print(f"[INFO] Failed to register model! ERROR: {e}")
-            # Update upload state
-            # ModelUpdate - update completion
-            _ = ModelUploadService.update(user_model_upload_result.data.id,
-                                          status=ModelUpload.FAILED,
-                                          finished_at=datetime.now())
 
-            _ = send_email(access_token, success=False, deployment_id=user_model_upload_result.data.id)
+def is_upload_done(progress: dict) -> bool:
+    ''' Whether an upload and its stages, e.g. the conda env. prepared after the upload is finished, are done
+    '''
+    return progress['status'] in [ModelUpload.FINISHED, ModelUpload.FAILED, ModelUpload.CANCELED] \
+        and all(stage['status'] != ModelUploadStage.RUNNING for stage in progress['stages'])
 
 
 # Upload model zip file and deploy
 @router.post('/uploads/deploy', status_code=200)
-async def upload_model_file_and_deploy(response: Response,
-                                       background_task: BackgroundTasks,
-                                       file: UploadFile = File(...),
+async def upload_model_file_and_deploy(request: Request,
+                                       response: Response,
                                        access_token=Depends(AuthMiddleware.get_current_user)):
     ''' Upload zip file and deploy project. Requires API access token
 
+    The multipart 'file' field is streamed to disk: its size is capped and its sha256 computed while reading, and the
+    zip file is validated before the upload is queued. Queued uploads are registered by the upload workers; see
+    upload_worker.py
+
     Request example:
         curl -X POST "http://localhost:8001/uploads/deploy" -H 'Authorization: Bearer <access_token>' -F "file=@/path/to/zip_file"  -F 'description="Some model Description"'
     
@@ -165,12 +88,11 @@ async def upload_model_file_and_deploy(response: Response,
         'multipart/form-data'
     ]
 
-    # TODO ModelUpload.QUEUED
-    all_model_uploads_result = ModelUploadService.list(status=ModelUpload.RUNNING)
-
-    ##### Server is running max number of uploads #####
-    if all_model_uploads_result.is_success() and len(all_model_uploads_result.data) >= MODEL_UPLOAD_SERVICE_CONFIG[
-        'max_concurrent_uploads_all']:
+    ##### Queue is full #####
+    # Database calls run in the thread pool; they must not block the streamed uploads of the event loop
+    all_model_uploads_result = await run_in_threadpool(ModelUploadService.count,
+                                                       statuses=[ModelUpload.QUEUED, ModelUpload.RUNNING])
+    if all_model_uploads_result.is_success() and all_model_uploads_result.data >= MODEL_UPLOAD_SERVICE_CONFIG['max_queued_uploads']:
         print('[INFO] Cannot register any models. Too many uploads are running or queued.')
         result = Result(
             Result.FAIL,
@@ -181,60 +103,168 @@ async def upload_model_file_and_deploy(response: Response,
 
         return result.to_dict()
 
-    ##### User is already uploading a model #####
-    user_model_uploads_result = ModelUploadService.list(user_id=access_token.data.id, status=ModelUpload.RUNNING)
-    if user_model_uploads_result.is_success() and len(user_model_uploads_result.data) >= MODEL_UPLOAD_SERVICE_CONFIG[
-        'max_concurrent_uploads_user']:
+    ##### User has too many uploads queued #####
+    user_model_uploads_result = await run_in_threadpool(ModelUploadService.count,
+                                                        statuses=[ModelUpload.QUEUED, ModelUpload.RUNNING],
+                                                        user_id=access_token.data.id)
+    if user_model_uploads_result.is_success() and user_model_uploads_result.data >= MODEL_UPLOAD_SERVICE_CONFIG['max_queued_uploads_user']:
         print('[INFO] Cannot register any models. Upload is running or queued.')
         result = Result(
             Result.FAIL,
-            'You cannot register any models at the moment. Model is being uploaded. Please upgrade your user limits or try again later.',
+            'You cannot register any models at the moment. Models are being uploaded. Please upgrade your user limits or try again later.',
             Result.FORBIDDEN
         )
         response.status_code = result.get_status_code()
 
         return result.to_dict()
 
-    # Create model_upload record
-    user_model_upload_result = ModelUploadService.create(access_token.data.id)
-    # TODO check integrity
+    #### Stream file to disk and validate zip ####
+    save_started_at = datetime.now()
+    # The upload directory is shared with the upload workers; it is removed once the upload is finished or failed
+    os.makedirs(MODEL_UPLOAD_SERVICE_CONFIG['uploads_dir'], exist_ok=True)
+    upload_dir = tempfile.mkdtemp(dir=MODEL_UPLOAD_SERVICE_CONFIG['uploads_dir'])
+    try:
+        uploaded_file = await ingest_multipart_file(request,
+                                                    field_name='file',
+                                                    target_dir=upload_dir,
+                                                    max_size=MODEL_UPLOAD_SERVICE_CONFIG['max_model_size'] * 1024 * 1024,
+                                                    content_types=accepted_extensions)
+
+        await run_in_threadpool(validate_zip,
+                                uploaded_file.path,
+                                max_files=MODEL_UPLOAD_SERVICE_CONFIG['max_files'],
+                                max_uncompressed_size=MODEL_UPLOAD_SERVICE_CONFIG['max_uncompressed_size'] * 1024 * 1024,
+                                required_files=['shipped-brain.yaml'])
+    except IngestError as e:
+        print(f"[WARN] Rejected model upload of user {access_token.data.id}: {e.message}")
+        shutil.rmtree(upload_dir, ignore_errors=True)
+
+        result = Result(
+            Result.FAIL,
+            e.message,
+            e.reason
+        )
 
-    #### Bad file foramt - Update ModelUpload status to ####
-    if file.content_type not in accepted_extensions:
-        print(f"[WARN] BAD file content type: {file.content_type}")
-        # ModelUpdate - update completion
-        _ = ModelUploadService.update(user_model_upload_result.data.id,
-                                      status=ModelUpload.FAILED,
-                                      finished_at=datetime.now())
+        response.status_code = result.get_status_code()
+
+        return result.to_dict()
+    except Exception as e:
+        print(f'[EXCEPTION] An error occurred while saving file. Exception: {e}')
+        shutil.rmtree(upload_dir, ignore_errors=True)
 
         result = Result(
             Result.FAIL,
-            'Invalid extension for file upload',
-            Result.NOT_ACCEPTABLE
+            'An error occurred while saving file',
+            Result.EXCEPTION
         )
 
         response.status_code = result.get_status_code()
 
         return result.to_dict()
 
-    try:
-        print("[INFO] Registering model as bg task")
-        #### Upload model as background task ####
-        background_task.add_task(upload_file_and_register_model,
-                                 access_token,
-                                 file,
-                                 user_model_upload_result,
-                                 response)
+    #### Identical upload - resolve to the version already registered ####
+    registered_model_version = await run_in_threadpool(get_registered_model_version, access_token.data.id, uploaded_file.sha256)
+    if registered_model_version is not None:
+        model_name, model_version = registered_model_version
+        print(f"[INFO] Upload of user {access_token.data.id} is identical to ({model_name}, {model_version})")
+        shutil.rmtree(upload_dir, ignore_errors=True)
+        _ = await run_in_threadpool(ModelUploadService.create,
+                                    access_token.data.id,
+                                    model_name=model_name,
+                                    model_version=model_version,
+                                    status=ModelUpload.FINISHED,
+                                    finished_at=datetime.now(),
+                                    file_size=uploaded_file.size,
+                                    content_hash=uploaded_file.sha256)
 
         return Result(
             Result.SUCCESS,
-            'Successfully submitted model deployment job.',
+            f"Model is already registered as ({model_name}, {model_version}).",
             Result.SUCCESS).to_dict()
-    except Exception as e:
-        result = Result(
-            Result.FAIL,
-            e,
-            Result.EXCEPTION
-        )
+
+    #### Queue upload ####
+    user_model_upload_result = await run_in_threadpool(ModelUploadService.create,
+                                                       access_token.data.id,
+                                                       status=ModelUpload.QUEUED,
+                                                       upload_path=uploaded_file.path,
+                                                       file_size=uploaded_file.size,
+                                                       content_hash=uploaded_file.sha256)
+    if user_model_upload_result.is_fail():
+        shutil.rmtree(upload_dir, ignore_errors=True)
+        response.status_code = user_model_upload_result.get_status_code()
+
+        return user_model_upload_result.to_dict()
+
+    model_upload_id = user_model_upload_result.data.id
+    print(f"[INFO] Queued model upload {model_upload_id}")
+
+    save_stage_id = await run_in_threadpool(ModelUploadStageService.start,
+                                            model_upload_id,
+                                            ModelUploadStage.SAVE,
+                                            started_at=save_started_at)
+    await run_in_threadpool(ModelUploadStageService.finish, save_stage_id, bytes=uploaded_file.size)
+    _ = await run_in_threadpool(ModelUploadStageService.start, model_upload_id, ModelUploadStage.QUEUE)
+
+    return Result(
+        Result.SUCCESS,
+        f'Successfully submitted model deployment job {model_upload_id}.',
+        Result.SUCCESS).to_dict()
+
+
+@router.get('/uploads/{upload_id}', status_code=200)
+async def get_model_upload(upload_id: int, response: Response, access_token=Depends(AuthMiddleware.get_current_user)):
+    ''' Get a model upload's status and its stages, with their timings and sizes. Requires API access token
+
+    Request example:
+        curl "http://localhost:8001/uploads/1" -H 'Authorization: Bearer <access_token>'
+    '''
+    result = await get_user_upload_progress(upload_id, access_token.data.id)
+    if result.is_fail():
+        response.status_code = result.get_status_code()
+
+    return result.to_dict()
+
+
+@router.get('/uploads/{upload_id}/progress', status_code=200)
+async def stream_model_upload_progress(upload_id: int,
+                                       response: Response,
+                                       access_token=Depends(AuthMiddleware.get_current_user)):
+    ''' Stream a model upload's progress as server-sent events. A 'progress' event, with the data of GET
+    /uploads/{upload_id}, is sent whenever the upload or its stages change; the stream ends once they are done.
+    Requires API access token
+
+    Request example:
+        curl -N "http://localhost:8001/uploads/1/progress" -H 'Authorization: Bearer <access_token>'
+    '''
+    user_id = access_token.data.id
+    result = await get_user_upload_progress(upload_id, user_id)
+    if result.is_fail():
         response.status_code = result.get_status_code()
         return result.to_dict()
+
+    async def stream_progress():
+        progress = result.data
+        data = None
+        started = last_sent = time.monotonic()
+        while True:
+            next_data = json.dumps(progress, default=str)
+            if next_data != data:
+                data = next_data
+                last_sent = time.monotonic()
+                yield f'event: progress\ndata: {data}\n\n'
+            elif time.monotonic() - last_sent >= MODEL_UPLOAD_SERVICE_CONFIG['progress_keep_alive']:
+                last_sent = time.monotonic()
+                yield ': keep-alive\n\n'
+
+            if is_upload_done(progress) or time.monotonic() - started >= MODEL_UPLOAD_SERVICE_CONFIG['progress_timeout']:
+                return
+
+            await asyncio.sleep(MODEL_UPLOAD_SERVICE_CONFIG['progress_poll_interval'])
+            progress_result = await get_user_upload_progress(upload_id, user_id)
+            if progress_result.is_fail():
+                return
+            progress = progress_result.data
+
+    return StreamingResponse(stream_progress(),
+                             media_type='text/event-stream',
+                             headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
@@ -8,16 +8,15 @@ from services.mlflow_service import MLflowService
 from services.api_call_service import ApiCallService
 from services.hashtag_service import HashtagService
 from services.social_network_service import SocialNetworkService
-from services.model_like_service import ModelLikeService
 from services.image_upload_service import ImageUploadService
-from services.model_comment_service import ModelCommentService
+from services.model_listing_service import ModelListingService
 from libs.email_lib import Email
+from db.async_db import run_blocking
 import schemas.user as UserSchema
 import schemas.hashtag as HashtagSchema
 import middleware.auth as AuthMiddleware
 import libs.format as Format
 import util.validation as Validation
-import schemas.ml_model as ml_model_schema
 import libs.utilities as utilities
 
 router = APIRouter()
@@ -98,93 +97,37 @@ def create_user(user: UserSchema.UserCreate, response: Response):
 # Get user by username
 @router.get('/users/{username}')
 async def get_user(username: str, response: Response, request: Request):
-    user_query = UserService.get_user_by_username(username=username)
+    user_query = await UserService.get_user_by_username_async(username=username)
 
     if user_query.is_fail():
         response.status_code = user_query.get_status_code()
         return user_query.to_dict()
 
     result = Format.format_user(user_query.data)
-
-    try:
-        result['photo'] = UserPhotoService.get_user_photo(username)
-    except:
-        result['photo'] = None
-
+    result['photo'] = UserPhotoService.get_user_photo_url(username)
     result['models'] = []
 
-    user_models_result = MLflowService.get_user_models(username)
+    user_models_result = await run_blocking(MLflowService.get_user_models, username)
 
     if user_models_result.is_fail():
         response.status_code = user_models_result.get_status_code()
         return user_models_result.to_dict()
 
-    for registered_model in user_models_result.data:
-        # Get hashtags
-        hashtags_result = HashtagService.get_model_hashtags(model_name=registered_model.name)
-        hashtags = hashtags_result.data if hashtags_result.is_success() else []
-        print("[DEBUG] hashtags_result.is_success():", hashtags_result.is_success())
-
-        # Get API calls
-        api_calls_result = ApiCallService.get_model_count(model_name=registered_model.name)
-        api_calls = api_calls_result.data['count'] if api_calls_result.is_success() else 0
-        print("[DEBUG] api_calls_result.is_success():", api_calls_result.is_success())
-
-        # Get likes
-        user_id = None
-
-        # Check if authorization header exists
-        if 'Authorization' in request.headers:
-            # Get current user
-            current_user = await AuthMiddleware.get_current_user(
-                str(request.headers['Authorization']).replace('Bearer ', ''))
-            user_id = current_user.data.id
-
-        likes_dict = {
-            'count': 0,
-            'has_liked_model': False
-        }
-
-        likes_dict['count'] = ModelLikeService.get_model_likes(model_name=registered_model.name,
-                                                               count_only=True).data
-        likes_dict['has_liked_model'] = False
-
-        # Check if user liked model
-        if user_id:
-            user_like = ModelLikeService.get_like(model_name=registered_model.name, user_id=user_id)
-
-            if user_like.is_success() and user_like.data is not None:
-                likes_dict['has_liked_model'] = True
-
-        likes = ml_model_schema.Likes(**likes_dict)
-
-        # Get comment count
-        comment_count = ModelCommentService.get_model_comments(model_name=registered_model.name, count_only=True)
-        comment_count = comment_count.data if comment_count.is_success() else 0
-
-        # Get latest model version
-        version = 0 if len(registered_model.latest_versions) == 0 else int(
-            registered_model.latest_versions[0].version)
-
-        ml_user = ml_model_schema.User(name=user_query.data.name, username=user_query.data.username)
-
-        try:
-            ml_user.photo = UserPhotoService.get_user_photo(user_query.data.username)
-        except:
-            ml_user.photo = None
-
-        registered_model_dict = ml_model_schema.MlModelListing(name=registered_model.name,
-                                                               version=version,
-                                                               likes=likes,
-                                                               comment_count=comment_count,
-                                                               hashtags=hashtags,
-                                                               tags=registered_model.tags,
-                                                               api_calls=api_calls,
-                                                               creation_time=registered_model.creation_timestamp,
-                                                               last_update_time=registered_model.last_updated_timestamp,
-                                                               user=ml_user,
-                                                               description=registered_model.description).dict()
-        result['models'].append(registered_model_dict)
+    # Get current user once; used to check if the user liked the models
+    user_id = None
+    if 'Authorization' in request.headers:
+        current_user = await AuthMiddleware.get_current_user(
+            str(request.headers['Authorization']).replace('Bearer ', ''))
+        user_id = current_user.data.id
+
+    listing_result = await ModelListingService.list_models_async(user_models_result.data, user_id=user_id,
+                                                                 with_cover_photo=False)
+
+    if listing_result.is_fail():
+        response.status_code = listing_result.get_status_code()
+        return listing_result.to_dict()
+
+    result['models'] = listing_result.data
 
     return Result(
         Result.SUCCESS,
@@ -216,10 +159,7 @@ def get_users(response: Response, search_query: str = '', page_number: int = 1,
         if user_model_hashtags.is_success():
             user['model_hashtags'] = user_model_hashtags.data
 
-        try:
-            user['photo'] = UserPhotoService.get_user_photo(user['username'])
-        except:
-            user['photo'] = None
+        user['photo'] = UserPhotoService.get_user_photo_url(user['username'])
 
         results.append(user)
 
@@ -466,6 +406,7 @@ def upload_photo(username: str, response: Response, photo: UploadFile = File(...
         utilities.clear_dir(full_photo_path)
         utilities.create_dir(full_photo_path)
         utilities.save_uploaded_file(full_photo_path, photo)
+        UserPhotoService.create_user_photo_thumbnail(username)
     except Exception:
         result = Result(
             Result.FAIL,
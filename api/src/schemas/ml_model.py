@@ -73,6 +73,9 @@ class MlModelMetricsSet(BaseModel):
 class MlModelGitHubSet(BaseModel):
     url: str
 
+class MlModelPredictionCacheSet(BaseModel):
+    enabled: bool
+
 class MlModelParametersSet(BaseModel):
     parameters: str
 
@@ -1,13 +1,20 @@
-from datetime import datetime
-from typing import Optional
+from datetime import datetime, timedelta
+from typing import Optional, List
 
 import schemas.api_call as ApiCallSchema
-from db.db_config import session
+from db.db_config import session, read_session, engine
+from config.config import METERING_CONFIG
+from libs.metering import MeteringQueue
 from models.api_call import ApiCall
+from models.api_call_batch import ApiCallBatch
+from models.api_call_rollup import ApiCallRollup
+from models.api_call_model_total import ApiCallModelTotal
 from models.registered_model import RegisteredModel
 from models.result import Result
 from services.mlflow_service import MLflowService
-from sqlalchemy import func
+from sqlalchemy import func, select
+from db.async_db import database
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.sql import text
 
 
@@ -19,19 +26,19 @@ class ApiCallService:
 
         :param api_call_create: an ApiCallCreate object
 
-        :return: and ApiCall object, None on exception
+        :return: a Result object, on success Result.data is the written usage event
         '''
         try:
-            api_call = ApiCall(user_id=api_call_create.user_id,
-                               model_name=api_call_create.model_name,
-                               call_time=datetime.now())
-            session.add(api_call)
-            session.commit()
+            event = {'user_id': int(api_call_create.user_id),
+                     'model_name': api_call_create.model_name,
+                     'calls': 1,
+                     'call_time': datetime.now().isoformat()}
+            ApiCallService.write_events([event])
 
             return Result(
                 Result.SUCCESS,
                 'Created API call',
-                api_call
+                event
             )
         except Exception as e:
             print(f'[EXCEPTION] ApiCallService.create. Exception: {e}')
@@ -43,31 +50,27 @@ class ApiCallService:
 
     @staticmethod
     def create_batch(api_call_create: ApiCallSchema.ApiCallCreate, batch_size: int) -> Result:
-        ''' Create an api call for each observation in batch
+        ''' Meter the api calls of a batch prediction. The batch is recorded asynchronously, by the metering queue,
+        as a single row with calls=batch_size
 
         :param api_call_create: an ApiCallCreate object
         :param batch_size: the size of the batch used in prediction
 
-        :return: a list of ApiCall object, None on exception
+        :return: a Result object, on success Result.data is the enqueued usage event
         '''
         try:
-            api_calls = []
             # A batch prediction is considered originates from a single call, 
             # thus th time of the API call is the same for every single inference
-            call_time = datetime.now()
-            for i in range(batch_size):
-                api_call = ApiCall(user_id=api_call_create.user_id,
-                                   model_name=api_call_create.model_name,
-                                   call_time=call_time)
-                session.add(api_call)
-                api_calls.append(api_call)
-            # Bulk insert
-            session.commit()
+            event = {'user_id': int(api_call_create.user_id),
+                     'model_name': api_call_create.model_name,
+                     'calls': batch_size,
+                     'call_time': datetime.now().isoformat()}
+            metering_queue.enqueue(event)
 
             return Result(
                 Result.SUCCESS,
-                'Created API call batch',
-                api_calls
+                'Enqueued API call batch',
+                event
             )
         except Exception as e:
             print(f'[EXCEPTION] ApiCallService.create_batch. Exception: {e}')
@@ -77,6 +80,67 @@ class ApiCallService:
                 Result.EXCEPTION
             )
 
+    @staticmethod
+    def write_events(events: List[dict], batch_id: str) -> None:
+        ''' Bulk insert usage events from the metering queue. Uses its own connection; raises on failure. Batches
+        already written are skipped: the batch id is recorded in the same transaction
+
+        :param events: list of usage events {'user_id': <int>, 'model_name': <str>, 'calls': <int>, 'call_time': <iso format>}
+        :param batch_id: id of the metering batch
+        '''
+        # Merge events of the same user, model and call time
+        rows = {}
+        for event in events:
+            key = (event['user_id'], event['model_name'], event['call_time'])
+            if key in rows:
+                rows[key]['calls'] += event['calls']
+            else:
+                rows[key] = {'user_id': event['user_id'],
+                             'model_name': event['model_name'],
+                             'calls': event['calls'],
+                             'call_time': datetime.fromisoformat(event['call_time'])}
+
+        # Usage rollups, maintained in the same transaction as the raw api calls
+        rollups = {}
+        totals = {}
+        for row in rows.values():
+            for granularity in ApiCallRollup._all_granularities:
+                key = (granularity, ApiCallRollup.truncate(row['call_time'], granularity), row['model_name'], row['user_id'])
+                rollups[key] = rollups.get(key, 0) + row['calls']
+
+            calls, last_call_time = totals.get(row['model_name'], (0, row['call_time']))
+            totals[row['model_name']] = (calls + row['calls'], max(last_call_time, row['call_time']))
+
+        rollup_table = ApiCallRollup.__table__
+        rollup_upsert = insert(rollup_table)
+        rollup_upsert = rollup_upsert.on_conflict_do_update(
+            index_elements=[rollup_table.c.granularity, rollup_table.c.bucket, rollup_table.c.model_name, rollup_table.c.user_id],
+            set_={'calls': rollup_table.c.calls + rollup_upsert.excluded.calls})
+
+        total_table = ApiCallModelTotal.__table__
+        total_upsert = insert(total_table)
+        total_upsert = total_upsert.on_conflict_do_update(
+            index_elements=[total_table.c.model_name],
+            set_={'calls': total_table.c.calls + total_upsert.excluded.calls,
+                  'last_call_time': func.greatest(total_table.c.last_call_time, total_upsert.excluded.last_call_time)})
+
+        batch_insert = insert(ApiCallBatch.__table__).on_conflict_do_nothing(index_elements=[ApiCallBatch.__table__.c.id])
+
+        with engine.begin() as connection:
+            if connection.execute(batch_insert, {'id': batch_id, 'written_at': datetime.now()}).rowcount == 0:
+                print(f'[INFO] ApiCallService.write_events - batch {batch_id} was already written')
+                return
+
+            # executemany
+            connection.execute(ApiCall.__table__.insert(), list(rows.values()))
+            connection.execute(rollup_upsert,
+                               [{'granularity': k[0], 'bucket': k[1], 'model_name': k[2], 'user_id': k[3], 'calls': v}
+                                for k, v in rollups.items()])
+            connection.execute(total_upsert,
+                               [{'model_name': k, 'calls': v[0], 'last_call_time': v[1]} for k, v in totals.items()])
+
+        print(f'[DEBUG] ApiCallService.write_events - wrote {len(rows)} rows from {len(events)} events')
+
     @staticmethod
     def get_model_count(model_name: str) -> Result:
         ''' Get total number of API call for a model version
@@ -86,9 +150,9 @@ class ApiCallService:
         :return: a Result object with the total count of API calls
         '''
         try:
-            qr = session.query(func.count(ApiCall.model_name)).filter(ApiCall.model_name == model_name)
+            qr = read_session.query(ApiCallModelTotal.calls).filter(ApiCallModelTotal.model_name == model_name)
 
-            count = qr.scalar()
+            count = qr.scalar() or 0
             return Result(
                 Result.SUCCESS,
                 f"Successfully counted the number of api calls from model with name '{model_name}'.",
@@ -104,6 +168,97 @@ class ApiCallService:
                 Result.EXCEPTION
             )
 
+    @staticmethod
+    async def get_models_count_async(model_names: List[str]) -> Result:
+        ''' Get total number of API calls of several models in a single query
+
+        :param model_names: list of model names
+
+        :return: a Result object, on success Result.data is a dict {<model name>: <count>}
+        '''
+        try:
+            counts = {model_name: 0 for model_name in model_names}
+            if len(model_names) > 0:
+                rows = await database.fetch_all(select([ApiCallModelTotal.model_name, ApiCallModelTotal.calls])
+                                                .where(ApiCallModelTotal.model_name.in_(model_names)))
+
+                counts.update({row['model_name']: row['calls'] for row in rows})
+
+            return Result(
+                Result.SUCCESS,
+                f"Successfully counted the number of api calls of {len(model_names)} models.",
+                counts
+            )
+        except Exception as e:
+            print(f'[EXCEPTION] ApiCallService.get_models_count_async. Exception: {e}')
+            return Result(
+                Result.FAIL,
+                f"Failed to count the number of api calls of models.",
+                Result.EXCEPTION
+            )
+
+    @staticmethod
+    def delete_expired_usage() -> Result:
+        ''' Delete minute and hour rollups, and metering batch ids, older than their retention. Rollups are written at
+        every granularity, thus expired buckets are still counted by the coarser ones; day rollups are kept
+
+        :return: a Result object, on success Result.data is a dict {<granularity or 'batches'>: <deleted rows>}
+        '''
+        try:
+            now = datetime.now()
+            retention = {ApiCallRollup.MINUTE: METERING_CONFIG['minute_rollup_retention'],
+                         ApiCallRollup.HOUR: METERING_CONFIG['hour_rollup_retention']}
+            deleted = {}
+
+            with engine.begin() as connection:
+                for granularity, days in retention.items():
+                    deleted[granularity] = connection.execute(
+                        ApiCallRollup.__table__.delete()
+                        .where(ApiCallRollup.granularity == granularity)
+                        .where(ApiCallRollup.bucket < now - timedelta(days=days))).rowcount
+
+                deleted['batches'] = connection.execute(
+                    ApiCallBatch.__table__.delete()
+                    .where(ApiCallBatch.written_at < now - timedelta(days=METERING_CONFIG['batch_retention']))).rowcount
+
+            print(f'[INFO] ApiCallService.delete_expired_usage - deleted {deleted}')
+
+            return Result(
+                Result.SUCCESS,
+                'Successfully deleted expired usage rollups',
+                deleted
+            )
+        except Exception as e:
+            print(f'[EXCEPTION] ApiCallService.delete_expired_usage. Exception: {e}')
+            return Result(
+                Result.FAIL,
+                'Failed to delete expired usage rollups',
+                Result.EXCEPTION
+            )
+
+    @staticmethod
+    def get_rollup_granularity(sample: str) -> str:
+        ''' Get the coarsest rollup granularity that a pandas resample rule can be computed from. Minute and hour
+        rollups only cover their retention; see delete_expired_usage
+
+        :param sample: a pandas resample rule; e.g. 'D', 'W', 'M', '1Min', '6H'
+
+        :return: ApiCallRollup granularity
+        '''
+        from pandas.tseries.frequencies import to_offset
+        from pandas.tseries.offsets import Tick
+
+        offset = to_offset(sample)
+        if not isinstance(offset, Tick):
+            # calendar rules: weeks, months, years...
+            return ApiCallRollup.DAY
+        if offset.nanos % (24 * 3600 * 10**9) == 0:
+            return ApiCallRollup.DAY
+        if offset.nanos % (3600 * 10**9) == 0:
+            return ApiCallRollup.HOUR
+
+        return ApiCallRollup.MINUTE
+
     @staticmethod
     def count_by(model_name: str, sample='D') -> Result:
         ''' Count number of api calls of model by day, week or month sample (or whatever)
@@ -122,15 +277,21 @@ class ApiCallService:
         '''
         try:
             import pandas as pd
-            # TODO can count==0?
-            qr = session.query(ApiCall).filter(ApiCall.model_name == model_name)
 
-            table = pd.read_sql_query(qr.statement,
-                                      session.bind,
-                                      index_col='call_time',
-                                      parse_dates=['call_time'])  # , chunksize=<n_rows>
-            sampled_count = table['id'].resample(sample).count().to_json()
-            distinct_users_count = table['user_id'].nunique()
+            # Read the coarsest rollup the sample can be computed from
+            granularity = ApiCallService.get_rollup_granularity(sample)
+            rows = read_session.query(ApiCallRollup.bucket, func.sum(ApiCallRollup.calls).label('calls')) \
+                .filter(ApiCallRollup.granularity == granularity, ApiCallRollup.model_name == model_name) \
+                .group_by(ApiCallRollup.bucket) \
+                .all()
+
+            table = pd.DataFrame(rows, columns=['bucket', 'calls'])
+            table.index = pd.to_datetime(table['bucket'])
+            sampled_count = table['calls'].astype('int64').resample(sample).sum().to_json()
+
+            distinct_users_count = read_session.query(func.count(func.distinct(ApiCallRollup.user_id))) \
+                .filter(ApiCallRollup.granularity == ApiCallRollup.DAY, ApiCallRollup.model_name == model_name) \
+                .scalar()
 
             return Result(
                 Result.SUCCESS,
@@ -226,20 +387,20 @@ class ApiCallService:
             page_number += 1
             offset = results_per_page * page_number - results_per_page
 
-            query_result = session.query(ApiCall.model_name, func.count(ApiCall.model_name).label('model_name_count')) \
-                .filter(ApiCall.model_name.ilike(f'%{search_query}%')) \
-                .group_by(ApiCall.model_name) \
-                .order_by(func.count(ApiCall.model_name).desc()) \
+            query_result = read_session.query(ApiCallModelTotal.model_name, ApiCallModelTotal.calls.label('model_name_count')) \
+                .filter(ApiCallModelTotal.model_name.ilike(f'%{search_query}%')) \
+                .order_by(ApiCallModelTotal.calls.desc(), ApiCallModelTotal.model_name) \
                 .offset(offset) \
                 .limit(results_per_page) \
                 .all()
 
-            most_popular_models = []
-            for qr in query_result:
-                registered_model = MLflowService.get_model(model_name=qr[0])  # , version = qr[1])
-
-                if registered_model.is_success():
-                    most_popular_models.append(registered_model.data)
+            # Fetch the page's registered models at once, keeping the popularity order
+            model_names = [qr[0] for qr in query_result]
+            registered_models = {m.name: m for m in
+                                 read_session.query(RegisteredModel).filter(RegisteredModel.name.in_(model_names)).all()} \
+                if len(model_names) > 0 else {}
+            most_popular_models = MLflowService.get_registered_model_entities(
+                [registered_models[name] for name in model_names if name in registered_models])
 
             return Result(
                 Result.SUCCESS,
@@ -312,26 +473,10 @@ class ApiCallService:
                 Result.EXCEPTION
             )
 
-    @staticmethod
-    def get_user_calls_count(user_id: int) -> Result:
-        ''' Get total number of API call for a user
-
-        :param user_id: the user's id
-        
-        :return: a Result object with the total count of API calls for user
-        '''
-        try:
-            results = session.query(ApiCall).filter(ApiCall.user_id == user_id).count()
 
-            return Result(
-                Result.SUCCESS,
-                f"Successfully counted the number of api calls",
-                results
-            )
-        except Exception as e:
-            print(f'[EXCEPTION] ApiCallService.get_user_calls_count. Exception: {e}')
-            return Result(
-                Result.FAIL,
-                f"Failed to count the number of api calls",
-                Result.EXCEPTION
-            )
+# Usage events are spooled locally and bulk inserted by a background flusher
+metering_queue = MeteringQueue(METERING_CONFIG['spool_dir'],
+                               writer=ApiCallService.write_events,
+                               flush_interval=METERING_CONFIG['flush_interval'],
+                               flush_size=METERING_CONFIG['flush_size'],
+                               max_attempts=METERING_CONFIG['max_attempts'])
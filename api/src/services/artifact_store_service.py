@@ -0,0 +1,130 @@
+'''
+Content-addressed store of logged artifact files.
+
+MLflow resolves a model's artifacts under its run's artifact path, thus every version needs its own objects. Files
+are indexed by sha256 in artifact_blobs, with the URI of their first stored copy; when a model upload logs a file that
+is already stored, the object is copied server side by S3 instead of being uploaded again by the upload server.
+'''
+import hashlib
+import os
+
+from botocore.exceptions import ClientError
+from mlflow.store.artifact.artifact_repository_registry import _artifact_repository_registry
+from mlflow.store.artifact.s3_artifact_repo import S3ArtifactRepository
+from sqlalchemy.exc import IntegrityError
+
+from config.config import MODEL_UPLOAD_SERVICE_CONFIG
+from db.db_config import session
+from models.artifact_blob import ArtifactBlob
+from models.result import Result
+
+
+class ArtifactStoreService:
+
+    @staticmethod
+    def get_file_hash(path: str) -> str:
+        file_hash = hashlib.sha256()
+        with open(path, 'rb') as file:
+            for chunk in iter(lambda: file.read(1024 * 1024), b''):
+                file_hash.update(chunk)
+
+        return file_hash.hexdigest()
+
+    @staticmethod
+    def get_blob(sha256: str) -> Result:
+        ''' Get the stored copy of a file
+
+        :param sha256: the file's sha256
+
+        :return: Result object with ArtifactBlob data
+        '''
+        try:
+            blob = session.query(ArtifactBlob).filter(ArtifactBlob.sha256 == sha256).first()
+
+            if blob is None:
+                return Result(Result.FAIL,
+                              f'Artifact blob {sha256} was not found',
+                              Result.NOT_FOUND)
+
+            return Result(Result.SUCCESS,
+                          f'Successfully fetched artifact blob {sha256}',
+                          blob)
+        except Exception as e:
+            print(f'[EXCEPTION] Failed to fetch artifact blob {sha256}. Exception {e}')
+            session.rollback()
+            return Result(Result.FAIL,
+                          f'Failed to fetch artifact blob {sha256}',
+                          Result.EXCEPTION)
+
+    @staticmethod
+    def add_blob(sha256: str, size: int, uri: str) -> Result:
+        ''' Index the stored copy of a file; a concurrent upload of the same file may have indexed it first
+        '''
+        try:
+            blob = ArtifactBlob(sha256=sha256, size=size, uri=uri)
+            session.add(blob)
+            session.commit()
+
+            return Result(Result.SUCCESS,
+                          f'Created artifact blob {sha256}',
+                          blob)
+        except IntegrityError:
+            session.rollback()
+            return ArtifactStoreService.get_blob(sha256)
+        except Exception as e:
+            print(f'[EXCEPTION] Failed to create artifact blob {sha256}. Exception {e}')
+            session.rollback()
+            return Result(Result.FAIL,
+                          f'Failed to create artifact blob {sha256}',
+                          Result.EXCEPTION)
+
+    @staticmethod
+    def delete_blob(sha256: str) -> None:
+        try:
+            session.query(ArtifactBlob).filter(ArtifactBlob.sha256 == sha256).delete()
+            session.commit()
+        except Exception as e:
+            print(f'[EXCEPTION] Failed to delete artifact blob {sha256}. Exception {e}')
+            session.rollback()
+
+    @staticmethod
+    def install() -> None:
+        ''' Log s3 artifacts of this process through DedupS3ArtifactRepository
+        '''
+        if MODEL_UPLOAD_SERVICE_CONFIG['dedupe_artifacts']:
+            print('[INFO] Deduplicating s3 artifacts by content')
+            _artifact_repository_registry.register('s3', DedupS3ArtifactRepository)
+
+
+class DedupS3ArtifactRepository(S3ArtifactRepository):
+    ''' S3 artifact repository that copies files already stored, server side, instead of uploading them
+    '''
+
+    def _upload_file(self, s3_client, local_file: str, bucket: str, key: str) -> None:
+        size = os.path.getsize(local_file)
+        if size < MODEL_UPLOAD_SERVICE_CONFIG['dedupe_min_size']:
+            super()._upload_file(s3_client, local_file, bucket, key)
+            return
+
+        sha256 = ArtifactStoreService.get_file_hash(local_file)
+        blob_result = ArtifactStoreService.get_blob(sha256)
+        if blob_result.is_success() and blob_result.data.size == size:
+            source_bucket, source_key = DedupS3ArtifactRepository.parse_uri(blob_result.data.uri)
+            try:
+                # Managed copy; multipart for objects over 5 GB
+                s3_client.copy({'Bucket': source_bucket, 'Key': source_key}, bucket, key)
+                print(f'[DEBUG] DedupS3ArtifactRepository - copied {key} from {blob_result.data.uri}')
+                return
+            except ClientError as e:
+                # e.g. the stored copy was deleted; the new upload becomes the stored copy
+                print(f'[WARN] DedupS3ArtifactRepository - failed to copy {blob_result.data.uri}: {e}')
+                ArtifactStoreService.delete_blob(sha256)
+
+        super()._upload_file(s3_client, local_file, bucket, key)
+        ArtifactStoreService.add_blob(sha256, size, f's3://{bucket}/{key}')
+
+    @staticmethod
+    def parse_uri(uri: str) -> tuple:
+        bucket, _, key = uri[len('s3://'):].partition('/')
+
+        return bucket, key
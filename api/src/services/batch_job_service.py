@@ -0,0 +1,434 @@
+import asyncio
+import os
+import time
+import uuid
+from collections import deque
+from datetime import datetime, timedelta
+from typing import BinaryIO, Iterator, List, Optional, Set
+
+import pandas as pd
+from sqlalchemy import func
+import libs.prediction_decoder as PredictionDecoder
+import schemas.api_call as ApiCallSchema
+from config.config import BATCH_JOB_SERVICE_CONFIG
+from db.async_db import run_blocking
+from db.db_config import session, begin_session_scope, end_session_scope
+from models.batch_job import BatchJob
+from models.result import Result
+from services.api_call_service import ApiCallService
+
+
+class BatchJobService:
+    ''' Batch scoring jobs.
+
+    The API stores the input file in the shared cache directory and queues a job. Prediction server processes poll
+    for queued jobs, claim them and score their input in chunks on the model pool; predictions are written, in input
+    order, to a CSV file that is downloaded once the job finished. A job is metered as a single batch of api calls.
+    '''
+    JOBS_DIR: str = BATCH_JOB_SERVICE_CONFIG['jobs_dir']
+    MAX_INPUT_SIZE: int = BATCH_JOB_SERVICE_CONFIG['max_input_size'] * 1024 * 1024
+    CHUNK_SIZE: int = BATCH_JOB_SERVICE_CONFIG['chunk_size']
+    CHUNK_CONCURRENCY: int = BATCH_JOB_SERVICE_CONFIG['chunk_concurrency']
+    MAX_CONCURRENT_JOBS: int = BATCH_JOB_SERVICE_CONFIG['max_concurrent_jobs']
+    HEARTBEAT_INTERVAL: int = BATCH_JOB_SERVICE_CONFIG['heartbeat_interval']
+    STALE_TIMEOUT: int = BATCH_JOB_SERVICE_CONFIG['stale_timeout']
+    MAX_ATTEMPTS: int = BATCH_JOB_SERVICE_CONFIG['max_attempts']
+    PROGRESS_RESOLUTION: int = 1 # min. time (seconds) between progress updates of a job in the database
+    RUNNING: Set[int] = set() # ids of the jobs run by this process
+    last_heartbeat: float = 0 # time (monotonic) of the last heartbeat of the jobs run by this process
+
+    @staticmethod
+    def get_input_format(filename: str) -> Optional[str]:
+        ''' Get input format from a file name
+
+        :param filename: name of the uploaded file
+
+        :return: BatchJob.CSV or BatchJob.PARQUET; None if format is not supported
+        '''
+        extension = os.path.splitext(filename or '')[1].lower()
+        if extension == '.csv':
+            return BatchJob.CSV
+        if extension in ('.parquet', '.pq'):
+            return BatchJob.PARQUET
+
+        return None
+
+    @staticmethod
+    def create(user_id: int, model_name: str, model_version: int, input_format: str, file: BinaryIO) -> Result:
+        ''' Store an input file and queue its batch job
+
+        :param user_id: id of the job's owner
+        :param model_name: name of the registered model
+        :param model_version: version of the model
+        :param input_format: BatchJob.CSV or BatchJob.PARQUET
+        :param file: the input file
+
+        :return: a Result object, on success Result.data is the BatchJob
+        '''
+        job_dir = os.path.join(BatchJobService.JOBS_DIR, uuid.uuid4().hex)
+        input_path = os.path.join(job_dir, f'input.{input_format}')
+        try:
+            os.makedirs(job_dir, exist_ok=True)
+            size = 0
+            with open(input_path, 'wb') as f:
+                while True:
+                    chunk = file.read(1024 * 1024)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                    if size > BatchJobService.MAX_INPUT_SIZE:
+                        f.close()
+                        BatchJobService.remove_files(input_path)
+                        return Result(Result.FAIL,
+                                      f'Input file exceeds max. size of {BATCH_JOB_SERVICE_CONFIG["max_input_size"]} MB',
+                                      Result.NOT_ACCEPTABLE)
+                    f.write(chunk)
+
+            batch_job = BatchJob(user_id=user_id,
+                                 model_name=model_name,
+                                 model_version=model_version,
+                                 input_format=input_format,
+                                 input_path=input_path,
+                                 status=BatchJob.QUEUED)
+            session.add(batch_job)
+            session.commit()
+
+            return Result(Result.SUCCESS,
+                          'Queued batch job',
+                          batch_job)
+        except Exception as e:
+            session.rollback()
+            BatchJobService.remove_files(input_path)
+            print(f'[EXCEPTION] Could not create batch job for model ({model_name}, {model_version}). Exception {e}')
+            return Result(Result.FAIL,
+                          'Failed to create batch job',
+                          Result.EXCEPTION)
+
+    @staticmethod
+    def remove_files(input_path: str) -> None:
+        ''' Remove the files of a job
+        '''
+        job_dir = os.path.dirname(input_path)
+        for file in os.listdir(job_dir) if os.path.isdir(job_dir) else []:
+            os.remove(os.path.join(job_dir, file))
+        if os.path.isdir(job_dir):
+            os.rmdir(job_dir)
+
+    @staticmethod
+    def get_by_id(id: int) -> Result:
+        ''' Get batch job by id
+
+        :param id: record id
+
+        :return: Result object with BatchJob data
+        '''
+        try:
+            batch_job = session.query(BatchJob).filter(BatchJob.id == id).first()
+
+            if batch_job is None:
+                return Result(Result.FAIL,
+                              f'Batch job with id {id} was not found',
+                              Result.NOT_FOUND)
+
+            return Result(Result.SUCCESS,
+                          f'Successfully fetched batch job with id {id}',
+                          batch_job)
+        except Exception as e:
+            print(f'[EXCEPTION] Failed to fetch batch job with id {id}. Exception {e}')
+            return Result(Result.FAIL,
+                          f'Failed to fetch batch job with id {id}',
+                          Result.EXCEPTION)
+
+    @staticmethod
+    def list(user_id: int, status: Optional[str] = None) -> Result:
+        ''' List batch jobs of a user, most recent first
+
+        :param user_id: the user's id
+        :param status: (optional) job status
+
+        :return: Result object with list of BatchJob data
+        '''
+        try:
+            assert status is None or BatchJob.is_valid_status(status), f"Bad status value '{status}'"
+
+            query = session.query(BatchJob).filter(BatchJob.user_id == user_id)
+            if status is not None:
+                query = query.filter(BatchJob.status == status)
+
+            return Result(Result.SUCCESS,
+                          'Successfully fetched batch jobs',
+                          query.order_by(BatchJob.id.desc()).all())
+        except Exception as e:
+            print(f'[EXCEPTION] Failed to list batch jobs. Exception {e}')
+            return Result(Result.FAIL,
+                          'Failed to list batch jobs',
+                          Result.EXCEPTION)
+
+    @staticmethod
+    def update(id: int, **values) -> None:
+        ''' Update columns of a batch job; e.g. update(id, status=BatchJob.FAILED, error='...')
+        '''
+        try:
+            session.query(BatchJob).filter(BatchJob.id == id).update(values, synchronize_session=False)
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            print(f'[EXCEPTION] Failed to update batch job with id {id}. Exception {e}')
+
+    @staticmethod
+    def claim_queued(limit: int) -> List[BatchJob]:
+        ''' Claim queued jobs, oldest first. A job is claimed by a single process: the status update only succeeds
+        if the job is still queued
+
+        :param limit: max number of jobs to claim
+
+        :return: list of claimed BatchJob
+        '''
+        claimed = []
+        try:
+            queued = session.query(BatchJob.id) \
+                .filter(BatchJob.status == BatchJob.QUEUED) \
+                .order_by(BatchJob.id) \
+                .limit(limit) \
+                .all()
+
+            for (id,) in queued:
+                updated = session.query(BatchJob) \
+                    .filter(BatchJob.id == id, BatchJob.status == BatchJob.QUEUED) \
+                    .update({'status': BatchJob.RUNNING,
+                             'started_at': datetime.now(),
+                             'heartbeat_at': None,
+                             'attempts': BatchJob.attempts + 1,
+                             'total_rows': None,
+                             'processed_rows': 0},
+                            synchronize_session=False)
+                session.commit()
+                if updated == 1:
+                    claimed.append(session.query(BatchJob).filter(BatchJob.id == id).first())
+        except Exception as e:
+            session.rollback()
+            print(f'[EXCEPTION] Failed to claim queued batch jobs. Exception {e}')
+
+        return claimed
+
+    @staticmethod
+    def heartbeat(ids: List[int]) -> None:
+        ''' Record a heartbeat of running jobs; jobs without heartbeats are recovered by recover_stale
+
+        :param ids: ids of the jobs run by this process
+        '''
+        try:
+            session.query(BatchJob) \
+                .filter(BatchJob.id.in_(ids), BatchJob.status == BatchJob.RUNNING) \
+                .update({'heartbeat_at': datetime.now()}, synchronize_session=False)
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            print(f'[EXCEPTION] Failed to record heartbeat of batch jobs {ids}. Exception {e}')
+
+    @staticmethod
+    def recover_stale(stale_timeout: int, max_attempts: int) -> None:
+        ''' Recover running jobs without heartbeats for stale_timeout seconds, e.g. their prediction server process
+        stopped. Jobs are queued again unless they ran max_attempts times or their input file is gone
+
+        :param stale_timeout: time (seconds) without heartbeats
+        :param max_attempts: max number of runs of a job
+        '''
+        try:
+            threshold = datetime.now() - timedelta(seconds=stale_timeout)
+            stale = session.query(BatchJob) \
+                .filter(BatchJob.status == BatchJob.RUNNING,
+                        func.coalesce(BatchJob.heartbeat_at, BatchJob.started_at) < threshold) \
+                .with_for_update(skip_locked=True) \
+                .all()
+
+            for batch_job in stale:
+                batch_job.heartbeat_at = None
+                if batch_job.attempts < max_attempts and os.path.exists(batch_job.input_path):
+                    print(f'[WARN] Queueing stale batch job with id {batch_job.id} again')
+                    batch_job.status = BatchJob.QUEUED
+                else:
+                    print(f'[WARN] Failing stale batch job with id {batch_job.id}')
+                    batch_job.status = BatchJob.FAILED
+                    batch_job.error = 'Prediction server stopped while running the job'
+                    batch_job.finished_at = datetime.now()
+
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            print(f'[EXCEPTION] Failed to recover stale batch jobs. Exception {e}')
+
+    @staticmethod
+    def count_rows(input_path: str, input_format: str) -> int:
+        ''' Count the rows of an input file; CSV rows are counted by lines, thus used for progress only
+        '''
+        if input_format == BatchJob.PARQUET:
+            import pyarrow.parquet as pq
+            return pq.ParquetFile(input_path).metadata.num_rows
+
+        with open(input_path, 'rb') as f:
+            lines = sum(chunk.count(b'\n') for chunk in iter(lambda: f.read(1024 * 1024), b''))
+
+        # header line
+        return max(lines - 1, 0)
+
+    @staticmethod
+    def read_chunks(input_path: str, input_format: str, chunk_size: int) -> Iterator[pd.DataFrame]:
+        ''' Read an input file in chunks of chunk_size rows
+        '''
+        if input_format == BatchJob.PARQUET:
+            import pyarrow.parquet as pq
+            for batch in pq.ParquetFile(input_path).iter_batches(batch_size=chunk_size):
+                yield batch.to_pandas()
+        else:
+            for chunk in pd.read_csv(input_path, chunksize=chunk_size):
+                yield chunk
+
+    @staticmethod
+    def to_data_frame(decoded: PredictionDecoder.DecodedPredictions) -> pd.DataFrame:
+        ''' Convert decoded predictions to a DataFrame; 1D predictions are named 'prediction'
+        '''
+        if decoded.kind == PredictionDecoder.DecodedPredictions.SPLIT:
+            return pd.DataFrame(decoded.predictions['data'], columns=decoded.predictions['columns'])
+        if decoded.kind == PredictionDecoder.DecodedPredictions.RECORDS:
+            return pd.DataFrame(decoded.predictions)
+        if len(decoded.predictions) > 0 and isinstance(decoded.predictions[0], list):
+            return pd.DataFrame(decoded.predictions).add_prefix('prediction_')
+
+        return pd.DataFrame({'prediction': decoded.predictions})
+
+    @staticmethod
+    async def score_chunk(model_serving, model_name: str, model_version: int, chunk: pd.DataFrame) -> pd.DataFrame:
+        ''' Score a chunk of rows on the model pool; raises Exception on failure
+        '''
+        # serve per chunk: keeps the model live and restarts it if it was evicted during the job
+        serve_result = await model_serving.serve(model_name, model_version)
+        if serve_result.is_fail():
+            raise Exception(serve_result.message)
+
+        body = chunk.to_json(orient='split', index=False).encode('utf-8')
+        status, result = await model_serving.invoke_raw(serve_result.data['port'], serve_result.data['path'], body)
+
+        error = PredictionDecoder.get_error(result)
+        if error is not None or status != 200:
+            raise Exception(error.message if error is not None else f'Model returned status {status}')
+
+        decoded = PredictionDecoder.decode(result)
+        if len(decoded) != len(chunk):
+            raise Exception(f'Model returned {len(decoded)} predictions for {len(chunk)} rows')
+
+        return BatchJobService.to_data_frame(decoded)
+
+    @staticmethod
+    async def run(model_serving, job: BatchJob) -> None:
+        ''' Score a claimed job. Chunks are scored concurrently and written in input order
+
+        :param model_serving: the process' ModelServingService
+        :param job: a claimed BatchJob
+        '''
+        loop = asyncio.get_event_loop()
+        # job's attributes expire on every commit; read them once
+        job_id, user_id, model_name, model_version = job.id, job.user_id, job.model_name, int(job.model_version)
+        input_path, input_format = job.input_path, job.input_format
+        output_path = os.path.join(os.path.dirname(input_path), 'predictions.csv')
+        part_path = f'{output_path}.part'
+        processed_rows = 0
+        pending = deque()
+        print(f'[INFO] Running batch job {job_id} for model ({model_name}, {model_version})')
+
+        try:
+            total_rows = await loop.run_in_executor(None, BatchJobService.count_rows, input_path, input_format)
+            await run_blocking(BatchJobService.update, job_id, total_rows=total_rows)
+
+            chunks = BatchJobService.read_chunks(input_path, input_format, BatchJobService.CHUNK_SIZE)
+            last_update = time.monotonic()
+
+            with open(part_path, 'w') as out:
+                async def write_next():
+                    nonlocal processed_rows, last_update
+                    predictions = await pending.popleft()
+                    await loop.run_in_executor(None, lambda: predictions.to_csv(out, header=(processed_rows == 0), index=False))
+                    processed_rows += len(predictions)
+
+                    if time.monotonic() - last_update >= BatchJobService.PROGRESS_RESOLUTION:
+                        await run_blocking(BatchJobService.update, job_id, processed_rows=processed_rows)
+                        last_update = time.monotonic()
+
+                while True:
+                    chunk = await loop.run_in_executor(None, next, chunks, None)
+                    if chunk is None:
+                        break
+                    pending.append(asyncio.ensure_future(BatchJobService.score_chunk(model_serving, model_name, model_version, chunk)))
+
+                    if len(pending) >= BatchJobService.CHUNK_CONCURRENCY:
+                        await write_next()
+
+                while len(pending) > 0:
+                    await write_next()
+
+            os.replace(part_path, output_path)
+            await run_blocking(BatchJobService.update,
+                               job_id,
+                               status=BatchJob.FINISHED,
+                               output_path=output_path,
+                               total_rows=processed_rows,
+                               processed_rows=processed_rows,
+                               finished_at=datetime.now())
+            print(f'[INFO] Batch job {job_id} finished; {processed_rows} rows scored')
+
+        except Exception as e:
+            print(f'[EXCEPTION] Batch job {job_id} failed. Exception: {e}')
+            for task in pending:
+                task.cancel()
+            if os.path.exists(part_path):
+                os.remove(part_path)
+            await run_blocking(BatchJobService.update,
+                               job_id,
+                               status=BatchJob.FAILED,
+                               error=str(e)[:1024],
+                               processed_rows=processed_rows,
+                               finished_at=datetime.now())
+
+        # Meter the rows scored, in aggregate
+        if processed_rows > 0:
+            api_call_create = ApiCallSchema.ApiCallCreate(user_id=user_id,
+                                                          model_name=model_name,
+                                                          model_version=model_version)
+            _ = await run_blocking(ApiCallService.create_batch, api_call_create, processed_rows)
+
+    @staticmethod
+    async def run_queued(model_serving) -> None:
+        ''' Record a heartbeat of the jobs run by the process and recover stale jobs; then claim queued jobs up to the
+        max. number of concurrent jobs of the process and run them in background
+
+        :param model_serving: the process' ModelServingService
+        '''
+        async def run_in_session_scope(job: BatchJob) -> None:
+            # jobs run concurrently; each one gets its own database session
+            token = begin_session_scope()
+            try:
+                await BatchJobService.run(model_serving, job)
+            finally:
+                end_session_scope(token)
+
+        # Database calls run in the bounded thread pool, with the context's session scope; they must not block
+        # live predictions
+        jobs = []
+        token = begin_session_scope()
+        try:
+            if time.monotonic() - BatchJobService.last_heartbeat >= BatchJobService.HEARTBEAT_INTERVAL:
+                if len(BatchJobService.RUNNING) > 0:
+                    await run_blocking(BatchJobService.heartbeat, list(BatchJobService.RUNNING))
+                await run_blocking(BatchJobService.recover_stale, BatchJobService.STALE_TIMEOUT, BatchJobService.MAX_ATTEMPTS)
+                BatchJobService.last_heartbeat = time.monotonic()
+
+            available = BatchJobService.MAX_CONCURRENT_JOBS - len(BatchJobService.RUNNING)
+            if available > 0:
+                jobs = await run_blocking(BatchJobService.claim_queued, available)
+        finally:
+            end_session_scope(token)
+
+        for job in jobs:
+            BatchJobService.RUNNING.add(job.id)
+            task = asyncio.ensure_future(run_in_session_scope(job))
+            task.add_done_callback(lambda _, job_id=job.id: BatchJobService.RUNNING.discard(job_id))
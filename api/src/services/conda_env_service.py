@@ -0,0 +1,179 @@
+import asyncio
+import fcntl
+import os
+import shutil
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict
+from dotenv import load_dotenv
+from mlflow.utils import conda
+from config.config import CONDA_ENV_SERVICE_CONFIG
+from libs.shared_store import SharedStore
+from models.result import Result
+from services.mlflow_service import MLflowService
+
+# This is needed; set mlflow tracking uri to MLFLOW_TRACKING_URI
+load_dotenv()
+
+
+class CondaEnvService:
+    ''' Resolves and prepares the conda environments of model versions
+
+    Resolved environments are cached per (model, version) in a store shared by the servers of the host:
+        {'envs': {'<name>/<version>': {'env_name': <str>, 'conda_env_path': <str>, 'prepared': <bool>, 'resolved_at': <float>}}}
+    Model versions' artifacts are immutable, thus entries are only dropped when a version is deleted or transitioned.
+    '''
+    CACHE: SharedStore = SharedStore(CONDA_ENV_SERVICE_CONFIG['cache_path'], {'envs': {}})
+    ENV_FILES_DIR: str = CONDA_ENV_SERVICE_CONFIG['env_files_dir']
+
+    LOCKS: Dict[str, threading.Lock] = {}  # env. name: lock; serializes env. creation within the process
+    LOCKS_LOCK: threading.Lock = threading.Lock()
+
+    @staticmethod
+    def get_key(name: str, version: int) -> str:
+        return f'{name}/{version}'
+
+    @staticmethod
+    def get_python_path(env_name: str) -> str:
+        ''' Get the python interpreter of a conda environment
+        '''
+        return os.path.join(os.environ.get('MLFLOW_CONDA_HOME'), 'envs', env_name, 'bin', 'python')
+
+    @staticmethod
+    def __to_env(entry: dict) -> dict:
+        return {'env_name': entry['env_name'],
+                'conda_env_path': entry['conda_env_path'],
+                'python_path': CondaEnvService.get_python_path(entry['env_name'])}
+
+    @staticmethod
+    @contextmanager
+    def __env_lock(env_name: str):
+        ''' Lock env. creation across threads and processes sharing the envs directory
+        '''
+        with CondaEnvService.LOCKS_LOCK:
+            if env_name not in CondaEnvService.LOCKS:
+                CondaEnvService.LOCKS[env_name] = threading.Lock()
+            thread_lock = CondaEnvService.LOCKS[env_name]
+
+        with thread_lock:
+            with open(os.path.join(CondaEnvService.ENV_FILES_DIR, f'{env_name}.lock'), 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    @staticmethod
+    def resolve_env(name: str, version: int) -> Result:
+        ''' Resolve model version's conda environment; artifacts are only downloaded on cache miss
+
+        :param name: model name
+        :param version: model version
+
+        :return: Result object: data is {'env_name': <str>, 'conda_env_path': <str>, 'python_path': <str>} on success
+        '''
+        try:
+            key = CondaEnvService.get_key(name, version)
+            entry = CondaEnvService.CACHE.read()['envs'].get(key)
+
+            if entry is not None and os.path.exists(entry['conda_env_path']):
+                return Result(Result.SUCCESS,
+                              'Resolved model conda env. from cache',
+                              CondaEnvService.__to_env(entry))
+
+            conda_env_path_result = MLflowService.get_conda_env_path(name, str(version))
+            if conda_env_path_result.is_fail():
+                return conda_env_path_result
+
+            # Env. name is a hash of the env. file's content; keep a copy: downloaded artifacts live in temp. dirs
+            env_name = conda._get_conda_env_name(conda_env_path_result.data, None)
+            os.makedirs(CondaEnvService.ENV_FILES_DIR, exist_ok=True)
+            conda_env_path = os.path.join(CondaEnvService.ENV_FILES_DIR, f'{env_name}.yaml')
+            shutil.copyfile(conda_env_path_result.data, conda_env_path)
+
+            with CondaEnvService.CACHE.transaction() as state:
+                entry = {'env_name': env_name,
+                         'conda_env_path': conda_env_path,
+                         'prepared': False,
+                         'resolved_at': datetime.now().timestamp()}
+                state['envs'][key] = entry
+
+            print(f"[DEBUG] CondaEnvService.resolve_env - resolved ({name}, {version}): '{env_name}'")
+
+            return Result(Result.SUCCESS,
+                          'Resolved model conda env.',
+                          CondaEnvService.__to_env(entry))
+
+        except Exception as e:
+            print(f'[EXCEPTION] Failed to resolve conda env. for model ({name}, {version}). Exception: {e}')
+            return Result(Result.FAIL,
+                          f'Failed to resolve conda env. for model ({name}, {version})',
+                          Result.EXCEPTION)
+
+    @staticmethod
+    def prepare_env(name: str, version: int) -> Result:
+        ''' Resolve and create, if it does not exist, model version's conda environment. Blocking
+
+        :param name: model name
+        :param version: model version
+
+        :return: Result object: data is {'env_name': <str>, 'conda_env_path': <str>, 'python_path': <str>} on success
+        '''
+        try:
+            env_result = CondaEnvService.resolve_env(name, version)
+            if env_result.is_fail():
+                return env_result
+
+            env = env_result.data
+            key = CondaEnvService.get_key(name, version)
+            entry = CondaEnvService.CACHE.read()['envs'].get(key)
+
+            # Env. may have been removed from the envs directory
+            if entry is not None and entry['prepared'] and os.path.exists(env['python_path']):
+                return env_result
+
+            with CondaEnvService.__env_lock(env['env_name']):
+                if not os.path.exists(env['python_path']):
+                    print(f"[INFO] Creating conda env. '{env['env_name']}' for model ({name}, {version})")
+                conda.get_or_create_conda_env(env['conda_env_path'])
+
+            with CondaEnvService.CACHE.transaction() as state:
+                if key in state['envs']:
+                    state['envs'][key]['prepared'] = True
+
+            return Result(Result.SUCCESS,
+                          'Prepared model conda env.',
+                          env)
+
+        except Exception as e:
+            print(f'[EXCEPTION] Failed to prepare conda env. for model ({name}, {version}). Exception: {e}')
+            return Result(Result.FAIL,
+                          f'Failed to prepare conda env. for model ({name}, {version})',
+                          Result.EXCEPTION)
+
+    @staticmethod
+    async def prepare_env_async(name: str, version: int) -> Result:
+        ''' Non-blocking prepare_env; runs in the event loop's default executor
+        '''
+        return await asyncio.get_event_loop().run_in_executor(None, CondaEnvService.prepare_env, name, version)
+
+    @staticmethod
+    def prepare_env_in_background(name: str, version: int) -> None:
+        ''' Prepare model version's conda environment in a daemon thread; e.g. after the model is registered
+        '''
+        def prepare():
+            result = CondaEnvService.prepare_env(name, version)
+            print(f'[INFO] Background conda env. preparation for model ({name}, {version}): {result.message}')
+
+        threading.Thread(target=prepare, name=f'prepare-env-{name}-{version}', daemon=True).start()
+
+    @staticmethod
+    def invalidate(name: str, version: int) -> None:
+        ''' Drop model version's cached conda environment. The environment itself is kept; it may be shared
+        '''
+        try:
+            with CondaEnvService.CACHE.transaction() as state:
+                state['envs'].pop(CondaEnvService.get_key(name, version), None)
+        except Exception as e:
+            print(f'[EXCEPTION] Failed to invalidate conda env. cache for model ({name}, {version}). Exception: {e}')
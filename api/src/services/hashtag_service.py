@@ -6,6 +6,9 @@ from models.result import Result
 from models.user import User
 from models.registered_model import RegisteredModel
 from models.registered_model_tag import RegisteredModelTag
+from typing import List
+from sqlalchemy import select
+from db.async_db import database
 
 
 class HashtagService:
@@ -263,6 +266,37 @@ class HashtagService:
                 Result.EXCEPTION
             )
 
+    @staticmethod
+    async def get_models_hashtags_async(model_names: List[str]) -> Result:
+        ''' Get hashtags of several models in a single query
+
+        :param model_names: list of model names
+
+        :return: a Result object, on success Result.data is a dict {<model name>: <collection of Hashtag dicts>}
+        '''
+        try:
+            models_hashtags = {model_name: [] for model_name in model_names}
+            if len(model_names) > 0:
+                rows = await database.fetch_all(select([ModelHashtag.model_name, Hashtag.__table__])
+                                                .select_from(ModelHashtag.__table__.join(Hashtag.__table__, Hashtag.id == ModelHashtag.hashtag_id))
+                                                .where(ModelHashtag.model_name.in_(model_names)))
+
+                for row in rows:
+                    models_hashtags[row['model_name']].append(Hashtag(id=row['id'], key=row['key'], value=row['value']).to_dict())
+
+            return Result(
+                Result.SUCCESS,
+                f"Successfully fetched hashtags for {len(model_names)} models.",
+                models_hashtags
+            )
+        except Exception as e:
+            print(f'[EXCEPTION] HashtagService.get_models_hashtags_async. Exception: {e}')
+            return Result(
+                Result.FAIL,
+                f"Failed to get hashtags for models.",
+                Result.EXCEPTION
+            )
+
     @staticmethod
     def get_models_with_hashtag(hashtag_id: int) -> Result:
         ''' Get models with query hashtag
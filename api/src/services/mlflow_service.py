@@ -1,14 +1,21 @@
 from dotenv import load_dotenv
-from typing import Optional, Dict, Any, Union
+from typing import Optional, Dict, Any, Union, List, Tuple
 import mlflow.pyfunc
+from mlflow.entities.model_registry import RegisteredModel as RegisteredModelEntity
+from mlflow.entities.model_registry import ModelVersion as ModelVersionEntity
+from mlflow.entities.model_registry import RegisteredModelTag as RegisteredModelTagEntity
 from models.model_version import ModelVersion
+from models.registered_model import RegisteredModel
 from models.result import Result
-from db.db_config import session
-from sqlalchemy import desc
+from db.db_config import session, read_session
+from sqlalchemy import desc, tuple_
 import yaml
 import json
+import base64
 from models.registered_model_tag import RegisteredModelTag
 import util.validation as Validation
+from libs.artifact_cache import ArtifactCache
+from config.config import ARTIFACT_CACHE_CONFIG
 
 # This is needed; set mlflow tracking uri to MLFLOW_TRACKING_URI
 load_dotenv()
@@ -22,6 +29,10 @@ class MLflowService:
 
     client = mlflow.tracking.MlflowClient()
 
+    artifact_cache = ArtifactCache(ARTIFACT_CACHE_CONFIG['cache_dir'],
+                                   max_disk_size=ARTIFACT_CACHE_CONFIG['max_disk_size'] * 1024 * 1024,
+                                   max_memory_size=ARTIFACT_CACHE_CONFIG['max_memory_size'] * 1024 * 1024)
+
     STAGING: str = 'Staging'
     PRODUCTION: str = 'Productions'
     ARCHIVED: str = 'Archived'
@@ -33,6 +44,7 @@ class MLflowService:
     GITHUB_REPO_TAG: str = 'github_repo'
     INPUT_EXAMPLE_TAG: str = 'input_example'
     SIGNATURE_TAG: str = 'signature'
+    PREDICTION_CACHE_TAG: str = 'prediction_cache' # 'true' if the model's predictions are deterministic and may be cached
 
     @staticmethod
     def _is_valid_stage(stage: str) -> bool:
@@ -45,6 +57,25 @@ class MLflowService:
 
         return stage == MLflowService.STAGING or stage == MLflowService.PRODUCTION or stage == MLflowService.ARCHIVED
 
+    @staticmethod
+    def _read_artifact(run_id: str, path: str) -> bytes:
+        """Read run artifact through the artifact cache; run artifacts are immutable
+
+        :param run_id: the run id
+        :param path: artifact path relative to the run's artifact root
+
+        :return: the artifact's content
+        """
+        return MLflowService.artifact_cache.get(run_id, path, MLflowService.client.download_artifacts)
+
+    @staticmethod
+    def _get_model_artifacts_path(run_id: str) -> str:
+        """Get path of the model artifacts from the run's shipped-brain.yaml
+        """
+        shipped_brain_yaml = yaml.full_load(MLflowService._read_artifact(run_id, "shipped-brain.yaml"))
+
+        return shipped_brain_yaml["model_artifacts_path"]
+
     @staticmethod
     def list_model_versions(model_name: str) -> Result:
         """List model versions
@@ -117,27 +148,120 @@ class MLflowService:
                           f"Failed to get model with name '{model_name}'",
                           Result.EXCEPTION)
 
+    @staticmethod
+    def encode_cursor(creation_time: int, name: str) -> str:
+        """Encode the position of a registered model in the search order as an opaque cursor token
+        """
+        return base64.urlsafe_b64encode(json.dumps([creation_time, name]).encode('utf-8')).decode('utf-8')
+
+    @staticmethod
+    def decode_cursor(cursor: str) -> Tuple[int, str]:
+        """Decode a cursor token; raises ValueError if token is not valid
+        """
+        try:
+            creation_time, name = json.loads(base64.urlsafe_b64decode(cursor.encode('utf-8')))
+            return int(creation_time), str(name)
+        except Exception:
+            raise ValueError(f"Invalid cursor '{cursor}'")
+
+    @staticmethod
+    def get_registered_model_entities(registered_models: List[RegisteredModel]) -> List[RegisteredModelEntity]:
+        """Build mlflow RegisteredModel entities from registered_models rows, fetching tags and latest versions
+        of all models in two queries
+
+        :param registered_models: list of RegisteredModel rows
+
+        :return: list of mlflow RegisteredModel entities in the input order
+        """
+        names = [registered_model.name for registered_model in registered_models]
+        if len(names) == 0:
+            return []
+
+        tags = {name: [] for name in names}
+        for tag in read_session.query(RegisteredModelTag).filter(RegisteredModelTag.name.in_(names)).all():
+            tags[tag.name].append(RegisteredModelTagEntity(tag.key, tag.value))
+
+        # Latest version per stage, as mlflow does; highest version first
+        latest_versions = {name: {} for name in names}
+        model_versions = read_session.query(ModelVersion) \
+            .filter(ModelVersion.name.in_(names), ModelVersion.current_stage != MLflowService.DELETED_STAGE) \
+            .order_by(ModelVersion.version.desc()) \
+            .all()
+        for model_version in model_versions:
+            if model_version.current_stage not in latest_versions[model_version.name]:
+                latest_versions[model_version.name][model_version.current_stage] = ModelVersionEntity(
+                    name=model_version.name,
+                    version=str(model_version.version),
+                    creation_timestamp=model_version.creation_time,
+                    last_updated_timestamp=model_version.last_updated_time,
+                    description=model_version.description,
+                    user_id=model_version.user_id,
+                    current_stage=model_version.current_stage,
+                    source=model_version.source,
+                    run_id=model_version.run_id,
+                    status=model_version.status,
+                    status_message=model_version.status_message,
+                    run_link=model_version.run_link)
+
+        return [RegisteredModelEntity(name=registered_model.name,
+                                      creation_timestamp=registered_model.creation_time,
+                                      last_updated_timestamp=registered_model.last_updated_time,
+                                      description=registered_model.description,
+                                      latest_versions=list(latest_versions[registered_model.name].values()),
+                                      tags=tags[registered_model.name])
+                for registered_model in registered_models]
+
     @staticmethod
     def search_models(model_name: str = '',
                       page_number: int = 1,
-                      results_per_page: int = 10) -> Result:
-        ''' Search for model versions by name in backend that satisfy the filter criteria [name]
+                      results_per_page: int = 10,
+                      cursor: Optional[str] = None) -> Result:
+        """ Search registered models by name, most recent first. Ordering and limits run in the database
+
+        Keyset pagination: pass the 'next_cursor' of a page to get the next one. Without cursor, page_number is used
 
         :param model_name: the name to perform search on, if None returns all
-        :param page_number: Page number to retrieve
+        :param page_number: Page number to retrieve; ignored if cursor is set
         :param results_per_page: Maximum number of registered models desired
+        :param cursor: (optional) cursor token of the last model of the previous page
 
-        :return: Result object containing list of models
-        '''
+        :return: Result object, on success data is {'models': <list of mlflow RegisteredModel>, 'next_cursor': <str or None>}
+        """
 
         try:
-            offset = results_per_page * page_number - results_per_page
-            results = MLflowService.client.search_registered_models(f"name ilike '%{model_name}%'")
+            query = read_session.query(RegisteredModel) \
+                .filter(RegisteredModel.name.ilike(f'%{model_name}%'))
+
+            if cursor is not None:
+                creation_time, name = MLflowService.decode_cursor(cursor)
+                query = query.filter(tuple_(RegisteredModel.creation_time, RegisteredModel.name) < tuple_(creation_time, name))
+            else:
+                query = query.offset(results_per_page * page_number - results_per_page)
+
+            # fetch one extra row to know if there is a next page
+            registered_models = query \
+                .order_by(RegisteredModel.creation_time.desc(), RegisteredModel.name.desc()) \
+                .limit(results_per_page + 1) \
+                .all()
+
+            next_cursor = None
+            if len(registered_models) > results_per_page:
+                registered_models = registered_models[:results_per_page]
+                next_cursor = MLflowService.encode_cursor(registered_models[-1].creation_time, registered_models[-1].name)
 
             return Result(
                 Result.SUCCESS,
                 'Searched models successfully',
-                results
+                {
+                    'models': MLflowService.get_registered_model_entities(registered_models),
+                    'next_cursor': next_cursor
+                }
+            )
+        except ValueError as e:
+            return Result(
+                Result.FAIL,
+                str(e),
+                Result.BAD_REQUEST
             )
         except Exception as e:
             print(f'[EXCEPTION] An error occurred while searching models with name like {model_name}. Error {e}')
@@ -224,6 +348,10 @@ class MLflowService:
                 MLflowService.client.transition_model_version_stage(name=model_name,
                                                                     version=str(version),
                                                                     stage=stage)
+
+                # Avoid circular import
+                from services.conda_env_service import CondaEnvService
+                CondaEnvService.invalidate(model_name, version)
             return Result(Result.SUCCESS,
                           f"Successfully transitioned model with name '{model_name}' and version {version} to '{stage}",
                           None)
@@ -260,6 +388,10 @@ class MLflowService:
             # Delete registered model. Backend raises exception if a registered model with given name does not exist
             MLflowService.client.delete_model_version(name=model_name, version=str(version))
 
+            # Avoid circular import
+            from services.conda_env_service import CondaEnvService
+            CondaEnvService.invalidate(model_name, version)
+
             return Result(
                 Result.SUCCESS,
                 'Deleted model version successfully'
@@ -386,19 +518,10 @@ class MLflowService:
             if model_version.is_fail():
                 return model_version
 
-            shipped_brain_yaml_file = MLflowService.client.download_artifacts(model_version.data.run_id,
-                                                                              "shipped-brain.yaml")
-            with open(shipped_brain_yaml_file, "r") as yaml_file:
-                shipped_brain_yaml = yaml.full_load(yaml_file)
-                model_artifacts_path = shipped_brain_yaml["model_artifacts_path"]
-
-            ml_model_path = MLflowService.client.download_artifacts(model_version.data.run_id,
-                                                                    f"{model_artifacts_path}/MLmodel")
-            cfg = None
+            model_artifacts_path = MLflowService._get_model_artifacts_path(model_version.data.run_id)
 
-            # TODO read from s3: implement store service
-            with open(ml_model_path, 'r') as f:
-                cfg = yaml.full_load(f)
+            cfg = yaml.full_load(MLflowService._read_artifact(model_version.data.run_id,
+                                                              f"{model_artifacts_path}/MLmodel"))
 
             return Result(
                 Result.SUCCESS,
@@ -439,17 +562,10 @@ class MLflowService:
 
             print("MODEL VERSION DATA:", model_version.data.run_id)
 
-            shipped_brain_yaml_file = MLflowService.client.download_artifacts(model_version.data.run_id,
-                                                                              "shipped-brain.yaml")
-            with open(shipped_brain_yaml_file, "r") as yaml_file:
-                shipped_brain_yaml = yaml.full_load(yaml_file)
-                model_artifacts_path = shipped_brain_yaml["model_artifacts_path"]
+            model_artifacts_path = MLflowService._get_model_artifacts_path(model_version.data.run_id)
 
-            input_example_path = MLflowService.client.download_artifacts(model_version.data.run_id,
-                                                                         f"{model_artifacts_path}/input_example.json")
-
-            with open(input_example_path, 'r') as f:
-                input_example = json.load(f)
+            input_example = json.loads(MLflowService._read_artifact(model_version.data.run_id,
+                                                                    f"{model_artifacts_path}/input_example.json"))
 
             return Result(
                 Result.SUCCESS,
@@ -480,29 +596,20 @@ class MLflowService:
                 return model_version
 
             # artifacts_ls = MLflowService.__client.list_artifacts(registered_model_version.run_id, name)
-            shipped_brain_yaml_file = MLflowService.client.download_artifacts(model_version.data.run_id,
-                                                                              "shipped-brain.yaml")
-            with open(shipped_brain_yaml_file, "r") as yaml_file:
-                shipped_brain_yaml = yaml.full_load(yaml_file)
-                model_artifacts_path = shipped_brain_yaml["model_artifacts_path"]
-                model_flavor = shipped_brain_yaml["flavor"]
+            model_artifacts_path = MLflowService._get_model_artifacts_path(model_version.data.run_id)
 
             print("[DEBUG] Model artifacts path:", model_artifacts_path)
 
-            ml_model_path = MLflowService.client.download_artifacts(model_version.data.run_id,
-                                                                    f"{model_artifacts_path}/MLmodel")
-            cfg = None
-
-            print(f'[DEBUG] MLflowService.get_conda_env_path, {ml_model_path}')
-            # TODO read from s3: implement store service
-            with open(ml_model_path, 'r') as f:
-                cfg = yaml.full_load(f)
+            cfg = yaml.full_load(MLflowService._read_artifact(model_version.data.run_id,
+                                                              f"{model_artifacts_path}/MLmodel"))
 
             print(f"[DEBUG] MLflowService.get_conda_env_path :: cfg['flavors'] object in MLmodel: {cfg['flavors']}")
 
             remote_conda_env_path = model_artifacts_path + "/" + cfg['flavors']["python_function"]['env']
-            print("[INFO] Downloading conda env from", remote_conda_env_path)
-            conda_env_path = MLflowService.client.download_artifacts(model_version.data.run_id, remote_conda_env_path)
+            print("[INFO] Getting conda env from", remote_conda_env_path)
+            conda_env_path = MLflowService.artifact_cache.get_path(model_version.data.run_id,
+                                                                   remote_conda_env_path,
+                                                                   MLflowService.client.download_artifacts)
 
             return Result(
                 Result.SUCCESS,
@@ -654,6 +761,13 @@ class MLflowService:
     def set_signature(username: str, model_name: str, signature: Dict[str, Any]):
         return MLflowService.set_tag(username, model_name, MLflowService.SIGNATURE_TAG, signature)
 
+    @staticmethod
+    def set_prediction_cache(username: str, model_name: str, enabled: bool):
+        if enabled:
+            return MLflowService.set_tag(username, model_name, MLflowService.PREDICTION_CACHE_TAG, 'true')
+
+        return MLflowService.delete_tag(username, model_name, MLflowService.PREDICTION_CACHE_TAG)
+
     @staticmethod
     def delete_metrics(username: str, model_name: str):
         return MLflowService.delete_tag(username, model_name, MLflowService.METRICS_TAG)
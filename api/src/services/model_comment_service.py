@@ -2,6 +2,9 @@ from db.db_config import session
 from datetime import datetime
 from models.result import Result
 from models.model_comment import ModelComment
+from typing import List
+from sqlalchemy import func, select
+from db.async_db import database
 
 class ModelCommentService:
     
@@ -66,6 +69,35 @@ class ModelCommentService:
                 Result.EXCEPTION
             )
 
+    @staticmethod
+    async def get_models_comments_count_async(model_names: List[str]) -> Result:
+        '''Count comments of several models in a single query
+
+        :param model_names: Models to count comments from
+
+        :return: Result object, on success data is a dict {<model name>: <number of comments>}
+        '''
+        try:
+            counts = {model_name: 0 for model_name in model_names}
+            if len(model_names) > 0:
+                rows = await database.fetch_all(select([ModelComment.model_name, func.count(ModelComment.id).label('count')])
+                                                .where(ModelComment.model_name.in_(model_names))
+                                                .group_by(ModelComment.model_name))
+
+                counts.update({row['model_name']: row['count'] for row in rows})
+
+            return Result(
+                Result.SUCCESS,
+                'Successfully counted comments',
+                counts
+            )
+        except:
+            return Result(
+                Result.FAIL,
+                'An error occurred while counting comments',
+                Result.EXCEPTION
+            )
+
     @staticmethod
     def get_comment(comment_id: int) -> Result:
         '''Get comment by ID
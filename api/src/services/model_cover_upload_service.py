@@ -1,7 +1,13 @@
-import libs.utilities as utilities
+from config.config import IMAGE_CONFIG
+from libs.thumbnails import ThumbnailStore
+from typing import Dict, List, Optional
 import os
 
 class ModelCoverUploadService:
+    THUMBNAILS = ThumbnailStore(os.path.join(IMAGE_CONFIG['thumbnails_dir'], 'models'),
+                                f"{IMAGE_CONFIG['static_url']}/models",
+                                IMAGE_CONFIG['cover_size'])
+
     @staticmethod
     def get_model_cover_photo_path(model_name: str) -> str:
         '''Returns the full path for model's cover photo directory \n
@@ -17,17 +23,54 @@ class ModelCoverUploadService:
         return full_cover_photo_path
 
     @staticmethod
-    def get_model_cover_photo(model_name: str) -> str:
-        '''Returns model's cover photo in base64 format
+    def create_model_cover_photo_thumbnail(model_name: str) -> Optional[str]:
+        '''Creates the thumbnail of model cover photo's uploaded file
+
+        :param model_name: Model name to use for path
+
+        :return: Thumbnail's URL, None if model cover photo's directory is empty
+        '''
+        model_cover_photo_path = ModelCoverUploadService.get_model_cover_photo_path(model_name)
+        files = os.listdir(model_cover_photo_path) if os.path.isdir(model_cover_photo_path) else []
+
+        if len(files) == 0:
+            ModelCoverUploadService.THUMBNAILS.delete(model_name)
+            return None
+
+        return ModelCoverUploadService.THUMBNAILS.create(os.path.join(model_cover_photo_path, files[0]), model_name)
+
+    @staticmethod
+    def get_model_cover_photo_url(model_name: str) -> Optional[str]:
+        '''Returns the URL of model cover photo's thumbnail
 
-        :param model_name: Model name to use for getting content
+        :param model_name: Model name to use for getting URL
 
-        :return: Base64 string if cover photo's directory contains file, else None is returned
+        :return: URL string if thumbnail exists, else None is returned
+        '''
+        return ModelCoverUploadService.THUMBNAILS.get_url(model_name)
+
+    @staticmethod
+    def get_model_cover_photo_urls(model_names: List[str]) -> Dict[str, str]:
+        '''Returns the URLs of thumbnails; model names without thumbnail are not included
+
+        :param model_names: Model names to use for getting URLs
+
+        :return: dict of model_name: URL
+        '''
+        return ModelCoverUploadService.THUMBNAILS.get_urls(model_names)
+
+    @staticmethod
+    def create_missing_thumbnails() -> None:
+        '''Creates the thumbnails of files uploaded before thumbnails existed
         '''
-        cover_photo_path = ModelCoverUploadService.get_model_cover_photo_path(model_name)
-        files = os.listdir(cover_photo_path)
+        root = os.path.abspath(os.path.join('files', 'models'))
+        if not os.path.isdir(root):
+            return
 
-        if len(files) > 0:
-            return utilities.convert_to_base_64(os.path.join(cover_photo_path, files[0]))
-        
-        return None
\ No newline at end of file
+        for model_name in os.listdir(root):
+            if ModelCoverUploadService.THUMBNAILS.has(model_name):
+                continue
+            try:
+                ModelCoverUploadService.create_model_cover_photo_thumbnail(model_name)
+            except Exception as e:
+                print(f'[WARN] ModelCoverUploadService.create_missing_thumbnails - {model_name}: {e}')
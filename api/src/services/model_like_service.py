@@ -2,6 +2,9 @@ from db.db_config import session
 from models.result import Result
 from models.model_like import ModelLike
 from datetime import datetime
+from typing import List
+from sqlalchemy import func, select
+from db.async_db import database
 
 class ModelLikeService:
 
@@ -82,6 +85,56 @@ class ModelLikeService:
                 Result.EXCEPTION
             )
 
+    @staticmethod
+    async def get_models_likes_count_async(model_names: List[str]) -> Result:
+        try:
+            counts = {model_name: 0 for model_name in model_names}
+            if len(model_names) > 0:
+                rows = await database.fetch_all(select([ModelLike.model_name, func.count(ModelLike.user_id).label('count')])
+                                                .where(ModelLike.model_name.in_(model_names))
+                                                .group_by(ModelLike.model_name))
+
+                counts.update({row['model_name']: row['count'] for row in rows})
+
+            return Result(
+                Result.SUCCESS,
+                'Successfully retrieved models likes count',
+                counts
+            )
+        except:
+            return Result(
+                Result.FAIL,
+                'An error occurred while retrieving models likes count',
+                Result.EXCEPTION
+            )
+
+    @staticmethod
+    async def get_liked_models_async(model_names: List[str], user_id: int) -> Result:
+        '''Check which of the models the user liked, in a single query
+
+        :return: Result object, on success data is a dict {<model name>: <True if user liked model, False otherwise>}
+        '''
+        try:
+            liked_models = {model_name: False for model_name in model_names}
+            if len(model_names) > 0:
+                rows = await database.fetch_all(select([ModelLike.model_name])
+                                                .where(ModelLike.model_name.in_(model_names))
+                                                .where(ModelLike.user_id == user_id))
+
+                liked_models.update({row['model_name']: True for row in rows})
+
+            return Result(
+                Result.SUCCESS,
+                "Successfully retrieved user's models likes",
+                liked_models
+            )
+        except:
+            return Result(
+                Result.FAIL,
+                "An error occurred while retrieving user's models likes",
+                Result.EXCEPTION
+            )
+
     @staticmethod
     def get_user_model_likes(user_id: int) -> Result:
         try:
@@ -0,0 +1,105 @@
+import asyncio
+from typing import List, Optional
+import schemas.ml_model as ml_model_schema
+from models.result import Result
+from services.api_call_service import ApiCallService
+from services.hashtag_service import HashtagService
+from services.model_comment_service import ModelCommentService
+from services.model_cover_upload_service import ModelCoverUploadService
+from services.model_like_service import ModelLikeService
+from services.user_photo_service import UserPhotoService
+from services.user_service import UserService
+
+
+class ModelListingService:
+    ''' Builds model listings for a page of registered models with a constant number of grouped queries,
+    regardless of page size
+    '''
+
+    @staticmethod
+    async def list_models_async(registered_models: List, user_id: Optional[int] = None, with_cover_photo: bool = True) -> Result:
+        ''' Enrich registered models with owner, hashtags, api calls, likes and comments. The grouped queries run
+        concurrently on the async database
+
+        :param registered_models: list of mlflow RegisteredModel entities
+        :param user_id: (optional) id of the current user; used to check if the user liked the models
+        :param with_cover_photo: (optional) [default True] include models' cover photos
+
+        :return: a Result object, on success Result.data is a list of MlModelListing dicts in the input order
+        '''
+        try:
+            model_names = [registered_model.name for registered_model in registered_models]
+            usernames = [registered_model.tags['user_id'] for registered_model in registered_models]
+
+            async def get_liked_models():
+                if not user_id:
+                    return None
+                return await ModelLikeService.get_liked_models_async(model_names, user_id)
+
+            users_result, hashtags_result, api_calls_result, likes_result, liked_models_result, comments_result = \
+                await asyncio.gather(
+                    UserService.get_users_by_usernames_async(usernames),
+                    HashtagService.get_models_hashtags_async(model_names),
+                    ApiCallService.get_models_count_async(model_names),
+                    ModelLikeService.get_models_likes_count_async(model_names),
+                    get_liked_models(),
+                    ModelCommentService.get_models_comments_count_async(model_names))
+
+            # Thumbnail URLs from the in-memory index
+            photos = UserPhotoService.get_user_photo_urls(usernames)
+            cover_photos = ModelCoverUploadService.get_model_cover_photo_urls(model_names) if with_cover_photo else {}
+
+            def data(result: Optional[Result]) -> dict:
+                return result.data if result is not None and result.is_success() else {}
+
+            results = ModelListingService.build_listings(registered_models, data(users_result), data(hashtags_result),
+                                                         data(api_calls_result), data(likes_result),
+                                                         data(liked_models_result), data(comments_result),
+                                                         photos, cover_photos)
+
+            return Result(
+                Result.SUCCESS,
+                'Collected models successfully',
+                results
+            )
+        except Exception as e:
+            print(f'[EXCEPTION] ModelListingService.list_models_async. Exception: {e}')
+            return Result(
+                Result.FAIL,
+                'An error occurred while collecting models',
+                Result.EXCEPTION
+            )
+
+    @staticmethod
+    def build_listings(registered_models: List, users: dict, hashtags: dict, api_calls: dict, likes_count: dict,
+                       liked_models: dict, comments_count: dict, photos: dict, cover_photos: dict) -> List[dict]:
+        ''' Build the MlModelListing dicts of registered models from the grouped query results
+        '''
+        results = []
+        for registered_model in registered_models:
+            username = registered_model.tags['user_id']
+            user_data = users.get(username)
+            user = ml_model_schema.User(name=user_data.name if user_data is not None else username,
+                                        username=username,
+                                        photo=photos.get(username))
+
+            likes = ml_model_schema.Likes(count=likes_count.get(registered_model.name, 0),
+                                          has_liked_model=liked_models.get(registered_model.name, False))
+
+            # Get latest model version
+            version = 0 if len(registered_model.latest_versions) == 0 else int(registered_model.latest_versions[0].version)
+
+            results.append(ml_model_schema.MlModelListing(name=registered_model.name,
+                                                          version=version,
+                                                          likes=likes,
+                                                          comment_count=comments_count.get(registered_model.name, 0),
+                                                          hashtags=hashtags.get(registered_model.name, []),
+                                                          tags=registered_model.tags,
+                                                          api_calls=api_calls.get(registered_model.name, 0),
+                                                          creation_time=registered_model.creation_timestamp,
+                                                          last_update_time=registered_model.last_updated_timestamp,
+                                                          user=user,
+                                                          description=registered_model.description,
+                                                          cover_photo=cover_photos.get(registered_model.name)).dict())
+
+        return results
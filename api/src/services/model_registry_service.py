@@ -1,13 +1,17 @@
 import os
 import tempfile
+from typing import Optional
 
+import libs.utilities as Utilities
 import mlflow
 import yaml
 from db.db_config import session
+from models.model_upload_stage import ModelUploadStage
 from models.model_version import ModelVersion
 from models.result import Result
 from services.hashtag_service import HashtagService
 from services.mlflow_service import MLflowService
+from services.model_upload_stage_service import ModelUploadStageService
 from shippedbrain import shippedbrain
 
 
@@ -41,8 +45,13 @@ class ModelRegistryService:
             print(f'[INFO] Failed to inherit or create model hashtags for {model_name}')
 
     @staticmethod
-    def register_model(zipfile: str, username: str) -> Result:
+    def register_model(zipfile: str, username: str, model_upload_id: Optional[int] = None, attempt: int = 1) -> Result:
         """ Return Result object with data=ModelVersion on success, raise exception otherwise
+
+        :param zipfile: path of the uploaded zip file
+        :param username: the owner's username
+        :param model_upload_id: (optional) id of the model upload; its stages are recorded
+        :param attempt: (optional) the model upload's attempt
         """
         # set on function's start
         mlflow.set_experiment(username)
@@ -50,13 +59,19 @@ class ModelRegistryService:
         print(f"[DEBUG] Experiment id: {experiment.experiment_id}")
         print(f"[DEBUG] Experiment lifecycle stage: {experiment.lifecycle_stage}")
 
+        def track(stage: str):
+            return ModelUploadStageService.track(model_upload_id, stage, attempt)
+
         with tempfile.TemporaryDirectory() as tmpdir_target:
-            shippedbrain._unzip_artifacts(zipfile, tmpdir_target)
+            with track(ModelUploadStage.UNZIP) as stage:
+                shippedbrain._unzip_artifacts(zipfile, tmpdir_target)
+                stage['bytes'] = Utilities.get_dir_size(tmpdir_target)
 
             # read shipped-brain.yaml
-            print("[INFO] Reading shipped-brain.yaml")
-            with open(os.path.join(tmpdir_target, "shipped-brain.yaml"), "r") as yaml_file:
-                shippedbrain_yaml = yaml.full_load(yaml_file)
+            with track(ModelUploadStage.YAML_PARSE) as stage:
+                print("[INFO] Reading shipped-brain.yaml")
+                with open(os.path.join(tmpdir_target, "shipped-brain.yaml"), "r") as yaml_file:
+                    shippedbrain_yaml = yaml.full_load(yaml_file)
                 model_artifacts_path = shippedbrain_yaml["model_artifacts_path"]
                 model_name = shippedbrain_yaml["model_name"]
                 model_metrics = shippedbrain_yaml["metrics"]
@@ -68,6 +83,7 @@ class ModelRegistryService:
 
                 if not valid_model_name:
                     print(f"[WARN] Invalid model name '{model_name}")
+                    stage['error'] = f"Model name '{model_name}' is not valid!"
                     return Result(Result.FAIL,
                                   f"Model name '{model_name}' is not valid!",
                                   Result.EXCEPTION)
@@ -75,29 +91,37 @@ class ModelRegistryService:
                 registered_model_result = MLflowService.get_or_create_registered_model(username, model_name)
                 if registered_model_result.is_fail():
                     print(f"[FAIL] Failed to get or create model '{model_name}' for user {username}.")
+                    stage['error'] = registered_model_result.message
                     return Result(Result.FAIL,
                                   f"An unexpected error occurred. Could not log model with name '{model_name}'.",
                                   Result.EXCEPTION)
 
                 elif registered_model_result.data.tags["user_id"] != username:
                     print(f"[FAIL] Failed create model '{model_name}'. Permission denied.")
+                    stage['error'] = 'Permission denied'
                     return Result(Result.FAIL,
                                   f"Failed create model '{model_name}'. Permission denied.",
                                   Result.EXCEPTION)
 
-                print("[DEBUG]\tMODEL NAME:", model_name)
-                print("[DEBUG]\tMODEL NAME IS VALID:", valid_model_name)
-                print("[DEBUG]\tMODEL ARTIFACTS PATH:", model_artifacts_path)
-                print("[DEBUG]\tMODEL FLAVOR:", shippedbrain_yaml["flavor"])
+            print("[DEBUG]\tMODEL NAME:", model_name)
+            print("[DEBUG]\tMODEL NAME IS VALID:", valid_model_name)
+            print("[DEBUG]\tMODEL ARTIFACTS PATH:", model_artifacts_path)
+            print("[DEBUG]\tMODEL FLAVOR:", shippedbrain_yaml["flavor"])
 
-                # final_model_name = f"{username}/{model_name}"
+            # final_model_name = f"{username}/{model_name}"
+            with track(ModelUploadStage.LOG_MODEL) as stage:
                 logged_model_run = shippedbrain._log_model(tmpdir_target, model_artifacts_path)
+                stage['bytes'] = Utilities.get_dir_size(tmpdir_target)
 
+            with track(ModelUploadStage.REGISTER_MODEL):
                 model_version = mlflow.register_model(
                     f"runs:/{logged_model_run.info.run_id}/{model_artifacts_path}",
                     model_name)
+
+            with track(ModelUploadStage.TAGS):
                 MLflowService.set_params(username=username, model_name=model_name, params=model_params)
                 MLflowService.set_metrics(username=username, model_name=model_name, metrics=model_metrics)
-                return Result(Result.SUCCESS,
-                              f"Successfully registered model ({model_version.name, model_version.version}).",
-                              model_version)
+
+            return Result(Result.SUCCESS,
+                          f"Successfully registered model ({model_version.name, model_version.version}).",
+                          model_version)
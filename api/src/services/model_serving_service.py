@@ -1,56 +1,71 @@
 from typing import Optional, Tuple, List, Dict
 import subprocess
 import tempfile
+import signal
+import sys
 import os
+import json
+import time
+import asyncio
+import aiohttp
 import pandas as pd
 from dotenv import load_dotenv
-from services.mlflow_service import MLflowService
-from mlflow.utils import conda
+from services.conda_env_service import CondaEnvService
 from models.result import Result
+import libs.prediction_decoder as PredictionDecoder
+from models.live_model import LiveModel
+from libs.single_flight import SingleFlight
+from libs.micro_batcher import MicroBatcher
+from libs.prediction_cache import PredictionCache
+from libs.shared_store import SharedStore
 from datetime import datetime
-from config.config import MODEL_SERVING_SERVICE_CONFIG
-import signal
+from config.config import MODEL_SERVING_SERVICE_CONFIG, PREDICTION_CACHE_CONFIG
 
 # This is needed; set mlflow tracking uri to MLFLOW_TRACKING_URI
 load_dotenv()
 
 class ModelServingService:
-    
+    ''' Serves models from a pool of worker processes, one per conda environment.
+
+    Live models, pool workers and ports are kept in a registry shared by every server process of the host
+    (e.g. gunicorn workers), thus a model is started once per host regardless of the process receiving the request.
+    Registry layout:
+        {
+         'models': {'<name>/<version>': LiveModel.to_dict()},
+         'workers': {'<conda env. name>': {'port': <int>, 'pid': <int>, 'start_time': <int>}},
+         'memory_hints': {'<name>/<version>': <last measured memory (bytes)>},
+         'reserved_ports': {'<port>': <pid of the server process starting a worker on the port>}
+        }
+
+    Registry reads and transactions take file locks; on the request path they run in the event loop's default
+    executor.
+    '''
+    NO_CONDA_ENV: str = '__no_conda__'
+    WORKER_SCRIPT: str = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'libs', 'model_worker.py')
+    LAST_USED_RESOLUTION: int = 1 # min. time (seconds) between last used updates of a model in the registry
 
     def __init__(self):
         self.MIN_PORT: int = MODEL_SERVING_SERVICE_CONFIG['min_port']
         self.MAX_PORT: int = MODEL_SERVING_SERVICE_CONFIG['max_port']
         self.TTL: int = MODEL_SERVING_SERVICE_CONFIG['ttl']
         self.MAX_MODELS: int = MODEL_SERVING_SERVICE_CONFIG['max_concurrent_models']
-        self.OPEN_PORTS: List[int] = [x for x in range(MODEL_SERVING_SERVICE_CONFIG['min_port'], MODEL_SERVING_SERVICE_CONFIG['max_port'] + 1)]
-        self.MODELS: Dict[Tuple[str, int], Tuple[int, subprocess.Popen, datetime]] = {}  # (model, version): [port, pid, datetime]
-        self.MAX_RETRIES = MODEL_SERVING_SERVICE_CONFIG['max_retries']
-
-    @staticmethod
-    async def __has_conda_env(name: str, version: str) -> Tuple[bool, str]:
-        ''' Check if model version has conda environment
-
-        :param name: model name
-        :param version: model version
-
-        :return: True if env. exists; False otherwise
-        '''
-        result = MLflowService.get_conda_env_path(name, version)
-
-        print(f"[DEBUG] PredictionService.__has_conda_env - MLflowService.get_conda_env_path: {result.to_dict()}")
-
-        conda_env_path = result.to_dict()['data']['results']
-
-        project_env_name = conda._get_conda_env_name(conda_env_path, None)
-
-        print(f'[DEBUG] PredictionService.__has_conda_env - project_env_name={project_env_name}')
-
-        conda_path = os.environ.get('MLFLOW_CONDA_HOME')
-        conda_envs_path = os.path.join(conda_path, 'envs')
-        conda_env_list = os.listdir(conda_envs_path)
-
-        print(f"[DEBUG] PredictionService.__has_conda_env - conda envs list: {conda_env_list}")
-        return project_env_name in conda_env_list, conda_env_path
+        self.MAX_MEMORY: int = MODEL_SERVING_SERVICE_CONFIG['max_memory'] * 1024 * 1024
+        self.READY_TIMEOUT: int = MODEL_SERVING_SERVICE_CONFIG['ready_timeout']
+        self.READY_POLL_INTERVAL: float = MODEL_SERVING_SERVICE_CONFIG['ready_poll_interval']
+        self.REGISTRY: SharedStore = SharedStore(MODEL_SERVING_SERVICE_CONFIG['registry_path'],
+                                                 {'models': {}, 'workers': {}, 'memory_hints': {}, 'reserved_ports': {}})
+        self.PROCESSES: Dict[int, subprocess.Popen] = {}  # pid: pool worker process started by this process
+        self.READY: Dict[Tuple[str, int], asyncio.Future] = {}  # (model, version): readiness future
+        self.STARTUPS: SingleFlight = SingleFlight()  # (model, version) startups in flight
+        self.MICRO_BATCHING: bool = MODEL_SERVING_SERVICE_CONFIG['micro_batching']
+        self.BATCHER: MicroBatcher = MicroBatcher(self.__invoke_batch,
+                                                  MODEL_SERVING_SERVICE_CONFIG['batch_max_rows'],
+                                                  MODEL_SERVING_SERVICE_CONFIG['batch_max_latency'])
+        self.PREDICTION_CACHE: PredictionCache = PredictionCache(PREDICTION_CACHE_CONFIG['path'],
+                                                                 PREDICTION_CACHE_CONFIG['max_disk_size'] * 1024 * 1024,
+                                                                 PREDICTION_CACHE_CONFIG['max_memory_size'] * 1024 * 1024)
+        self.CACHE_SETTINGS: Dict[str, Tuple[bool, float]] = {}  # model: (prediction cache enabled, expiration time)
+        self.session: Optional[aiohttp.ClientSession] = None
 
     @staticmethod
     async def predict(name: str,
@@ -76,19 +91,18 @@ class ModelServingService:
                 cmd = ['mlflow', 'models', 'predict', '-m', f'{base_uri}:/{name}/{version}', '-i', file_abs, '-t', 'csv'] # -o <output_file>
                 prepare_env_cmd = ['mlflow', 'models', 'prepare-env', '--model-uri', f'{base_uri}:/{name}/{version}']
                 
-                # Check conda env
-                has_conda_env, project_env_name = await ModelServingService.__has_conda_env(name, str(version))
-
                 if no_conda:
                     cmd.append('--no-conda')
+                else:
+                    # Install conda environment on first prediction.
+                    # If env. is not prepared, first prediction fails!
+                    prepare_env_result = await CondaEnvService.prepare_env_async(name, version)
+                    if prepare_env_result.is_fail():
+                        return prepare_env_result
                 
                 df = pd.read_json(input_features, orient='split')
                 df.to_csv(file_abs)
 
-                # Install conda environment on first prediction.
-                # If env. is not prepared, first prediction fails!
-                conda.get_or_create_conda_env(project_env_name)
-
                 '''if not has_conda_env:
                     print(f"\t[INFO] Preparing env. for '{name}' with version '{version}'...")
                     prepare_env_result = subprocess.run(prepare_env_cmd, env=os.environ.copy(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
@@ -114,7 +128,14 @@ class ModelServingService:
                                   f"Failed to perform prediction using model ({name}, {version})",
                                   Result.FAIL)
 
-                out = eval(process.stdout)
+                decoded = PredictionDecoder.decode(process.stdout)
+                if decoded.is_error():
+                    print(f"[WARN] Prediction failed: {decoded.message}")
+                    return Result(Result.FAIL,
+                                  f"Failed to perform prediction using model ({name}, {version})",
+                                  Result.FAIL)
+
+                out = decoded.predictions
 
                 print('[INFO] PredictionService.predict - success')
                 return Result(Result.SUCCESS,
@@ -127,81 +148,601 @@ class ModelServingService:
                           f"[EXCEPTION] Could not make prediction using model with name '{name}' and version '{version}'.",
                           Result.EXCEPTION)
 
+
+    async def __get_session(self) -> aiohttp.ClientSession:
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession()
+
+        return self.session
+
+    @staticmethod
+    def get_key(name: str, version: int) -> str:
+        ''' Registry key of a model version
+        '''
+        return f'{name}/{version}'
+
+    @staticmethod
+    def parse_key(key: str) -> Tuple[str, int]:
+        name, version = key.rsplit('/', 1)
+
+        return name, int(version)
+
+    @staticmethod
+    def get_process_start_time(pid: int) -> Optional[int]:
+        ''' Get process start time in clock ticks since boot; distinguishes a process from a later one reusing its pid
+
+        :return: start time; None if process does not exist
+        '''
+        try:
+            with open(f'/proc/{pid}/stat', 'r') as f:
+                # the 2nd field, the executable name, may contain spaces
+                return int(f.read().rsplit(')', 1)[1].split()[19])
+        except FileNotFoundError:
+            return None
+        except Exception:
+            # no procfs
+            try:
+                os.kill(pid, 0)
+                return 0
+            except OSError:
+                return None
+
+    @staticmethod
+    def is_worker_alive(worker: dict) -> bool:
+        start_time = ModelServingService.get_process_start_time(worker['pid'])
+
+        return start_time is not None and (start_time == worker['start_time'] or worker['start_time'] == 0)
+
+    def __reap(self) -> None:
+        ''' Reap exited pool worker processes started by this process
+        '''
+        for pid in list(self.PROCESSES):
+            if self.PROCESSES[pid].poll() is not None:
+                self.PROCESSES.pop(pid)
+
+    def __reserve_port(self, state: dict) -> int:
+        ''' Reserve a port for a pool worker started by this process. Must run in a registry transaction;
+        reservations of dead processes are dropped
+
+        :param state: registry state
+
+        :return: the reserved port
+        '''
+        for reserved_port, owner in list(state['reserved_ports'].items()):
+            if ModelServingService.get_process_start_time(owner) is None:
+                state['reserved_ports'].pop(reserved_port)
+
+        used_ports = set(w['port'] for w in state['workers'].values())
+        used_ports.update(int(p) for p in state['reserved_ports'])
+        open_ports = [p for p in range(self.MIN_PORT, self.MAX_PORT + 1) if p not in used_ports]
+        if len(open_ports) == 0:
+            raise Exception('No open ports for pool worker')
+
+        port = open_ports[0]
+        state['reserved_ports'][str(port)] = os.getpid()
+
+        return port
+
+    def __release_port(self, port: int) -> None:
+        ''' Release a port reserved by this process, e.g. if its worker failed to start. Blocking
+        '''
+        with self.REGISTRY.transaction() as state:
+            state['reserved_ports'].pop(str(port), None)
+
+    def __start_worker(self, env_key: str, python_path: str, port: int) -> dict:
+        ''' Start a pool worker process for a python environment. Runs outside registry transactions; the worker is
+        registered by the caller
+
+        :param env_key: key of the worker's environment; conda env. name
+        :param python_path: path to the environment's python interpreter
+        :param port: port reserved for the worker
+
+        :return: the worker {'port': <int>, 'pid': <int>, 'start_time': <int>}
+        '''
+        cmd = [python_path, self.WORKER_SCRIPT, '--port', str(port)]
+
+        # New session: the worker and its children must be killed as a process group without killing this server
+        process = subprocess.Popen(cmd, env=os.environ.copy(), start_new_session=True)
+        self.PROCESSES[process.pid] = process
+
+        print(f"\t[INFO] Started pool worker for env '{env_key}': ({port}, {process.pid})")
+
+        return {'port': port,
+                'pid': process.pid,
+                'start_time': ModelServingService.get_process_start_time(process.pid) or 0}
+
+    def __kill_worker_process(self, worker: dict) -> None:
+        try:
+            # the worker is its process group leader
+            os.killpg(worker['pid'], signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        self.__reap()
+
+    def __stop_worker(self, state: dict, env_key: str) -> None:
+        ''' Stop pool worker process and release its port. Must run in a registry transaction
+
+        :param state: registry state
+        :param env_key: key of the worker's environment
+        '''
+        worker = state['workers'].pop(env_key)
+
+        if ModelServingService.is_worker_alive(worker):
+            self.__kill_worker_process(worker)
+        else:
+            print(f"\t[WARN] Pool worker for env '{env_key}' was already dead")
+            self.__reap()
+        print(f"\t[INFO] Stopped pool worker for env '{env_key}': ({worker['port']}, {worker['pid']})")
+
+    async def __run(self, func, *args):
+        ''' Run a blocking registry operation in the event loop's default executor
+        '''
+        return await asyncio.get_event_loop().run_in_executor(None, func, *args)
+
+    async def __get_worker_stats(self, port: int) -> Optional[dict]:
+        ''' Get pool worker's stats: {'rss': <bytes>, 'models': {'<name>/<version>': {'rss': <bytes>}}}
+
+        :return: stats dict; None if worker does not answer
+        '''
+        try:
+            session = await self.__get_session()
+            async with session.get(f'http://127.0.0.1:{port}/stats', timeout=aiohttp.ClientTimeout(total=5)) as resp:
+                return await resp.json()
+        except Exception as e:
+            print(f'[DEBUG] Could not get pool worker stats on port {port}. Error: {e}')
+            return None
+
+    def get_live_models(self) -> Dict[Tuple[str, int], LiveModel]:
+        ''' Get live models of the host. Blocking
+
+        :return: dict (model, version): LiveModel
+        '''
+        state = self.REGISTRY.read()
+
+        return {ModelServingService.parse_key(k): LiveModel.from_dict(v) for k, v in state['models'].items()}
+
+    async def refresh_memory(self) -> None:
+        ''' Update live models' memory usage with the values measured by their pool workers
+        '''
+        workers = (await self.__run(self.REGISTRY.read))['workers']
+
+        for env_key in workers:
+            stats = await self.__get_worker_stats(workers[env_key]['port'])
+            if stats is None:
+                continue
+
+            await self.__run(self.__set_memory, stats)
+
+    def __set_memory(self, stats: dict) -> None:
+        ''' Record the memory usage measured by a pool worker. Blocking
+        '''
+        with self.REGISTRY.transaction() as state:
+            for model_key, model_stats in stats['models'].items():
+                if model_key in state['models']:
+                    state['models'][model_key]['memory'] = model_stats['rss']
+                    state['memory_hints'][model_key] = model_stats['rss']
+
+    def get_used_memory(self, live_models: Optional[Dict[Tuple[str, int], LiveModel]] = None) -> int:
+        ''' Get memory (bytes) used by all live models
+        '''
+        live_models = self.get_live_models() if live_models is None else live_models
+
+        return sum(live_models[k].memory for k in live_models)
+
+    async def evict(self,
+                    required_memory: int = 0,
+                    required_models: int = 0,
+                    exclude: Optional[Tuple[str, int]] = None) -> List[Tuple[str, int]]:
+        ''' Evict least recently used models until serving limits are met
+
+        :param required_memory: memory (bytes) that must be available after eviction
+        :param required_models: number of model slots that must be available after eviction
+        :param exclude: (model, version) that must not be evicted; e.g. the model being started
+
+        :return: list of evicted (model, version)
+        '''
+        evicted = []
+
+        while True:
+            live_models = await self.__run(self.get_live_models)
+            n_models = len([k for k in live_models if k != exclude])
+
+            if n_models + required_models <= self.MAX_MODELS and \
+                    self.get_used_memory(live_models) + required_memory <= self.MAX_MEMORY:
+                break
+
+            lru_key = self.get_lru(live_models, exclude=exclude)
+            if lru_key is None:
+                break
+
+            print(f'[INFO] Evicting LRU model {lru_key}. '
+                  f'Live models: {n_models}/{self.MAX_MODELS}; '
+                  f'memory: {self.get_used_memory(live_models)}/{self.MAX_MEMORY} bytes')
+
+            kill_result = await self.kill_model(lru_key[0], int(lru_key[1]))
+            if kill_result.is_fail():
+                # do not loop forever on a model that cannot be killed
+                await self.__run(self.__unregister_model, ModelServingService.get_key(*lru_key))
+            evicted.append(lru_key)
+
+        return evicted
+
+    async def __wait_until_ready(self, name: str, version: int, live_model: LiveModel) -> bool:
+        ''' Wait until the pool worker answers its health endpoint and has loaded the model
+
+        :param name: name of the registered model
+        :param version: version of the model
+        :param live_model: the LiveModel being started
+
+        :return: True if model is ready; False otherwise
+        '''
+        session = await self.__get_session()
+        deadline = asyncio.get_event_loop().time() + self.READY_TIMEOUT
+
+        # Worker boot: python + env. activation
+        while True:
+            if ModelServingService.get_process_start_time(live_model.pid) is None:
+                print(f'\t[WARN] Pool worker on port {live_model.port} died while booting')
+                return False
+            try:
+                async with session.get(f'http://127.0.0.1:{live_model.port}/ping',
+                                       timeout=aiohttp.ClientTimeout(total=1)) as resp:
+                    if resp.status == 200:
+                        break
+            except Exception:
+                pass
+
+            if asyncio.get_event_loop().time() >= deadline:
+                print(f'\t[WARN] Pool worker on port {live_model.port} is not ready after {self.READY_TIMEOUT}s')
+                return False
+            await asyncio.sleep(self.READY_POLL_INTERVAL)
+
+        # Model load: the worker answers once the model is in memory
+        try:
+            remaining = max(deadline - asyncio.get_event_loop().time(), 1)
+            async with session.post(f'http://127.0.0.1:{live_model.port}/load/{name}/{version}',
+                                    timeout=aiohttp.ClientTimeout(total=remaining)) as resp:
+                load_result = await resp.json()
+
+            if resp.status != 200:
+                print(f'\t[WARN] Pool worker failed to load model ({name}, {version}): {load_result.get("message")}')
+                return False
+
+            live_model.memory = load_result['rss']
+            return True
+        except Exception as e:
+            print(f'\t[WARN] Pool worker failed to load model ({name}, {version}). Error: {e}')
+            return False
+
+    async def __start_readiness(self, name: str, version: int, live_model: LiveModel) -> bool:
+        ''' Resolve the model's readiness future and publish readiness to the registry.
+        Unregister model if it could not get ready
+
+        :return: True if model is ready; False otherwise
+        '''
+        key = ModelServingService.get_key(name, version)
+        future = self.READY[(name, version)]
+        try:
+            is_ready = await self.__wait_until_ready(name, version, live_model)
+        except Exception as e:
+            print(f'\t[EXCEPTION] Readiness probe failed for ({name}, {version}). Error: {e}')
+            is_ready = False
+
+        if is_ready:
+            # False if killed while starting
+            is_ready = await self.__run(self.__set_ready, key, live_model.memory)
+        else:
+            await self.kill_model(name, version)
+
+        self.READY.pop((name, version), None)
+        future.set_result(is_ready)
+
+        return is_ready
+
+    def __set_ready(self, key: str, memory: int) -> bool:
+        ''' Publish a model's readiness to the registry. Blocking
+
+        :return: True if the model is registered; False if it was killed while starting
+        '''
+        with self.REGISTRY.transaction() as state:
+            if key not in state['models']:
+                return False
+
+            state['models'][key]['status'] = LiveModel.READY
+            state['models'][key]['memory'] = memory
+            state['memory_hints'][key] = memory
+
+            return True
+
+    def __unregister_model(self, key: str) -> None:
+        ''' Blocking
+        '''
+        with self.REGISTRY.transaction() as state:
+            state['models'].pop(key, None)
+
+    async def wait_until_ready(self, name: str, version: int) -> Optional[LiveModel]:
+        ''' Await the model's readiness. Concurrent callers of this process share the same readiness future;
+        callers of other processes follow the model's status in the registry
+
+        :return: the ready LiveModel; None if model could not get ready
+        '''
+        key = ModelServingService.get_key(name, version)
+
+        future = self.READY.get((name, version))
+        if future is not None and not await asyncio.shield(future):
+            return None
+
+        while True:
+            entry = (await self.__run(self.REGISTRY.read))['models'].get(key)
+            if entry is None:
+                return None
+
+            live_model = LiveModel.from_dict(entry)
+            if live_model.is_ready():
+                return live_model
+
+            # Stale claim: owner process died or startup timed out
+            if ModelServingService.get_process_start_time(live_model.owner) is None or \
+                    (datetime.now() - live_model.started_at).total_seconds() > self.READY_TIMEOUT:
+                print(f'\t[WARN] Stale startup of model ({name}, {version}) by process {live_model.owner}')
+                await self.kill_model(name, version)
+                return None
+
+            await asyncio.sleep(self.READY_POLL_INTERVAL)
+
+    def __touch(self, name: str, version: int) -> Optional[LiveModel]:
+        ''' Get live model and update its last used time. Blocking
+
+        :return: LiveModel; None if model is not live
+        '''
+        key = ModelServingService.get_key(name, version)
+        entry = self.REGISTRY.read()['models'].get(key)
+        if entry is None:
+            return None
+
+        now = datetime.now()
+        live_model = LiveModel.from_dict(entry)
+
+        # Update TTL; avoid taking the write lock on every prediction
+        if (now - live_model.last_used).total_seconds() >= self.LAST_USED_RESOLUTION:
+            with self.REGISTRY.transaction() as state:
+                if key not in state['models']:
+                    return None
+                state['models'][key]['last_used'] = now.timestamp()
+                live_model = LiveModel.from_dict(state['models'][key])
+
+        return live_model
+
     async def serve(self,
                     name: str,
                     version: int,
                     no_conda: bool=False,
                     base_uri: str='models') -> Result:
-        ''' Serve model as REST endpoint
+        ''' Serve model as REST endpoint from a warm pool worker
+
+        Models are loaded in long-lived worker processes, one per conda environment. Returns only once the
+        worker's health endpoint answers and the model is loaded. Least recently used models are evicted to
+        respect the max. number of live models and the memory ceiling.
 
         :param name: name of the registered model
         :param version: version of the model
         :param no_conda: (optional) [default False] use conda environment if False; otherwise True
-        :param prepare_env: (optional) [default False] prepare conda environment if True; otherwise False. Should be True on for first prediction
         :param base_uri: (option) base model uri to use: 'runs' or 'models'. If 'runs' is used then [[name]] is the [run_id] and [[version]] the [model name]
 
-        :return: REST endpoint port on success; None otherwise 
+        :return: Result object: data is {'port': <worker port>, 'path': <model invocations path>} on success
         '''
-        # TODO verify serving limits; e.g. self.MAX_MODELS
         try:
             print('[INFO] Serve model')
+            path = f'/invocations/{name}/{version}'
+
             # Check if model is being served
-            if self.MODELS.get((name, version)) is not None:
+            live_model = await asyncio.get_event_loop().run_in_executor(None, self.__touch, name, version)
+            if live_model is not None:
                 print(f'[INFO] Already serving model ({name}, {version})')
 
-                port = self.MODELS.get((name, version))[0]
-                process = self.MODELS.get((name, version))[1]
-                model_serving_timestamp = datetime.now()
-                # Update TTL
-                self.MODELS[(name, version)] = (port, process, model_serving_timestamp)
+                # Model may still be starting
+                if not live_model.is_ready():
+                    live_model = await self.wait_until_ready(name, version)
+
+                if live_model is None:
+                    return Result(Result.FAIL,
+                                  f"Model ({name}, {version}) failed to start",
+                                  Result.EXCEPTION)
+
                 return Result(Result.SUCCESS,
-                              f"Serving {(name, version)}: ({port}, {process.pid}, {model_serving_timestamp})",
-                              {'port': port})
-            
-            port = self.OPEN_PORTS[0]
-            
-            cmd = ['mlflow', 'models', 'serve', '-m', f'{base_uri}:/{name}/{version}', '-p', str(port)]
-            prepare_env_cmd = ['mlflow', 'models', 'prepare-env', '--model-uri', f'{base_uri}:/{name}/{version}']
-                
-            # Check conda env
-            has_conda_env, project_env_name = await ModelServingService.__has_conda_env(name, str(version))
+                              f"Serving {(name, version)}: ({live_model.port}, {live_model.pid}, {live_model.last_used})",
+                              {'port': live_model.port, 'path': path})
 
-            if no_conda:
-                cmd.append('--no-conda')
-                
-            # Install conda environment on first prediction.
-            # If env. is not prepared, first prediction fails!
-            conda.get_or_create_conda_env(project_env_name)
+            # Single-flight: only one startup runs per model; concurrent callers await it
+            if self.STARTUPS.in_flight((name, version)):
+                print(f'[INFO] Model ({name}, {version}) is starting. Awaiting startup.')
 
-            process = subprocess.Popen(cmd, env=os.environ.copy(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            return await self.STARTUPS.do((name, version), self.__start_model, name, version, no_conda, base_uri)
 
-            # subprocess is dead
-            if process.returncode is not None:
-                print("\t[WARN] Process returned code != 0")
-                return Result(Result.FAIL,
-                              f"Process returned code != 0")
+        except Exception as e:
+            print(f"\t[EXCEPTION] Could not start REST endpoint service for model with name '{name}' and version '{version}'. Error: '{e}'")
+            return Result(Result.FAIL,
+                          f"Could not start REST endpoint service for model with name '{name}' and version '{version}'",
+                          Result.EXCEPTION)
+
+    def __claim_startup(self, key: str) -> bool:
+        ''' Claim the startup of a model that is not live. Blocking
+
+        :return: True if claimed; False if the model is live or being started, e.g. by another process
+        '''
+        with self.REGISTRY.transaction() as state:
+            if key in state['models']:
+                return False
+
+            state['models'][key] = LiveModel(port=None,
+                                             pid=None,
+                                             last_used=datetime.now(),
+                                             memory=state['memory_hints'].get(key, 0),
+                                             status=LiveModel.STARTING,
+                                             owner=os.getpid()).to_dict()
+
+            return True
+
+    def __get_or_reserve_worker(self, key: str, env_key: str) -> Tuple[Optional[dict], Optional[int]]:
+        ''' Get the environment's live pool worker, or reserve a port to start one. Blocking
+
+        :return: (worker, None) if the worker is alive; (None, reserved port) if a worker must be started;
+                 (None, None) if the model was killed while starting
+        '''
+        with self.REGISTRY.transaction() as state:
+            if key not in state['models']:
+                return None, None
+
+            worker = state['workers'].get(env_key)
+            if worker is not None and not ModelServingService.is_worker_alive(worker):
+                print(f"\t[WARN] Pool worker for env '{env_key}' is dead. Restarting.")
+                self.__stop_worker(state, env_key)
+                worker = None
+
+            if worker is not None:
+                return worker, None
+
+            return None, self.__reserve_port(state)
+
+    def __register_model_worker(self, key: str, env_key: str, worker: dict) -> Optional[LiveModel]:
+        ''' Register the model on its pool worker; a worker started by this process is registered too. If another
+        process registered a live worker for the environment meanwhile, it is used and this process' worker is
+        stopped. Blocking
+
+        :return: the starting LiveModel; None if the model was killed while starting
+        '''
+        stale_worker = None
+        with self.REGISTRY.transaction() as state:
+            if state['reserved_ports'].pop(str(worker['port']), None) is not None:
+                registered = state['workers'].get(env_key)
+                if registered is not None and ModelServingService.is_worker_alive(registered):
+                    stale_worker, worker = worker, registered
+                elif key in state['models']:
+                    if registered is not None:
+                        self.__stop_worker(state, env_key)
+                    state['workers'][env_key] = worker
+                else:
+                    stale_worker = worker
+
+            if key in state['models']:
+                state['models'][key]['port'] = worker['port']
+                state['models'][key]['pid'] = worker['pid']
+                state['models'][key]['env'] = env_key
+                live_model = LiveModel.from_dict(state['models'][key])
+            else:
+                live_model = None
+
+        if stale_worker is not None:
+            self.__kill_worker_process(stale_worker)
+
+        return live_model
+
+    async def __start_model(self,
+                            name: str,
+                            version: int,
+                            no_conda: bool,
+                            base_uri: str) -> Result:
+        ''' Start serving a model that is not live. Must only run through self.STARTUPS
+
+        :return: Result object: data is {'port': <worker port>, 'path': <model invocations path>} on success
+        '''
+        key = ModelServingService.get_key(name, version)
+        path = f'/invocations/{name}/{version}'
+        failed_result = Result(Result.FAIL,
+                               f"Model ({name}, {version}) failed to start",
+                               Result.EXCEPTION)
+        claimed = False
 
-            # update
-            model_serving_timestamp = datetime.now()
-            self.MODELS[(name, version)] = (port, process, model_serving_timestamp)
-            self.OPEN_PORTS = self.OPEN_PORTS[1:]
+        try:
+            # Claim the startup; another server process may have claimed it first
+            loop = asyncio.get_event_loop()
+            claimed = await loop.run_in_executor(None, self.__claim_startup, key)
+
+            if not claimed:
+                print(f'[INFO] Model ({name}, {version}) is being started by another process. Awaiting startup.')
+                live_model = await self.wait_until_ready(name, version)
+                if live_model is None:
+                    return failed_result
+
+                return Result(Result.SUCCESS,
+                              f"Serving {(name, version)}: ({live_model.port}, {live_model.pid}, {live_model.last_used})",
+                              {'port': live_model.port, 'path': path})
 
-            print(f"\t[INFO] Started serving {(name, version)}: ({port}, {process.pid}, {model_serving_timestamp})")
+            # Make room for the new model; use last known memory usage of the model if any
+            memory_hint = (await loop.run_in_executor(None, self.REGISTRY.read))['memory_hints'].get(key, 0)
+            await self.evict(required_memory=memory_hint, required_models=1, exclude=(name, version))
+
+            if no_conda:
+                env_key = ModelServingService.NO_CONDA_ENV
+                python_path = sys.executable
+            else:
+                # Install conda environment on first prediction; resolved envs. are cached per model version
+                prepare_env_result = await CondaEnvService.prepare_env_async(name, version)
+                if prepare_env_result.is_fail():
+                    raise Exception(prepare_env_result.message)
+
+                env_key = prepare_env_result.data['env_name']
+                python_path = prepare_env_result.data['python_path']
+
+            # Reuse the environment's worker if it is alive; otherwise start one outside the registry lock
+            worker, port = await loop.run_in_executor(None, self.__get_or_reserve_worker, key, env_key)
+            if worker is None and port is None:
+                print(f'\t[WARN] Model ({name}, {version}) was killed while starting')
+                return failed_result
+
+            if worker is None:
+                try:
+                    worker = await loop.run_in_executor(None, self.__start_worker, env_key, python_path, port)
+                except Exception:
+                    await loop.run_in_executor(None, self.__release_port, port)
+                    raise
+
+            live_model = await loop.run_in_executor(None, self.__register_model_worker, key, env_key, worker)
+            if live_model is None:
+                print(f'\t[WARN] Model ({name}, {version}) was killed while starting')
+                return failed_result
+
+            # Concurrent requests for the model await the same readiness future
+            self.READY[(name, version)] = asyncio.get_event_loop().create_future()
+
+            if not await self.__start_readiness(name, version, live_model):
+                return failed_result
+
+            print(f"\t[INFO] Started serving {(name, version)}: ({live_model.port}, {live_model.pid}, {live_model.last_used})")
 
             return Result(Result.SUCCESS,
-                          f"Serving {(name, version)}: ({port}, {process.pid}, {model_serving_timestamp})",
-                          {'port': port})
+                          f"Serving {(name, version)}: ({live_model.port}, {live_model.pid}, {live_model.last_used})",
+                          {'port': live_model.port, 'path': path})
 
         except Exception as e:
             print(f"\t[EXCEPTION] Could not start REST endpoint service for model with name '{name}' and version '{version}'. Error: '{e}'")
+            if claimed:
+                await self.kill_model(name, version)
             return Result(Result.FAIL,
                           f"Could not start REST endpoint service for model with name '{name}' and version '{version}'",
                           Result.EXCEPTION)
 
+    def __kill_model(self, key: str) -> Tuple[Optional[dict], bool]:
+        ''' Unregister a model; its pool worker is stopped once it holds no models. Blocking
+
+        :return: (the model's registry entry, None if not registered; True if the model must be unloaded from its
+                  worker, which is still running)
+        '''
+        unload = False
+        with self.REGISTRY.transaction() as state:
+            entry = state['models'].pop(key, None)
+            if entry is not None and entry['env'] is not None and entry['env'] in state['workers']:
+                if not any(m['env'] == entry['env'] for m in state['models'].values()):
+                    self.__stop_worker(state, entry['env'])
+                else:
+                    unload = True
+
+        return entry, unload
+
     async def kill_model(self,
                          name: str,
                          version: int) -> Result:
-        ''' Kill model's REST endpoint
+        ''' Unload model from its pool worker. The worker is stopped once it holds no models
 
         :param name: name of the registered model
         :param version: version of the model
@@ -210,35 +751,35 @@ class ModelServingService:
         '''
         try:
             print(f'[INFO] Kill live model ({name}, {version})')
-            model_serving_data = self.MODELS.get((name, version))
-            if model_serving_data is None:
+            key = ModelServingService.get_key(name, version)
+            entry, unload = await self.__run(self.__kill_model, key)
+
+            if entry is None:
                 print('\t[WARN] Could not get live model port.')
                 return Result(Result.FAIL,
                               'Could not get live model port.',
                               Result.NOT_FOUND)
 
-            port = model_serving_data[0]
-            pro = model_serving_data[1]
-            model_serving_timestamp = model_serving_data[2]
+            live_model = LiveModel.from_dict(entry)
 
-            # TODO review and verify status code
-            #pid.kill()
-            # alternative SIGTERM
-            os.killpg(os.getpgid(pro.pid), signal.SIGKILL)  # Send the signal to all the process groups
+            if unload:
+                try:
+                    session = await self.__get_session()
+                    async with session.post(f'http://127.0.0.1:{live_model.port}/unload/{name}/{version}',
+                                            timeout=aiohttp.ClientTimeout(total=30)) as resp:
+                        await resp.read()
+                except Exception as e:
+                    print(f'\t[WARN] Could not unload model ({name}, {version}) from pool worker. Error: {e}')
 
-            self.MODELS.pop((name, version)) # delete pid
-            self.OPEN_PORTS.append(port) # add port to open ports
-            self.OPEN_PORTS = sorted(self.OPEN_PORTS)
-            print(f"\t[INFO] Killed live model ({name}, {version}): ({port}, {pro.pid}, {model_serving_timestamp})")
-            print("\t[DEBUG] Process status", pro.poll())
+            print(f"\t[INFO] Killed live model ({name}, {version}): ({live_model.port}, {live_model.pid}, {live_model.last_used})")
 
             return Result(Result.SUCCESS,
-                          f"Killed live model ({name}, {version}): ({port}, {pro.pid})",
+                          f"Killed live model ({name}, {version}): ({live_model.port}, {live_model.pid})",
                           {'model_name': name,
                            'model_version': version,
-                           'port': port,
-                           'pid': pro.pid,
-                           'timestamp': model_serving_timestamp
+                           'port': live_model.port,
+                           'pid': live_model.pid,
+                           'timestamp': live_model.last_used
                            }
                           )
         except Exception as e:
@@ -250,51 +791,215 @@ class ModelServingService:
     def get_port(self,
                  name: str,
                 version: int) -> Optional[int]:
-        model_serving_data = self.MODELS.get((name, version))
+        live_model = self.get_live_models().get((name, version))
 
-        if model_serving_data is None:
+        if live_model is None:
             return False
         
-        return model_serving_data[0]
+        return live_model.port
+
+    def __remove_dead_workers(self) -> None:
+        ''' Unregister dead pool workers and their models. Blocking
+        '''
+        with self.REGISTRY.transaction() as state:
+            for env_key in list(state['workers']):
+                if not ModelServingService.is_worker_alive(state['workers'][env_key]):
+                    print(f"[INFO] Removing dead pool worker for env '{env_key}'")
+                    self.__stop_worker(state, env_key)
+                    for k in [k for k, m in state['models'].items() if m['env'] == env_key]:
+                        state['models'].pop(k)
+        self.__reap()
 
     async def kill(self) -> None:
-        ''' Kill live models using configs: max serving time, concurrency, etc
+        ''' Kill live models using configs: max serving time, concurrency, memory, etc
         '''
         datetime_now = datetime.now()
         datetime_now_str = datetime_now.strftime('%Y-%m-%d %H:%M')
         print(f'[INFO] Kill model service. Time: {datetime_now_str}')
-        for k in self.MODELS:
-            time_delta = datetime_now - self.MODELS[k][2]
+
+        # Drop dead workers and their models; e.g. after a server restart
+        await self.__run(self.__remove_dead_workers)
+
+        live_models = await self.__run(self.get_live_models)
+        for k in live_models:
+            time_delta = datetime_now - live_models[k].last_used
             print(f'[DEBUG] Kill or not {k}? Delta: {time_delta.seconds}; {time_delta.seconds >= self.TTL}')
-            if time_delta.seconds >= self.TTL:
+            if time_delta.seconds >= self.TTL and (live_models[k].is_ready() or time_delta.seconds >= self.READY_TIMEOUT):
                 kill_result = await self.kill_model(k[0], int(k[1]))
                 print(f'[DEBUG] Kill Result ({k[0]}, {k[1]}): {kill_result.to_dict()}')
 
-    def get_sorted_keys_by_datetime(self) -> List[Tuple[str, int]]:
-        ''' Return sorted list of tuples by datetime
+        # Models grow in memory after their first predictions
+        await self.refresh_memory()
+        evicted = await self.evict()
+        print(f'[DEBUG] Evicted models: {evicted}')
+
+    def get_sorted_keys_by_datetime(self,
+                                    live_models: Optional[Dict[Tuple[str, int], LiveModel]] = None) -> List[Tuple[str, int]]:
+        ''' Return sorted list of tuples by datetime; least recently used first
         '''
-        return sorted(self.MODELS, key=lambda x: self.MODELS[x][2])
+        live_models = self.get_live_models() if live_models is None else live_models
 
-    def get_lru(self) -> Optional[Tuple[str, int]]:
-        '''Get least recently used model by datetime
+        return sorted(live_models, key=lambda x: live_models[x].last_used)
+
+    def get_lru(self,
+                live_models: Optional[Dict[Tuple[str, int], LiveModel]] = None,
+                exclude: Optional[Tuple[str, int]] = None) -> Optional[Tuple[str, int]]:
+        '''Get least recently used ready model by datetime
         '''
-        sorted_keys = self.get_sorted_keys_by_datetime()
+        live_models = self.get_live_models() if live_models is None else live_models
+        sorted_keys = [k for k in self.get_sorted_keys_by_datetime(live_models)
+                       if k != exclude and live_models[k].is_ready()]
+
+        return sorted_keys[0] if len(sorted_keys) > 0 else None
+
+    async def __post(self, url: str, columns: List[str], data: List[List]) -> Tuple[int, bytes]:
+        session = await self.__get_session()
+        async with session.post(url,
+                                headers={'Content-Type': 'application/json'},
+                                data=json.dumps({'columns': columns, 'data': data})) as resp:
+            return resp.status, await resp.read()
 
-        return sorted_keys[-1] if len(sorted_keys) > 0 else None
+    async def __invoke_batch(self, key: Tuple[str, Tuple[str, ...]], batch: List[List[List]]) -> List[Tuple[int, bytes]]:
+        ''' Send a batch of requests sharing the same columns as a single invocation and split the predictions
+
+        :param key: (invocations url, columns)
+        :param batch: list of the requests' rows
+
+        :return: list of (status, response body), one per request
+        '''
+        url, columns = key
+        if len(batch) == 1:
+            return [await self.__post(url, list(columns), batch[0])]
+
+        status, body = await self.__post(url, list(columns), [row for rows in batch for row in rows])
+        try:
+            if status == 200 and PredictionDecoder.get_error(body) is None:
+                parts = PredictionDecoder.split(PredictionDecoder.decode(body), [len(rows) for rows in batch])
+                return [(status, part) for part in parts]
+        except ValueError as e:
+            print(f'[WARN] Failed to split batch predictions of {url}: {e}')
+
+        # A bad request fails the whole batch; isolate it by invoking requests one by one
+        print(f'[WARN] Batch of {len(batch)} requests failed for {url}. Retrying requests individually.')
+        return await asyncio.gather(*[self.__post(url, list(columns), rows) for rows in batch])
+
+    async def invoke(self, port: int, path: str, columns: List[str], data: List[List]) -> Tuple[int, bytes]:
+        ''' Run prediction on a served model. Concurrent requests of the same model are coalesced into a single
+        invocation when micro batching is enabled
+
+        :param port: port of the model's pool worker; see serve
+        :param path: invocations path of the model; see serve
+        :param columns: input columns
+        :param data: input rows
+
+        :return: (status, response body) as returned by the model worker
+        '''
+        key = (f'http://127.0.0.1:{port}{path}', tuple(columns))
+        if not self.MICRO_BATCHING:
+            return await self.__post(key[0], columns, data)
+
+        return await self.BATCHER.submit(key, data, len(data))
+
+    async def is_prediction_cache_enabled(self, name: str) -> bool:
+        ''' Check if a model opted in to prediction caching; the setting is kept for settings_ttl seconds
+        '''
+        enabled, expires_at = self.CACHE_SETTINGS.get(name, (False, 0))
+        if time.monotonic() < expires_at:
+            return enabled
+
+        # Avoid circular import
+        from services.mlflow_service import MLflowService
+
+        result = await asyncio.get_event_loop().run_in_executor(None, MLflowService.get_model, name)
+        enabled = result.is_success() and result.data.tags.get(MLflowService.PREDICTION_CACHE_TAG) == 'true'
+        self.CACHE_SETTINGS[name] = (enabled, time.monotonic() + PREDICTION_CACHE_CONFIG['settings_ttl'])
+
+        return enabled
+
+    async def predict_rows(self, name: str, version: int, columns: List[str], data: List[List]) -> Result:
+        ''' Run prediction on input rows, serving the model if needed. Rows of models that opted in to prediction
+        caching are looked up in the cache first and only the missing rows are scored
+
+        :param name: name of the registered model
+        :param version: version of the model
+        :param columns: input columns
+        :param data: input rows
+
+        :return: Result object: data is (status, response body) as returned by the model worker on success
+        '''
+        try:
+            loop = asyncio.get_event_loop()
+            keys = None
+            cached = {}
+            if await self.is_prediction_cache_enabled(name):
+                keys = [PredictionCache.get_key(name, version, columns, row) for row in data]
+                cached = await loop.run_in_executor(None, self.PREDICTION_CACHE.get_many, keys)
+
+            misses = [i for i in range(len(data)) if keys is None or keys[i] not in cached]
+
+            # Without caching the model is always invoked, e.g. on empty input
+            if keys is None or len(misses) > 0:
+                serve_result = await self.serve(name, version)
+                if serve_result.is_fail():
+                    return serve_result
+
+                status, body = await self.invoke(serve_result.data['port'], serve_result.data['path'],
+                                                 columns, [data[i] for i in misses])
+                if keys is None or status != 200 or PredictionDecoder.get_error(body) is not None:
+                    return Result(Result.SUCCESS, 'Invoked model', (status, body))
+
+                # Only array and records predictions are per row; other outputs are never cached
+                decoded = PredictionDecoder.decode(body)
+                if decoded.kind not in (PredictionDecoder.DecodedPredictions.ARRAY, PredictionDecoder.DecodedPredictions.RECORDS) \
+                        or len(decoded) != len(misses):
+                    if len(misses) < len(data):
+                        # body only holds the output of the missing rows; score all rows instead
+                        status, body = await self.invoke(serve_result.data['port'], serve_result.data['path'],
+                                                         columns, data)
+                    return Result(Result.SUCCESS, 'Invoked model', (status, body))
+
+                scored = [(keys[i], json.dumps(prediction).encode('utf-8')) for i, prediction in zip(misses, decoded.predictions)]
+                await loop.run_in_executor(None, self.PREDICTION_CACHE.put_many, scored)
+                cached.update(scored)
+
+            # same serialization as the scoring server: a json array of per-row predictions
+            body = b'[' + b', '.join(cached[key] for key in keys) + b']'
+
+            return Result(Result.SUCCESS, 'Predicted from cache', (200, body))
+        except Exception as e:
+            print(f"[EXCEPTION] Could not predict using model with name '{name}' and version '{version}'. Error: '{e}'")
+            return Result(Result.FAIL,
+                          f"Could not predict using model with name '{name}' and version '{version}'",
+                          Result.EXCEPTION)
+
+    async def invoke_raw(self, port: int, path: str, body: bytes, content_type: str = 'application/json') -> Tuple[int, bytes]:
+        ''' Run prediction on a served model without micro batching; e.g. for the large chunks of batch jobs
+
+        :param port: port of the model's pool worker; see serve
+        :param path: invocations path of the model; see serve
+        :param body: request body
+        :param content_type: (optional) [default 'application/json'] content type of body
+
+        :return: (status, response body) as returned by the model worker
+        '''
+        session = await self.__get_session()
+        async with session.post(f'http://127.0.0.1:{port}{path}', headers={'Content-Type': content_type}, data=body) as resp:
+            return resp.status, await resp.read()
 
     async def list_endpoints(self) -> Result:
         '''Used in endpoint
         '''
         try:
-            active_endpoints = {}
-            for k in self.MODELS:
-                # cannot serialize tuple key object
-                active_endpoints[k[0]+"_"+str(k[1])] = (self.MODELS[k][0],
-                                                        self.MODELS[k][1].pid,
-                                                        self.MODELS[k][2])
+            state = await self.__run(self.REGISTRY.read)
+            live_models = {ModelServingService.parse_key(k): LiveModel.from_dict(v) for k, v in state['models'].items()}
             return Result(Result.SUCCESS,
                           'Successfully fetched live models endpoints',
-                          {'active_endpoints': active_endpoints})
+                          {'active_endpoints': state['models'],
+                           'workers': state['workers'],
+                           'used_memory': self.get_used_memory(live_models),
+                           'max_memory': self.MAX_MEMORY,
+                           'max_models': self.MAX_MODELS,
+                           'prediction_cache': self.PREDICTION_CACHE.stats()})
         except Exception as e:
             print(f"[EXCEPTION] Failed to list REST endpoint. Error: '{e}'")
             return Result(Result.FAIL,
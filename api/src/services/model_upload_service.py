@@ -1,15 +1,31 @@
 from db.db_config import session
 from models.result import Result
 from models.model_upload import ModelUpload
-from typing import Optional
-from datetime import datetime
+from sqlalchemy import and_, func, select
+from sqlalchemy.orm import aliased
+from typing import List, Optional
+from datetime import datetime, timedelta
+import os
 
 class ModelUploadService:
 
     @staticmethod
-    def create(user_id: int, model_name: Optional[str]=None, model_version: Optional[int]=None) -> Result:
+    def create(user_id: int,
+               model_name: Optional[str]=None,
+               model_version: Optional[int]=None,
+               status: str=ModelUpload.RUNNING,
+               **values) -> Result:
+        ''' Create model upload
+
+        :param user_id: the user's id
+        :param status: upload status; e.g. ModelUpload.QUEUED
+        :param values: other ModelUpload columns; e.g. upload_path
+
+        :return: Result objet with ModelUpload data
+        '''
         try:
-            model_upload = ModelUpload(user_id=user_id, model_name=model_name, model_version=model_version)
+            model_upload = ModelUpload(user_id=user_id, model_name=model_name, model_version=model_version,
+                                       status=status, started_at=datetime.now(), **values)
             session.add(model_upload)
             session.commit()
 
@@ -54,6 +70,159 @@ class ModelUploadService:
                           Result.EXCEPTION
                           )
 
+    @staticmethod
+    def get_registered_by_content_hash(user_id: int, content_hash: str) -> Result:
+        ''' Get the latest finished upload of a user with an identical zip file
+
+        :param user_id: the user's id
+        :param content_hash: the zip file's sha256
+
+        :return: Result objet with ModelUpload data
+        '''
+        try:
+            model_upload = session.query(ModelUpload).filter(ModelUpload.user_id == user_id,
+                                                             ModelUpload.content_hash == content_hash,
+                                                             ModelUpload.status == ModelUpload.FINISHED,
+                                                             ModelUpload.model_version.isnot(None)) \
+                .order_by(ModelUpload.id.desc()).first()
+
+            if model_upload is None:
+                return Result(Result.FAIL,
+                              f'No model upload with content hash {content_hash} was found',
+                              Result.NOT_FOUND)
+
+            return Result(Result.SUCCESS,
+                          f'Successfully fetched model upload with content hash {content_hash}',
+                          model_upload)
+        except Exception as e:
+            print(f'[EXCEPTION] Failed to fetch model upload with content hash {content_hash}. Exception {e}')
+            return Result(Result.FAIL,
+                          f'Failed to fetch model upload with content hash {content_hash}',
+                          Result.EXCEPTION)
+
+    @staticmethod
+    def count(statuses: List[str], user_id: Optional[int]=None) -> Result:
+        ''' Count model uploads by status
+
+        :param statuses: upload statuses
+        :param user_id: (optional) the user's id
+
+        :return: Result objet with count data
+        '''
+        try:
+            query = session.query(func.count(ModelUpload.id)).filter(ModelUpload.status.in_(statuses))
+            if user_id is not None:
+                query = query.filter(ModelUpload.user_id == user_id)
+
+            return Result(Result.SUCCESS,
+                          'Successfully counted model uploads',
+                          query.scalar())
+        except Exception as e:
+            print(f'[EXCEPTION] Failed to count model uploads. Exception {e}')
+            return Result(Result.FAIL,
+                          'Failed to count model uploads',
+                          Result.EXCEPTION)
+
+    @staticmethod
+    def claim_queued(worker_id: str, max_running_user: int) -> Optional[ModelUpload]:
+        ''' Claim the next queued upload. Users with fewer running uploads go first, then oldest uploads first; users
+        already running max_running_user uploads are skipped. Rows are locked with skip locked, thus concurrent
+        workers claim different uploads
+
+        :param worker_id: id of the claiming worker
+        :param max_running_user: max number of running uploads per user
+
+        :return: the claimed ModelUpload; None if no upload is claimable
+        '''
+        try:
+            running = aliased(ModelUpload)
+            user_running = select([func.count(running.id)]) \
+                .where(and_(running.user_id == ModelUpload.user_id, running.status == ModelUpload.RUNNING)) \
+                .as_scalar()
+
+            model_upload = session.query(ModelUpload) \
+                .filter(ModelUpload.status == ModelUpload.QUEUED,
+                        ModelUpload.upload_path.isnot(None),
+                        user_running < max_running_user) \
+                .order_by(user_running, ModelUpload.id) \
+                .with_for_update(skip_locked=True) \
+                .first()
+
+            if model_upload is None:
+                session.commit()
+                return None
+
+            model_upload.status = ModelUpload.RUNNING
+            model_upload.worker_id = worker_id
+            model_upload.attempts += 1
+            model_upload.started_at = datetime.now()
+            model_upload.heartbeat_at = datetime.now()
+            session.commit()
+
+            return model_upload
+        except Exception as e:
+            session.rollback()
+            print(f'[EXCEPTION] Failed to claim queued model upload. Exception {e}')
+            return None
+
+    @staticmethod
+    def heartbeat(id: int, worker_id: str) -> bool:
+        ''' Record a sign of life of the worker running an upload
+
+        :return: True if the upload is still run by worker_id; False otherwise, e.g. it was recovered
+        '''
+        try:
+            updated = session.query(ModelUpload) \
+                .filter(ModelUpload.id == id, ModelUpload.worker_id == worker_id, ModelUpload.status == ModelUpload.RUNNING) \
+                .update({'heartbeat_at': datetime.now()}, synchronize_session=False)
+            session.commit()
+
+            return updated == 1
+        except Exception as e:
+            session.rollback()
+            print(f'[EXCEPTION] Failed to record heartbeat of model upload with id {id}. Exception {e}')
+            return True
+
+    @staticmethod
+    def recover_stale(stale_timeout: int, max_attempts: int) -> List[ModelUpload]:
+        ''' Recover running uploads without heartbeats for stale_timeout seconds, e.g. their worker crashed. Uploads are
+        queued again unless they ran max_attempts times or their zip file is gone
+
+        :param stale_timeout: time (seconds) without heartbeats
+        :param max_attempts: max number of runs of an upload
+
+        :return: list of the uploads that failed
+        '''
+        failed = []
+        try:
+            threshold = datetime.now() - timedelta(seconds=stale_timeout)
+            stale = session.query(ModelUpload) \
+                .filter(ModelUpload.status == ModelUpload.RUNNING,
+                        func.coalesce(ModelUpload.heartbeat_at, ModelUpload.started_at) < threshold) \
+                .with_for_update(skip_locked=True) \
+                .all()
+
+            for model_upload in stale:
+                model_upload.worker_id = None
+                model_upload.heartbeat_at = None
+                if model_upload.attempts < max_attempts and model_upload.upload_path is not None \
+                        and os.path.exists(model_upload.upload_path):
+                    print(f'[WARN] Queueing stale model upload with id {model_upload.id} again')
+                    model_upload.status = ModelUpload.QUEUED
+                else:
+                    print(f'[WARN] Failing stale model upload with id {model_upload.id}')
+                    model_upload.status = ModelUpload.FAILED
+                    model_upload.finished_at = datetime.now()
+                    failed.append(model_upload)
+
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            print(f'[EXCEPTION] Failed to recover stale model uploads. Exception {e}')
+            return []
+
+        return failed
+
     @staticmethod
     def list(user_id: Optional[int]=None, status: Optional[str]=None) -> Result:
         ''' List model uploads. If both args. are None, list all
@@ -92,12 +261,16 @@ class ModelUploadService:
                model_name: Optional[str]=None,
                model_version: Optional[int]=None,
                status: Optional[str]=None,
-               finished_at: Optional[datetime]=None) -> Result:
+               finished_at: Optional[datetime]=None,
+               file_size: Optional[int]=None,
+               content_hash: Optional[str]=None) -> Result:
         ''' Update user model upload
 
         :param user_id: the user's id
         :param status: upload status
         :param finished_at: finished upload datetime
+        :param file_size: uploaded zip file's size (bytes)
+        :param content_hash: uploaded zip file's sha256
 
         :return: Result objet with ModelUpload data
         '''
@@ -120,6 +293,10 @@ class ModelUploadService:
                 model_upload.model_name = model_name
             if model_version is not None:
                 model_upload.model_version = model_version
+            if file_size is not None:
+                model_upload.file_size = file_size
+            if content_hash is not None:
+                model_upload.content_hash = content_hash
 
             session.commit()
 
@@ -0,0 +1,153 @@
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Iterator, Optional
+
+from sqlalchemy import select
+
+from db.async_db import database, to_model
+from db.db_config import session
+from models.model_upload import ModelUpload
+from models.model_upload_stage import ModelUploadStage
+from models.result import Result
+
+
+class ModelUploadStageService:
+    ''' Records the stages of model uploads. Failures to record are logged only; they never fail the upload
+    '''
+
+    @staticmethod
+    def start(model_upload_id: int, stage: str, attempt: int = 1, started_at: Optional[datetime] = None) -> Optional[int]:
+        ''' Record the start of a stage
+
+        :param model_upload_id: the model upload's id
+        :param stage: the stage; e.g. ModelUploadStage.UNZIP
+        :param attempt: the model upload's attempt
+        :param started_at: (optional) [default now] start datetime
+
+        :return: the stage record's id; None on failure
+        '''
+        try:
+            model_upload_stage = ModelUploadStage(model_upload_id=model_upload_id,
+                                                  stage=stage,
+                                                  attempt=attempt,
+                                                  status=ModelUploadStage.RUNNING,
+                                                  started_at=started_at or datetime.now())
+            session.add(model_upload_stage)
+            session.commit()
+
+            return model_upload_stage.id
+        except Exception as e:
+            session.rollback()
+            print(f'[EXCEPTION] Failed to record stage {stage} of model upload {model_upload_id}. Exception {e}')
+            return None
+
+    @staticmethod
+    def finish(id: Optional[int],
+               status: str = ModelUploadStage.FINISHED,
+               bytes: Optional[int] = None,
+               error: Optional[str] = None,
+               finished_at: Optional[datetime] = None) -> None:
+        ''' Record the end of a stage
+
+        :param id: the stage record's id
+        :param status: ModelUploadStage.FINISHED or ModelUploadStage.FAILED
+        :param bytes: (optional) size of the stage's files
+        :param error: (optional) error message of a failed stage
+        :param finished_at: (optional) [default now] end datetime
+        '''
+        if id is None:
+            return
+
+        try:
+            session.query(ModelUploadStage).filter(ModelUploadStage.id == id) \
+                .update({'status': status,
+                         'finished_at': finished_at or datetime.now(),
+                         'bytes': bytes,
+                         'error': error}, synchronize_session=False)
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            print(f'[EXCEPTION] Failed to record end of model upload stage {id}. Exception {e}')
+
+    @staticmethod
+    def finish_running(model_upload_id: int,
+                       stage: Optional[str] = None,
+                       status: str = ModelUploadStage.FINISHED,
+                       error: Optional[str] = None) -> None:
+        ''' Record the end of a model upload's running stages; e.g. ModelUploadStage.QUEUE once the upload is claimed,
+        or the stages left running by a crashed worker
+
+        :param model_upload_id: the model upload's id
+        :param stage: (optional) the stage; if None, all running stages
+        :param status: ModelUploadStage.FINISHED or ModelUploadStage.FAILED
+        :param error: (optional) error message of failed stages
+        '''
+        try:
+            query = session.query(ModelUploadStage) \
+                .filter(ModelUploadStage.model_upload_id == model_upload_id,
+                        ModelUploadStage.status == ModelUploadStage.RUNNING)
+            if stage is not None:
+                query = query.filter(ModelUploadStage.stage == stage)
+
+            query.update({'status': status, 'finished_at': datetime.now(), 'error': error}, synchronize_session=False)
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            print(f'[EXCEPTION] Failed to record end of running stages of model upload {model_upload_id}. Exception {e}')
+
+    @staticmethod
+    @contextmanager
+    def track(model_upload_id: Optional[int], stage: str, attempt: int = 1) -> Iterator[dict]:
+        ''' Record a stage around a block. The block may set 'bytes' of the yielded dict, and 'error' to record the
+        stage as failed; exceptions are recorded as failures and raised
+
+        :param model_upload_id: the model upload's id; nothing is recorded if None
+        :param stage: the stage
+        :param attempt: the model upload's attempt
+        '''
+        info = {'bytes': None, 'error': None}
+        if model_upload_id is None:
+            yield info
+            return
+
+        id = ModelUploadStageService.start(model_upload_id, stage, attempt)
+        try:
+            yield info
+        except Exception as e:
+            ModelUploadStageService.finish(id, ModelUploadStage.FAILED, info['bytes'], str(e))
+            raise
+
+        status = ModelUploadStage.FINISHED if info['error'] is None else ModelUploadStage.FAILED
+        ModelUploadStageService.finish(id, status, info['bytes'], info['error'])
+
+    @staticmethod
+    async def get_progress_async(model_upload_id: int) -> Result:
+        ''' Get a model upload and its stages
+
+        :param model_upload_id: the model upload's id
+
+        :return: Result object, on success Result.data is the upload's dict with a 'stages' list, in order
+        '''
+        try:
+            record = await database.fetch_one(select([ModelUpload.__table__]).where(ModelUpload.id == model_upload_id))
+
+            if record is None:
+                return Result(Result.FAIL,
+                              f'Model upload with id {model_upload_id} was not found',
+                              Result.NOT_FOUND)
+
+            stage_records = await database.fetch_all(select([ModelUploadStage.__table__])
+                                                     .where(ModelUploadStage.model_upload_id == model_upload_id)
+                                                     .order_by(ModelUploadStage.id))
+
+            progress = to_model(ModelUpload, record).to_dict()
+            progress['stages'] = [to_model(ModelUploadStage, stage_record).to_dict() for stage_record in stage_records]
+
+            return Result(Result.SUCCESS,
+                          f'Successfully fetched progress of model upload with id {model_upload_id}',
+                          progress)
+        except Exception as e:
+            print(f'[EXCEPTION] Failed to fetch progress of model upload with id {model_upload_id}. Exception {e}')
+            return Result(Result.FAIL,
+                          f'Failed to fetch progress of model upload with id {model_upload_id}',
+                          Result.EXCEPTION)
@@ -0,0 +1,211 @@
+'''
+Upload workers: processes, separate from the upload server's HTTP workers, that register queued model uploads.
+
+Uploads are queued in model_uploads by the upload server. Each worker claims one upload at a time and records
+heartbeats while it runs; uploads of crashed workers are recovered by the other workers once their heartbeats stop.
+'''
+import os
+import shutil
+import socket
+import threading
+import time
+import uuid
+from datetime import datetime
+from typing import Optional, Tuple
+
+from config.config import MODEL_UPLOAD_SERVICE_CONFIG
+from db.db_config import begin_session_scope, end_session_scope, session
+from libs.email_lib import Email
+from models.model_upload import ModelUpload
+from models.model_upload_stage import ModelUploadStage
+from models.result import Result
+from services.artifact_store_service import ArtifactStoreService
+from services.conda_env_service import CondaEnvService
+from services.model_registry_service import ModelRegistryService
+from services.model_upload_service import ModelUploadService
+from services.model_upload_stage_service import ModelUploadStageService
+from services.user_service import UserService
+
+
+class UploadWorkerService:
+
+    @staticmethod
+    def send_email(user: Result,
+                   model_name_version: Optional[Tuple[str, int]] = None,
+                   success: bool = True,
+                   deployment_id: Optional[int] = None) -> Result:
+        try:
+            if success:
+                print('[INFO] Sending model deployment SUCCESS e-mail.')
+                Email().send_deployed_model_email(user_name=user.data.name,
+                                                  user_email=user.data.email,
+                                                  model_name=model_name_version[0],
+                                                  model_version=model_name_version[1])
+            else:
+                print('[INFO] Sending model deployment FAIL e-mail.')
+                Email().send_failed_deployed_model_email(user_name=user.data.name,
+                                                         user_email=user.data.email,
+                                                         deployment_id=deployment_id)
+        except Exception as e:
+            print(f'[EXCEPTION] An error occurred while sending an email confirming model deployment status. Exception {e}')
+            return Result(
+                Result.FAIL,
+                'An error occurred while sending an email confirming model deployment status',
+                Result.EXCEPTION
+            )
+
+        return Result(Result.SUCCESS,
+                      'Successfully submitted model deployment job.',
+                      Result.SUCCESS)
+
+    @staticmethod
+    def remove_upload_file(model_upload: ModelUpload) -> None:
+        ''' Remove the upload's directory, created by the upload server for its zip file
+        '''
+        if model_upload.upload_path:
+            shutil.rmtree(os.path.dirname(model_upload.upload_path), ignore_errors=True)
+
+    @staticmethod
+    def fail(model_upload: ModelUpload, user: Result) -> None:
+        _ = ModelUploadService.update(model_upload.id,
+                                      status=ModelUpload.FAILED,
+                                      finished_at=datetime.now())
+        UploadWorkerService.remove_upload_file(model_upload)
+
+        if user.is_success():
+            _ = UploadWorkerService.send_email(user, success=False, deployment_id=model_upload.id)
+
+    @staticmethod
+    def register(model_upload: ModelUpload) -> None:
+        ''' Register the model of an upload and notify its user
+        '''
+        user = UserService.get_user_by_id(model_upload.user_id)
+        if user.is_fail():
+            print(f'[WARN] Failed to register model upload {model_upload.id}. User {model_upload.user_id} was not found')
+            UploadWorkerService.fail(model_upload, user)
+            return
+
+        try:
+            print(f"[INFO] Registrying model of upload {model_upload.id}...")
+            register_model_result = ModelRegistryService.register_model(model_upload.upload_path,
+                                                                        user.data.username,
+                                                                        model_upload_id=model_upload.id,
+                                                                        attempt=model_upload.attempts)
+
+            print(f"[DEBUG] Register model result.is_success(): {register_model_result.is_success()}")
+            print(f"[DEBUG] Register model result: {register_model_result.data}")
+
+            if register_model_result.is_fail():
+                print(f"[INFO] Failed to register model! {register_model_result.message}")
+                UploadWorkerService.fail(model_upload, user)
+                return
+
+            model_version = register_model_result.data
+            ModelRegistryService.update_model_owner(user.data.username, run_id=model_version.run_id)
+
+            print(f"[INFO] Model uploaded successfully.")
+            _ = ModelUploadService.update(model_upload.id,
+                                          model_name=model_version.name,
+                                          model_version=int(model_version.version),
+                                          status=ModelUpload.FINISHED,
+                                          finished_at=datetime.now())
+            UploadWorkerService.remove_upload_file(model_upload)
+
+            _ = UploadWorkerService.send_email(user, model_name_version=(model_version.name, int(model_version.version)),
+                                               success=True)
+
+            # Warm the conda env. so the model's first prediction does not pay for env. creation
+            UploadWorkerService.prepare_env_in_background(model_upload, model_version.name, int(model_version.version))
+
+        except Exception as e:
+            print(f"[INFO] Failed to register model! ERROR: {e}")
+            session.rollback()
+            UploadWorkerService.fail(model_upload, user)
+
+    @staticmethod
+    def prepare_env_in_background(model_upload: ModelUpload, name: str, version: int) -> None:
+        ''' Prepare model version's conda environment in a daemon thread, recorded as the upload's
+        ModelUploadStage.CONDA_ENV stage
+        '''
+        def prepare():
+            try:
+                with ModelUploadStageService.track(model_upload.id, ModelUploadStage.CONDA_ENV, model_upload.attempts) as stage:
+                    result = CondaEnvService.prepare_env(name, version)
+                    if result.is_fail():
+                        stage['error'] = result.message
+                print(f'[INFO] Background conda env. preparation for model ({name}, {version}): {result.message}')
+            except Exception as e:
+                print(f'[EXCEPTION] Failed to prepare conda env. for model ({name}, {version}). Exception {e}')
+            finally:
+                session.remove()
+
+        threading.Thread(target=prepare, name=f'prepare-env-{name}-{version}', daemon=True).start()
+
+    @staticmethod
+    def run_claimed(model_upload: ModelUpload, worker_id: str) -> None:
+        ''' Run a claimed upload, recording heartbeats from a background thread until it is done
+        '''
+        done = threading.Event()
+
+        def heartbeat() -> None:
+            try:
+                while not done.wait(MODEL_UPLOAD_SERVICE_CONFIG['heartbeat_interval']):
+                    if not ModelUploadService.heartbeat(model_upload.id, worker_id):
+                        print(f'[WARN] Model upload {model_upload.id} is no longer run by worker {worker_id}')
+            finally:
+                session.remove()
+
+        heartbeat_thread = threading.Thread(target=heartbeat, daemon=True)
+        heartbeat_thread.start()
+        try:
+            UploadWorkerService.register(model_upload)
+        finally:
+            done.set()
+            heartbeat_thread.join()
+
+    @staticmethod
+    def recover_stale() -> None:
+        for model_upload in ModelUploadService.recover_stale(MODEL_UPLOAD_SERVICE_CONFIG['stale_timeout'],
+                                                             MODEL_UPLOAD_SERVICE_CONFIG['max_attempts']):
+            UploadWorkerService.remove_upload_file(model_upload)
+            ModelUploadStageService.finish_running(model_upload.id, status=ModelUploadStage.FAILED,
+                                                   error='Upload worker stopped')
+            user = UserService.get_user_by_id(model_upload.user_id)
+            if user.is_success():
+                _ = UploadWorkerService.send_email(user, success=False, deployment_id=model_upload.id)
+
+    @staticmethod
+    def run(worker_index: int = 0) -> None:
+        ''' Worker loop: recover stale uploads, then claim and run the next queued upload; sleeps while the queue is
+        empty. Runs until the process is terminated
+        '''
+        worker_id = f'{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}'
+        print(f'[INFO] Upload worker {worker_index} started: {worker_id}')
+
+        # Artifact files already stored are copied instead of uploaded
+        ArtifactStoreService.install()
+
+        while True:
+            token = begin_session_scope()
+            try:
+                UploadWorkerService.recover_stale()
+                model_upload = ModelUploadService.claim_queued(worker_id,
+                                                               MODEL_UPLOAD_SERVICE_CONFIG['max_concurrent_uploads_user'])
+                if model_upload is not None:
+                    print(f'[INFO] Upload worker {worker_id} - running model upload {model_upload.id} '
+                          f'(attempt {model_upload.attempts})')
+                    if model_upload.attempts > 1:
+                        # Stages left running by the worker of the previous attempt
+                        ModelUploadStageService.finish_running(model_upload.id, status=ModelUploadStage.FAILED,
+                                                               error='Upload worker stopped')
+                    else:
+                        ModelUploadStageService.finish_running(model_upload.id, ModelUploadStage.QUEUE)
+                    UploadWorkerService.run_claimed(model_upload, worker_id)
+            except Exception as e:
+                print(f'[EXCEPTION] Upload worker {worker_id} - {e}')
+                model_upload = None
+            finally:
+                end_session_scope(token)
+
+            if model_upload is None:
+                time.sleep(MODEL_UPLOAD_SERVICE_CONFIG['poll_interval'])
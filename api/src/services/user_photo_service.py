@@ -1,7 +1,13 @@
-import libs.utilities as utilities
+from config.config import IMAGE_CONFIG
+from libs.thumbnails import ThumbnailStore
+from typing import Dict, List, Optional
 import os
 
 class UserPhotoService:
+    THUMBNAILS = ThumbnailStore(os.path.join(IMAGE_CONFIG['thumbnails_dir'], 'users'),
+                                f"{IMAGE_CONFIG['static_url']}/users",
+                                IMAGE_CONFIG['photo_size'])
+
     @staticmethod
     def get_user_photo_path(username: str) -> str:
         '''Returns the full path for user's photo directory \n
@@ -17,17 +23,54 @@ class UserPhotoService:
         return full_user_photo_path
 
     @staticmethod
-    def get_user_photo(username: str) -> str:
-        '''Returns user's photo in base64 format
+    def create_user_photo_thumbnail(username: str) -> Optional[str]:
+        '''Creates the thumbnail of user photo's uploaded file
+
+        :param username: Username to use for path
+
+        :return: Thumbnail's URL, None if user photo's directory is empty
+        '''
+        user_photo_path = UserPhotoService.get_user_photo_path(username)
+        files = os.listdir(user_photo_path) if os.path.isdir(user_photo_path) else []
+
+        if len(files) == 0:
+            UserPhotoService.THUMBNAILS.delete(username)
+            return None
+
+        return UserPhotoService.THUMBNAILS.create(os.path.join(user_photo_path, files[0]), username)
+
+    @staticmethod
+    def get_user_photo_url(username: str) -> Optional[str]:
+        '''Returns the URL of user photo's thumbnail
 
-        :param username: Username to use for getting content
+        :param username: Username to use for getting URL
 
-        :return: Base64 string if photo's directory contains file, else None is returned
+        :return: URL string if thumbnail exists, else None is returned
+        '''
+        return UserPhotoService.THUMBNAILS.get_url(username)
+
+    @staticmethod
+    def get_user_photo_urls(usernames: List[str]) -> Dict[str, str]:
+        '''Returns the URLs of thumbnails; usernames without thumbnail are not included
+
+        :param usernames: Usernames to use for getting URLs
+
+        :return: dict of username: URL
+        '''
+        return UserPhotoService.THUMBNAILS.get_urls(usernames)
+
+    @staticmethod
+    def create_missing_thumbnails() -> None:
+        '''Creates the thumbnails of files uploaded before thumbnails existed
         '''
-        photo_path = UserPhotoService.get_user_photo_path(username)
-        files = os.listdir(photo_path)
+        root = os.path.abspath(os.path.join('files', 'users'))
+        if not os.path.isdir(root):
+            return
 
-        if len(files) > 0:
-            return utilities.convert_to_base_64(os.path.join(photo_path, files[0]))
-        
-        return None
\ No newline at end of file
+        for username in os.listdir(root):
+            if UserPhotoService.THUMBNAILS.has(username):
+                continue
+            try:
+                UserPhotoService.create_user_photo_thumbnail(username)
+            except Exception as e:
+                print(f'[WARN] UserPhotoService.create_missing_thumbnails - {username}: {e}')
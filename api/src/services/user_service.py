@@ -1,14 +1,20 @@
 from services.mlflow_service import MLflowService
 from models.model_version import ModelVersion
 from db.db_config import session
-from sqlalchemy import or_
+from sqlalchemy import or_, select, func
+from db.async_db import database, to_model
+from config.config import AUTH_CONFIG
+from libs.ttl_cache import TTLCache
 from models.result import Result
 from models.user import User
+from typing import List
 import schemas.user as UserSchema
 import util.validation as Validation
 
 
 class UserService:
+    # Authenticated users by username; invalidated on user updates
+    PRINCIPALS = TTLCache(AUTH_CONFIG['principal_ttl'], AUTH_CONFIG['max_principals'])
 
     @staticmethod
     def check_login(user: UserSchema.Login) -> Result:
@@ -144,6 +150,84 @@ class UserService:
                 Result.EXCEPTION
             )
 
+    @staticmethod
+    async def get_user_by_username_async(username: str) -> Result:
+        ''' Async get_user_by_username; the user is a transient User object
+        '''
+        try:
+            record = await database.fetch_one(select([User.__table__]).where(User.username == username))
+
+            if record is None:
+                return Result(
+                    Result.FAIL,
+                    'User was not found',
+                    Result.NOT_FOUND
+                )
+
+            return Result(
+                Result.SUCCESS,
+                'Successfully retrieved user',
+                to_model(User, record)
+            )
+        except Exception as e:
+            print(f'[EXCEPTION] UserService.get_user_by_username_async. Exception: {e}')
+            return Result(
+                Result.FAIL,
+                'An error occurred while retrieving user',
+                Result.EXCEPTION
+            )
+
+    @staticmethod
+    async def get_principal_async(username: str) -> Result:
+        ''' Get the authenticated user; users are cached for AUTH_CONFIG['principal_ttl'] seconds. The cached user
+        is shared by requests and must not be modified
+
+        :param username: the token's subject
+
+        :return: a Result object, on success Result.data is a transient User object
+        '''
+        user = UserService.PRINCIPALS.get(username)
+        if user is not None:
+            return Result(
+                Result.SUCCESS,
+                'Successfully retrieved user',
+                user
+            )
+
+        result = await UserService.get_user_by_username_async(username)
+        if result.is_success():
+            UserService.PRINCIPALS.set(username, result.data)
+
+        return result
+
+    @staticmethod
+    async def get_users_by_usernames_async(usernames: List[str]) -> Result:
+        ''' Get users by username in a single query
+
+        :param usernames: list of usernames
+
+        :return: a Result object, on success Result.data is a dict {<username>: User}, of transient User objects; missing
+                 users are not included
+        '''
+        try:
+            usernames = list(set(usernames))
+            records = await database.fetch_all(select([User.__table__]).where(User.username.in_(usernames))) \
+                if len(usernames) > 0 else []
+            users = [to_model(User, record) for record in records]
+
+            return Result(
+                Result.SUCCESS,
+                'Successfully retrieved users',
+                {user.username: user for user in users}
+            )
+        except Exception as e:
+            print(f'[EXCEPTION] UserService.get_users_by_usernames_async. Exception: {e}')
+            return Result(
+                Result.FAIL,
+                'An error occurred while retrieving users',
+                Result.EXCEPTION
+            )
+
     @staticmethod
     def get_user_by_email(email: str) -> Result:
         try:
@@ -231,6 +315,7 @@ class UserService:
             user_data.description = user.description
 
             session.commit()
+            UserService.PRINCIPALS.invalidate(user_data.username)
 
             updated_user = UserService.get_user_by_username(user_data.username)
 
@@ -266,6 +351,7 @@ class UserService:
             user_data.hash_pw(new_password)
             # Update user
             session.commit()
+            UserService.PRINCIPALS.invalidate(user_data.username)
 
             return Result(
                 Result.SUCCESS,
@@ -286,6 +372,7 @@ class UserService:
         response = session.query(User).filter(User.username == username).delete()
 
         session.commit()
+        UserService.PRINCIPALS.invalidate(username)
 
         result = bool(response)
 
@@ -358,3 +445,22 @@ class UserService:
                 'An error occurred while retrieving count of model versions',
                 Result.EXCEPTION
             )
+
+    @staticmethod
+    async def count_user_model_versions_async(username: str) -> Result:
+        try:
+            count = await database.fetch_val(select([func.count()]).select_from(ModelVersion.__table__)
+                                             .where(ModelVersion.user_id == username))
+
+            return Result(
+                Result.SUCCESS,
+                f'User has {count} model versions',
+                count
+            )
+        except:
+            return Result(
+                Result.FAIL,
+                'An error occurred while retrieving count of model versions',
+                Result.EXCEPTION
+            )
+
@@ -0,0 +1,76 @@
+import asyncio
+import json
+import time
+
+import pytest
+
+pytest.importorskip('aiohttp')
+pytest.importorskip('pandas')
+
+from libs.micro_batcher import MicroBatcher
+from libs.prediction_cache import PredictionCache
+from models.result import Result
+from services.model_serving_service import ModelServingService
+
+
+def get_model_serving(posts: list) -> ModelServingService:
+    ''' ModelServingService whose model worker echoes the first input column of each row as its prediction
+    '''
+    model_serving = ModelServingService.__new__(ModelServingService)
+
+    async def post(url, columns, data):
+        posts.append(len(data))
+        return 200, json.dumps([row[0] for row in data]).encode('utf-8')
+
+    model_serving._ModelServingService__post = post
+    model_serving.MICRO_BATCHING = True
+    model_serving.BATCHER = MicroBatcher(model_serving._ModelServingService__invoke_batch, max_size=100, max_latency=0.05)
+
+    return model_serving
+
+
+def test_invoke_concurrent_requests_are_batched():
+    posts = []
+    model_serving = get_model_serving(posts)
+    requests = [[[i, 0], [i + 0.5, 0]] for i in range(5)]
+
+    async def invoke_all():
+        return await asyncio.gather(*[model_serving.invoke(5000, '/invocations/model/1', ['a', 'b'], data)
+                                      for data in requests])
+
+    results = asyncio.get_event_loop().run_until_complete(invoke_all())
+
+    for data, (status, body) in zip(requests, results):
+        assert status == 200
+        assert json.loads(body) == [row[0] for row in data]
+    # requests of the same tick are coalesced into a single invocation
+    assert posts == [10]
+
+
+def test_predict_rows_scores_all_rows_if_output_is_not_per_row(tmp_path):
+    posts = []
+    model_serving = get_model_serving(posts)
+
+    # split output: not per row, thus never cached
+    async def post(url, columns, data):
+        posts.append(len(data))
+        return 200, json.dumps({'columns': ['prediction'], 'data': [[row[0]] for row in data]}).encode('utf-8')
+
+    async def serve(name, version):
+        return Result(Result.SUCCESS, 'Serving model', {'port': 5000, 'path': '/invocations/model/1'})
+
+    model_serving._ModelServingService__post = post
+    model_serving.serve = serve
+    model_serving.CACHE_SETTINGS = {'model': (True, time.monotonic() + 60)}
+    model_serving.PREDICTION_CACHE = PredictionCache(str(tmp_path / 'predictions.db'), 1024 * 1024, 1024 * 1024)
+    # a row cached by an earlier request
+    model_serving.PREDICTION_CACHE.put_many([(PredictionCache.get_key('model', 1, ['a', 'b'], [1, 0]), b'1')])
+
+    result = asyncio.get_event_loop().run_until_complete(
+        model_serving.predict_rows('model', 1, ['a', 'b'], [[1, 0], [2, 0]]))
+
+    status, body = result.data
+    assert status == 200
+    assert json.loads(body)['data'] == [[1], [2]]
+    # the missing row is scored first; its output is not per row, thus all rows are scored
+    assert posts == [1, 2]
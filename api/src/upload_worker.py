@@ -0,0 +1,53 @@
+'''
+Upload worker
+
+Runs MODEL_UPLOAD_SERVICE_CONFIG['workers'] processes that register the model uploads queued by the upload server.
+Crashed processes are restarted; their running uploads are recovered by the other workers.
+
+    python upload_worker.py
+'''
+import multiprocessing
+import signal
+import sys
+import time
+
+from config.config import MODEL_UPLOAD_SERVICE_CONFIG
+
+
+def run_worker(worker_index: int) -> None:
+    # Imported in the worker process; each process creates its own database engine
+    from services.upload_worker_service import UploadWorkerService
+
+    UploadWorkerService.run(worker_index)
+
+
+def main() -> None:
+    context = multiprocessing.get_context('spawn')
+    workers = {}
+
+    def stop(signum, frame):
+        print('[INFO] Stopping upload workers')
+        for process in workers.values():
+            process.terminate()
+        for process in workers.values():
+            process.join()
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    while True:
+        for worker_index in range(MODEL_UPLOAD_SERVICE_CONFIG['workers']):
+            process = workers.get(worker_index)
+            if process is None or not process.is_alive():
+                if process is not None:
+                    print(f'[WARN] Upload worker {worker_index} exited with code {process.exitcode}; restarting')
+                process = context.Process(target=run_worker, args=(worker_index,), name=f'upload-worker-{worker_index}')
+                process.start()
+                workers[worker_index] = process
+
+        time.sleep(MODEL_UPLOAD_SERVICE_CONFIG['poll_interval'])
+
+
+if __name__ == '__main__':
+    main()
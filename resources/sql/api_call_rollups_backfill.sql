@@ -0,0 +1,19 @@
+-- Backfill usage rollups from api_calls
+-- Run once, with the api servers stopped, after creating api_call_rollups and api_call_model_totals
+
+begin;
+
+truncate api_call_rollups, api_call_model_totals;
+
+insert into api_call_rollups(granularity, bucket, model_name, user_id, calls)
+select g.granularity, date_trunc(g.granularity, a.call_time), a.model_name, a.user_id, sum(a.calls)
+from api_calls a
+cross join (values ('minute'), ('hour'), ('day')) as g(granularity)
+group by g.granularity, date_trunc(g.granularity, a.call_time), a.model_name, a.user_id;
+
+insert into api_call_model_totals(model_name, calls, last_call_time)
+select model_name, sum(calls), max(call_time)
+from api_calls
+group by model_name;
+
+commit;
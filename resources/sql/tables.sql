@@ -14,9 +14,30 @@ Create table api_calls(
     model_name varchar(256) NOT NULL,
     user_id int NOT NULL references users(id) ON UPDATE CASCADE ON DELETE CASCADE,
     call_time timestamp default now(),
+    calls integer default 1 NOT NULL,
     constraint registered_models_fk FOREIGN KEY (model_name) references registered_models(name) ON UPDATE CASCADE ON DELETE CASCADE
 );
 
+-- Usage rollups; maintained with api_calls by the metering flusher
+Create table api_call_rollups(
+    granularity varchar(8) NOT NULL, -- 'minute', 'hour' or 'day'
+    bucket timestamp NOT NULL,
+    model_name varchar(256) NOT NULL,
+    user_id int NOT NULL references users(id) ON UPDATE CASCADE ON DELETE CASCADE,
+    calls bigint default 0 NOT NULL,
+    PRIMARY KEY (granularity, model_name, bucket, user_id),
+    constraint registered_models_fk FOREIGN KEY (model_name) references registered_models(name) ON UPDATE CASCADE ON DELETE CASCADE
+);
+
+Create table api_call_model_totals(
+    model_name varchar(256) primary key,
+    calls bigint default 0 NOT NULL,
+    last_call_time timestamp,
+    constraint registered_models_fk FOREIGN KEY (model_name) references registered_models(name) ON UPDATE CASCADE ON DELETE CASCADE
+);
+
+create index api_call_model_totals_calls_idx on api_call_model_totals(calls desc);
+
 Create table hashtags(
     id serial primary key,
     key varchar(32) NOT NULL,
@@ -106,3 +127,81 @@ create table model_comments(
     comment text NOT NULL,
     created_at timestamp default now()
 );
+
+-- Keyset pagination of registered models search; registered_models is created by mlflow
+create index if not exists registered_models_creation_time_name_idx on registered_models(creation_time desc, name desc);
+
+-- A batch prediction is metered as a single api call row with calls = batch size
+alter table api_calls add column if not exists calls integer default 1 NOT NULL;
+
+-- Batch scoring jobs; input and output files are kept in the shared cache directory
+create table batch_jobs(
+    id serial primary key,
+    user_id int NOT NULL references users(id) ON UPDATE CASCADE ON DELETE CASCADE,
+    model_name varchar(256) NOT NULL,
+    model_version integer NOT NULL,
+    status varchar(12) default 'queued' NOT NULL,
+    input_format varchar(12) NOT NULL,
+    input_path text NOT NULL,
+    output_path text,
+    total_rows bigint,
+    processed_rows bigint default 0 NOT NULL,
+    error text,
+    created_at timestamp default now() NOT NULL,
+    started_at timestamp,
+    finished_at timestamp
+);
+
+create index if not exists batch_jobs_status_id_idx on batch_jobs(status, id);
+create index if not exists batch_jobs_user_id_idx on batch_jobs(user_id, id desc);
+
+-- Uploaded zip file's size and sha256, computed while the upload is streamed
+alter table model_uploads add column if not exists file_size bigint;
+alter table model_uploads add column if not exists content_hash varchar(64);
+
+-- Content-addressed artifact files: the stored copy of each distinct file logged by model uploads
+create table artifact_blobs(
+    sha256 varchar(64) primary key,
+    size bigint NOT NULL,
+    uri text NOT NULL,
+    created_at timestamp default now() NOT NULL
+);
+
+-- Identical uploads of a user are registered once
+create index if not exists model_uploads_user_id_content_hash_idx on model_uploads(user_id, content_hash);
+
+-- Upload queue: uploads are queued with the path of their zip file and run by upload workers
+alter table model_uploads add column if not exists upload_path text;
+alter table model_uploads add column if not exists attempts integer default 0 NOT NULL;
+alter table model_uploads add column if not exists worker_id varchar(64);
+alter table model_uploads add column if not exists heartbeat_at timestamp;
+create index if not exists model_uploads_status_id_idx on model_uploads(status, id);
+
+-- Timing and size of the registration stages of model uploads
+create table model_upload_stages(
+    id serial primary key,
+    model_upload_id int NOT NULL references model_uploads(id) ON UPDATE CASCADE ON DELETE CASCADE,
+    stage varchar(32) NOT NULL,
+    attempt integer default 1 NOT NULL,
+    status varchar(12) default 'running' NOT NULL,
+    started_at timestamp NOT NULL,
+    finished_at timestamp,
+    bytes bigint,
+    error text
+);
+
+create index if not exists model_upload_stages_model_upload_id_idx on model_upload_stages(model_upload_id, id);
+
+-- Metering batches written to api_calls; a batch written again after a crash is skipped
+create table if not exists api_call_batches(
+    id varchar(256) primary key,
+    written_at timestamp default now() NOT NULL
+);
+
+-- Expired minute and hour usage rollups are deleted by the api server; see ApiCallService.delete_expired_usage
+create index if not exists api_call_rollups_granularity_bucket_idx on api_call_rollups(granularity, bucket);
+create index if not exists api_call_batches_written_at_idx on api_call_batches(written_at);
+
+-- Batch jobs left running by a stopped prediction server process are queued again; see BatchJobService.recover_stale
+alter table batch_jobs add column if not exists attempts integer default 0 NOT NULL;
+alter table batch_jobs add column if not exists heartbeat_at timestamp;